@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for jack_stream: protocol parsing, and the server's
+period-to-send path run in-process on the synthetic audio source, so no
+JACK server is needed. --json output is meant for regression tracking.
+"""
+
+# standard imports
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import tracemalloc
+
+import numpy as np
+
+from jack_stream_common import msgify_pkt, MsgParserType, pack_msg
+import jack_stream_talk as talk
+
+
+def make_stream(count, size):
+    # a META message every 100 DATA messages, like the 1 Hz server META
+    msgs = []
+    for idx in range(count):
+        if 0 == idx % 100:
+            msgs.append(pack_msg('META', dict(rms=[0.0]*8, clips=[0]*8)))
+        msgs.append(pack_msg('DATA', bytes(size)))
+    return b''.join(msgs), len(msgs)
+
+
+def chunked(stream, chunk):
+    return [stream[idx:idx+chunk] for idx in range(0, len(stream), chunk)]
+
+
+def bench_msgify_pkt(chunks):
+    prevpkt = bytearray()
+    count = 0
+    t0 = time.perf_counter()
+    for curpkt in chunks:
+        # msgify_pkt returns at most one message per call, so keep calling
+        # with an empty packet until it runs dry
+        msgtype, msg = msgify_pkt(prevpkt, curpkt, log=_quiet)
+        while msgtype in ('META', 'DATA'):
+            count += 1
+            msgtype, msg = msgify_pkt(prevpkt, b'', log=_quiet)
+    return count, time.perf_counter() - t0
+
+
+def bench_msg_parser(chunks):
+    parser = MsgParserType(log=_quiet)
+    count = 0
+    t0 = time.perf_counter()
+    for curpkt in chunks:
+        count += len(parser.feed(curpkt))
+    return count, time.perf_counter() - t0
+
+
+class _QuietLog:
+    def warning(self, *args): pass
+    def error(self, *args): pass
+_quiet = _QuietLog()
+
+
+def bench_parsers(count=20000, size=256+24, chunk=1448):
+    '''parse rate of msgify_pkt vs MsgParserType, in messages per second'''
+    stream, nmsgs = make_stream(count, size)
+    chunks = chunked(stream, chunk)
+    results = dict(messages=nmsgs, payload_size=size, chunk_size=chunk,
+        stream_bytes=len(stream))
+    for name, func in (('msgify_pkt', bench_msgify_pkt),
+            ('MsgParserType', bench_msg_parser)):
+        parsed, elapsed = func(chunks)
+        results[name] = dict(parsed=parsed, seconds=elapsed,
+            msgs_per_sec=parsed/elapsed if elapsed else float('inf'),
+            mbytes_per_sec=len(stream)/elapsed/1e6 if elapsed else float('inf'))
+    return results
+
+
+class FakeWsockType:
+    '''stands in for a client websocket, send() only counts'''
+    remote_address = ('127.0.0.1', 0)
+
+    def __init__(self):
+        self.msgs  = 0
+        self.bytes = 0
+        self.last_send = 0.0 # perf_counter of the latest send
+
+    async def send(self, msg):
+        self.msgs += 1
+        self.bytes += len(msg)
+        self.last_send = time.perf_counter()
+
+    async def close(self):
+        pass
+
+
+class BenchServerType:
+    '''
+    sendbufs_wsock_coro on its own event loop with fake clients, fed
+    period by period from a SyntheticSourceType, what jack_process would do
+    '''
+    def __init__(self, clients=1, channels=2, samplerate=48000, blocksize=256,
+            fmt='float32', argv=()):
+        self.source = talk.SyntheticSourceType(channels, samplerate, blocksize,
+            signal='noise', seed=0)
+        talk.configure(['--source', 'synthetic', '-c', str(channels),
+            '--loglevel', 'warning'] + list(argv), source=self.source)
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.ring = talk.PeriodRingType(channels, blocksize,
+            periods=talk.args.ring_periods)
+        self.ring.attach_loop(self.loop)
+
+        talk.g_client_d.clear()
+        self.clients = []
+        for idx in range(clients):
+            client = talk.ClientType(FakeWsockType(), None, connected=True,
+                maxqueue=talk.args.send_queue)
+            talk.apply_client_request(client, dict(
+                channel_select=list(range(1, channels+1)), format=fmt))
+            client.preroll_pending = False
+            talk.g_client_d[client.id] = client
+            self.clients.append(client)
+        self.loop.run_until_complete(self.start_clients())
+        self.task = self.loop.create_task(
+            talk.sendbufs_wsock_coro(self.ring, talk.g_client_d))
+
+    async def start_clients(self):
+        for client in self.clients:
+            client.start()
+
+    def idle(self):
+        return self.ring.pending() == 0 and all(client.sendq.empty()
+            for client in self.clients)
+
+    async def lockstep(self, periods):
+        '''one period at a time, returns (cpu, latency) per period in seconds;
+        latency is from the ring write to the last client's send'''
+        cpu = np.zeros(periods)
+        latency = np.zeros(periods)
+        for idx in range(periods):
+            c0 = time.process_time()
+            t0 = time.perf_counter()
+            self.source.process(self.ring)
+            while not self.idle():
+                await asyncio.sleep(0)
+            cpu[idx] = time.process_time() - c0
+            latency[idx] = max(client.wsock.last_send
+                for client in self.clients) - t0
+        return cpu, latency
+
+    async def freerun(self, periods):
+        '''as fast as the ring drains, returns (wall, cpu) seconds'''
+        c0 = time.process_time()
+        t0 = time.perf_counter()
+        for idx in range(periods):
+            while self.ring.pending() >= self.ring.periods:
+                await asyncio.sleep(0)
+            self.source.process(self.ring)
+            await asyncio.sleep(0)
+        while not self.idle():
+            await asyncio.sleep(0)
+        return time.perf_counter() - t0, time.process_time() - c0
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def close(self):
+        self.ring.close()
+        self.loop.run_until_complete(self.task)
+        self.loop.close()
+        asyncio.set_event_loop(None)
+# end BenchServerType
+
+
+def percentiles_us(x):
+    p50, p99 = np.percentile(x, (50, 99))
+    return dict(mean_us=1e6*float(np.mean(x)), p50_us=1e6*float(p50),
+        p99_us=1e6*float(p99), max_us=1e6*float(np.max(x)))
+
+
+def bench_period_path(periods=2000, clients=1, channels=2, blocksize=256,
+        fmt='float32', argv=()):
+    '''CPU and latency per period from the ring write to the client sends'''
+    server = BenchServerType(clients, channels, blocksize=blocksize, fmt=fmt,
+        argv=argv)
+    try:
+        server.run(server.lockstep(min(100, periods))) # warm caches
+        cpu, latency = server.run(server.lockstep(periods))
+    finally:
+        server.close()
+    period_s = blocksize / server.source.samplerate
+    return dict(periods=periods, clients=clients, channels=channels,
+        blocksize=blocksize, format=fmt, cpu=percentiles_us(cpu),
+        latency=percentiles_us(latency),
+        cpu_load=float(np.mean(cpu)) / period_s)
+
+
+def bench_fanout(client_counts=(1, 10, 100, 500), periods=500, channels=2,
+        blocksize=256, fmt='float32'):
+    '''throughput versus client count, realtime factor > 1 keeps up'''
+    results = []
+    for clients in client_counts:
+        server = BenchServerType(clients, channels, blocksize=blocksize, fmt=fmt,
+            argv=['--send-queue', str(max(64, periods))])
+        try:
+            wall, cpu = server.run(server.freerun(periods))
+        finally:
+            server.close()
+        audio_s = periods * blocksize / server.source.samplerate
+        sent = sum(client.wsock.msgs for client in server.clients)
+        results.append(dict(clients=clients, periods=periods, seconds=wall,
+            realtime_factor=audio_s/wall if wall else float('inf'),
+            cpu_per_period_us=1e6*cpu/periods,
+            msgs_per_sec=sent/wall if wall else float('inf'),
+            mbit_per_sec=8e-6*sum(client.wsock.bytes
+                for client in server.clients)/wall if wall else float('inf'),
+            dropped=sum(client.dropped for client in server.clients)))
+    return results
+
+
+def bench_memory(periods=20000, clients=10, checkpoints=10, channels=2,
+        blocksize=256):
+    '''traced python memory while streaming, growth should be ~0'''
+    server = BenchServerType(clients, channels, blocksize=blocksize)
+    chunk = max(1, periods // checkpoints)
+    try:
+        server.run(server.freerun(chunk)) # warm up, fills history etc
+        tracemalloc.start()
+        samples = []
+        for idx in range(checkpoints):
+            server.run(server.freerun(chunk))
+            samples.append(tracemalloc.get_traced_memory()[0])
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        server.close()
+    return dict(periods=chunk*checkpoints, clients=clients,
+        traced_bytes=samples, peak_bytes=peak,
+        growth_bytes=samples[-1] - samples[0],
+        growth_bytes_per_kperiod=(samples[-1] - samples[0]) * 1000.0 /
+            (chunk * (checkpoints - 1)) if checkpoints > 1 else 0.0)
+
+
+BENCHES = ('parsers', 'period', 'fanout', 'memory')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Process args for jack_stream_bench.py')
+    parser.add_argument('--count', type=int, default=20000, \
+        help = "number of DATA messages to parse")
+    parser.add_argument('--size', type=int, default=256+24, \
+        help = "DATA payload size in bytes")
+    parser.add_argument('--chunk', type=int, default=1448, \
+        help = "bytes delivered per simulated socket read")
+    parser.add_argument('--periods', type=int, default=2000, \
+        help = "periods streamed by the period, fanout and memory benches")
+    parser.add_argument('--clients', type=str, default='1,10,100,500', \
+        help = "',' separated client counts for the fanout bench")
+    parser.add_argument('-c', '--channels', type=int, default=2, \
+        help = "synthetic source channels")
+    parser.add_argument('--blocksize', type=int, default=256, \
+        help = "synthetic source frames per period")
+    parser.add_argument('--format', default='float32', \
+        choices=sorted(talk.SAMPLE_FORMATS), \
+        help = "sample format the fake clients request")
+    parser.add_argument('--only', type=str, default=','.join(BENCHES), \
+        help = "',' separated benches to run, of {}".format(','.join(BENCHES)))
+    parser.add_argument('--json', action='store_true', \
+        help = "print results as json")
+    args = parser.parse_args()
+    only = args.only.split(',')
+    logging.root.setLevel('WARNING')
+
+    results = dict()
+    if 'parsers' in only:
+        results['parsers'] = bench_parsers(args.count, args.size, args.chunk)
+    if 'period' in only:
+        results['period'] = bench_period_path(args.periods,
+            channels=args.channels, blocksize=args.blocksize, fmt=args.format)
+    if 'fanout' in only:
+        results['fanout'] = bench_fanout(
+            [int(count) for count in args.clients.split(',')],
+            max(1, args.periods // 4), args.channels, args.blocksize, args.format)
+    if 'memory' in only:
+        results['memory'] = bench_memory(10 * args.periods,
+            channels=args.channels, blocksize=args.blocksize)
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+
+    if 'parsers' in results:
+        for name in ('msgify_pkt', 'MsgParserType'):
+            res = results['parsers'][name]
+            print('{:14s} {:8d} msgs {:8.3f} s {:12.0f} msgs/s {:8.1f} MB/s'.format(
+                name, res['parsed'], res['seconds'], res['msgs_per_sec'],
+                res['mbytes_per_sec']))
+    if 'period' in results:
+        res = results['period']
+        print('period path    cpu p50 {:7.1f} us p99 {:7.1f} us, latency p50 '
+            '{:7.1f} us p99 {:7.1f} us, load {:5.1%}'.format(res['cpu']['p50_us'],
+            res['cpu']['p99_us'], res['latency']['p50_us'],
+            res['latency']['p99_us'], res['cpu_load']))
+    for res in results.get('fanout', ()):
+        print('fanout {:5d}   {:8.1f} x realtime {:9.1f} us/period {:9.1f} '
+            'Mbit/s {:6d} dropped'.format(res['clients'], res['realtime_factor'],
+            res['cpu_per_period_us'], res['mbit_per_sec'], res['dropped']))
+    if 'memory' in results:
+        res = results['memory']
+        print('memory         {:d} periods, growth {:d} bytes ({:.1f} per '
+            '1000 periods), peak {:d} bytes'.format(res['periods'],
+            res['growth_bytes'], res['growth_bytes_per_kperiod'],
+            res['peak_bytes']))
+
+
+if __name__ == '__main__':
+    main()
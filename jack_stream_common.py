@@ -2,11 +2,311 @@
 '''FIXME add jack_stream_utils doc string'''
 
 import json
+import time
 import struct
 import logging
+import collections
+
+import numpy as np
 
 JACK_STREAM_VERSION = '0.01'
 
+# sample formats a client may negotiate for DATA frames, all little endian
+SAMPLE_FORMATS = {
+    'float32': dict(samplesize=32, sampletype='float'),
+    'int16'  : dict(samplesize=16, sampletype='signedint'),
+    'int24'  : dict(samplesize=24, sampletype='signedint'), # packed, 3 bytes
+}
+DEFAULT_SAMPLE_FORMAT = 'float32'
+FORMAT_IDS = dict(float32=1, int16=2, int24=3)
+FORMAT_NAMES = {fid: fmt for fmt, fid in FORMAT_IDS.items()}
+
+# fixed little endian header in front of every DATA payload:
+#   version, format id, channels per frame, sequence number (per stream),
+#   JACK frame time of the first frame, mask of source inports (bit 0 is
+#   channel 1), frames per channel in the payload
+DATA_HEADER_VERSION = 1
+DATA_HEADER = struct.Struct('<BBHIIQI')
+DataHeader = collections.namedtuple('DataHeader',
+    'version format_id frame_channels sequence frame_time channel_mask frames')
+
+# the channel_mask is 64 bits, streams can only carry the inports it can name
+MASK_CHANNELS = 8 * struct.calcsize('<Q')
+
+
+# DATA messages with this format id carry no payload, they stand for
+# 'frames' frames of silence (discontinuous transmission)
+SILENCE_FORMAT_ID = 0
+
+
+def pack_data_header(fmt, frame_channels, sequence, frame_time, channel_mask, frames,
+        codec=None):
+    return DATA_HEADER.pack(DATA_HEADER_VERSION,
+        CODEC_FORMAT_IDS[fmt, codec or PCM_CODEC], frame_channels,
+        sequence & 0xffffffff, frame_time & 0xffffffff, channel_mask, frames)
+
+
+def pack_silence(frame_channels, sequence, frame_time, channel_mask, frames):
+    '''a complete DATA message standing for frames of silence'''
+    return DATA_HEADER.pack(DATA_HEADER_VERSION, SILENCE_FORMAT_ID, frame_channels,
+        sequence & 0xffffffff, frame_time & 0xffffffff, channel_mask, frames)
+
+
+def parse_data(buf):
+    '''split a DATA message in to (DataHeader, payload memoryview), no copy'''
+    mv = memoryview(buf)
+    hdr = DataHeader._make(DATA_HEADER.unpack_from(mv))
+    if hdr.version != DATA_HEADER_VERSION:
+        raise ValueError('unsupported DATA header version {}'.format(hdr.version))
+    return hdr, mv[DATA_HEADER.size:]
+
+
+def seq_delta(seq, expected):
+    '''number of messages skipped between expected and seq, wraps at 2**32'''
+    return (seq - expected) & 0xffffffff
+
+
+def format_dict(fmt, **kwargs):
+    '''build the META 'format' block for sample format fmt'''
+    outp = dict(kwargs)
+    outp.update(SAMPLE_FORMATS[fmt])
+    outp['sampleformat'] = fmt
+    outp['byteorder'] = 'little'
+    outp.setdefault('codec', PCM_CODEC)
+    return outp
+
+
+def _quantize(x, bits, rng):
+    # TPDF dither of +/- 1 LSB, then round and clip to the integer range;
+    # float32 spacing near 2**23 is 0.5, so 24 bit samples are scaled and
+    # dithered in float64 or most of the dither would be rounded away
+    dtype = np.float64 if bits > 16 else np.float32
+    scale = float(2**(bits-1))
+    y = np.multiply(x, scale, dtype=dtype)
+    if rng is not None:
+        y += rng.random(x.shape, dtype)
+        y -= rng.random(x.shape, dtype)
+    np.rint(y, out=y)
+    np.clip(y, -scale, scale-1, out=y)
+    return y.astype(np.int32)
+
+
+def encode_samples(x, fmt, rng=None):
+    '''
+    convert float32 samples x (any shape) to sample format fmt
+
+    the returned array has x.shape plus, for 'int24', a trailing axis of 3
+    bytes, so slicing rows of a (channels x frames) block still works
+    '''
+    if fmt == 'float32':
+        return np.ascontiguousarray(x, np.dtype('<f4'))
+    elif fmt == 'int16':
+        return _quantize(x, 16, rng).astype(np.dtype('<i2'))
+    elif fmt == 'int24':
+        q = _quantize(x, 24, rng).astype(np.dtype('<i4'))
+        return q.view(np.uint8).reshape(x.shape + (4,))[..., :3]
+    raise ValueError('unknown sample format {!r}'.format(fmt))
+
+
+def decode_samples(buf, fmt):
+    '''convert DATA bytes in sample format fmt back to flat float32'''
+    if fmt == 'float32':
+        return np.frombuffer(buf, np.dtype('<f4'))
+    elif fmt == 'int16':
+        return np.frombuffer(buf, np.dtype('<i2')) * np.float32(1.0/2**15)
+    elif fmt == 'int24':
+        b = np.frombuffer(buf, np.uint8).reshape(-1, 3)
+        q = np.zeros((b.shape[0], 4), np.uint8)
+        q[:, 1:] = b # shift up one byte, then arithmetic shift back down
+        return (q.view(np.dtype('<i4'))[:, 0] >> 8) * np.float32(1.0/2**23)
+    raise ValueError('unknown sample format {!r}'.format(fmt))
+
+
+# lossless codec for the integer formats: per channel fixed polynomial
+# prediction (order 0..3, as in FLAC) of the quantized samples, residuals
+# Rice coded as one unary section of quotients and one section of k-bit
+# remainders, both packed with whole-array NumPy ops
+PCM_CODEC = 'audio/pcm'
+LOSSLESS_CODEC = 'audio/x-lpc-rice'
+CODECS = (PCM_CODEC, LOSSLESS_CODEC)
+LOSSLESS_FORMATS = ('int16', 'int24')
+
+# every (sample format, codec) pair has its own DATA format id, so a
+# receiver can tell lossless from PCM payloads without the META
+CODEC_FORMAT_IDS = {(fmt, PCM_CODEC): fid for fmt, fid in FORMAT_IDS.items()}
+CODEC_FORMAT_IDS.update({('int16', LOSSLESS_CODEC): 0x12,
+    ('int24', LOSSLESS_CODEC): 0x13})
+FORMAT_CODECS = {fid: key for key, fid in CODEC_FORMAT_IDS.items()}
+
+# block: byte length (incl. this header), frames, channels
+LPC_BLOCK = struct.Struct('<IHH')
+# per channel: predictor order, rice parameter k, unary section bytes; or
+# LPC_VERBATIM, bytes per sample, sample bytes for a channel stored as is
+LPC_SUBFRAME = struct.Struct('<BBI')
+LPC_MAX_ORDER = 3
+LPC_MAX_K = 30
+LPC_VERBATIM = 0xff
+
+
+def quantize_samples(x, fmt, rng=None):
+    '''float32 samples to the int32 values sample format fmt transmits'''
+    return _quantize(x, SAMPLE_FORMATS[fmt]['samplesize'], rng)
+
+
+def _rice_encode(u, k):
+    # unary quotients: q zero bits then a one bit per value
+    q = u >> k
+    ones = np.cumsum(q + 1) - 1
+    unary = np.zeros(int(ones[-1]) + 1 if len(u) else 0, np.uint8)
+    unary[ones] = 1
+    rem = b''
+    if k:
+        shifts = np.arange(k-1, -1, -1, dtype=np.uint64)
+        bits = ((u[:, None] >> shifts) & 1).astype(np.uint8)
+        rem = np.packbits(bits).tobytes()
+    return np.packbits(unary).tobytes(), rem
+
+
+def _rice_decode(unary, rem, n, k):
+    bits = np.unpackbits(np.frombuffer(unary, np.uint8))
+    ones = np.flatnonzero(bits)[:n]
+    if len(ones) != n:
+        raise ValueError('truncated lossless block')
+    q = np.diff(ones, prepend=-1).astype(np.uint64) - 1
+    if not k:
+        return q
+    rbits = np.unpackbits(np.frombuffer(rem, np.uint8))[:n*k].reshape(n, k)
+    weights = np.uint64(1) << np.arange(k-1, -1, -1, dtype=np.uint64)
+    return (q << np.uint64(k)) | (rbits.astype(np.uint64) @ weights)
+
+
+def _verbatim_width(x):
+    # fewest little endian bytes that hold every sample of x
+    if not len(x) or (-2**15 <= x.min() and x.max() < 2**15):
+        return 2
+    if -2**23 <= x.min() and x.max() < 2**23:
+        return 3
+    return 4
+
+
+def _verbatim_encode(x, width):
+    return x.astype('<i4').view(np.uint8).reshape(-1, 4)[:, :width].tobytes()
+
+
+def _verbatim_decode(buf, frames, width):
+    # the bytes go to the top of an int32, the shift back sign extends
+    raw = np.zeros((frames, 4), np.uint8)
+    raw[:, 4-width:] = np.frombuffer(buf, np.uint8).reshape(frames, width)
+    return raw.view('<i4').reshape(frames) >> (8 * (4 - width))
+
+
+def encode_lossless(q):
+    '''
+    lossless block for int32 samples q shaped (frames x channels); blocks
+    may be concatenated, e.g. for a batch of periods. A channel that does
+    not compress (e.g. noise) is stored verbatim, so a block is never more
+    than a few header bytes larger than the packed samples.
+    '''
+    q = np.asarray(q, np.int64)
+    if q.ndim == 1:
+        q = q[:, None]
+    frames, nch = q.shape
+    parts = []
+    for ch in range(nch):
+        x = q[:, ch]
+        width = _verbatim_width(x)
+        if frames <= LPC_MAX_ORDER:
+            parts.append(LPC_SUBFRAME.pack(LPC_VERBATIM, width, frames * width))
+            parts.append(_verbatim_encode(x, width))
+            continue
+        # pick the order with the smallest residual magnitude
+        resids = [np.diff(x, n=o) for o in range(min(LPC_MAX_ORDER, frames-1) + 1)]
+        tail = frames - len(resids) + 1
+        order = int(np.argmin([np.abs(e[len(e)-tail:]).sum() for e in resids]))
+        e = resids[order]
+
+        # zigzag to unsigned, then the k with the fewest total bits
+        u = ((e << 1) ^ (e >> 63)).astype(np.uint64)
+        ks = np.arange(LPC_MAX_K + 1, dtype=np.uint64)
+        cost = (u[None, :] >> ks[:, None]).sum(axis=1) + len(u) * (ks + 1)
+        k = int(np.argmin(cost)) if len(u) else 0
+
+        # the rice cost is known before coding, fall back to verbatim
+        if 4 * order + (int(cost[k]) + 7) // 8 >= frames * width:
+            parts.append(LPC_SUBFRAME.pack(LPC_VERBATIM, width, frames * width))
+            parts.append(_verbatim_encode(x, width))
+            continue
+        unary, rem = _rice_encode(u, k)
+        parts.append(LPC_SUBFRAME.pack(order, k, len(unary)))
+        parts.append(x[:order].astype('<i4').tobytes())
+        parts.append(unary)
+        parts.append(rem)
+    body = b''.join(parts)
+    return LPC_BLOCK.pack(LPC_BLOCK.size + len(body), frames, nch) + body
+
+
+def decode_lossless(buf):
+    '''int32 (frames x channels) samples of one or more lossless blocks'''
+    mv = memoryview(buf)
+    blocks = []
+    pos = 0
+    while pos < len(mv):
+        if pos + LPC_BLOCK.size > len(mv):
+            raise ValueError('truncated lossless block')
+        size, frames, nch = LPC_BLOCK.unpack_from(mv, pos)
+        end = pos + size
+
+        # check the header before allocating: every channel needs its
+        # subframe header and at least one bit per predicted sample
+        least = nch * (LPC_SUBFRAME.size + max(0, frames - LPC_MAX_ORDER) // 8)
+        if end > len(mv) or size < LPC_BLOCK.size + least:
+            raise ValueError('bad lossless block length')
+        pos += LPC_BLOCK.size
+        out = np.empty((frames, nch), np.int32)
+        for ch in range(nch):
+            if pos + LPC_SUBFRAME.size > end:
+                raise ValueError('truncated lossless block')
+            order, k, ubytes = LPC_SUBFRAME.unpack_from(mv, pos)
+            pos += LPC_SUBFRAME.size
+            if order == LPC_VERBATIM:
+                if ubytes != frames * k or not 2 <= k <= 4 or pos + ubytes > end:
+                    raise ValueError('bad verbatim subframe')
+                out[:, ch] = _verbatim_decode(mv[pos:pos+ubytes], frames, k)
+                pos += ubytes
+                continue
+            n = frames - order
+            rbytes = (n * k + 7) // 8
+            if (order > LPC_MAX_ORDER or n < 0 or k > LPC_MAX_K
+                    or pos + 4*order + ubytes + rbytes > end):
+                raise ValueError('bad lossless subframe')
+            warmup = np.frombuffer(mv[pos:pos+4*order], '<i4').astype(np.int64)
+            pos += 4*order
+            u = _rice_decode(mv[pos:pos+ubytes], mv[pos+ubytes:pos+ubytes+rbytes], n, k)
+            pos += ubytes + rbytes
+            e = (u >> np.uint64(1)).astype(np.int64) ^ -(u & np.uint64(1)).astype(np.int64)
+
+            # undo the differences, one cumulative sum per order
+            for o in range(order-1, -1, -1):
+                init = np.diff(warmup, n=o)[0]
+                e = np.concatenate(([init], init + np.cumsum(e)))
+            out[:, ch] = e
+        if pos != end:
+            raise ValueError('bad lossless block length')
+        blocks.append(out)
+    if not blocks:
+        return np.empty((0, 0), np.int32)
+    return np.concatenate(blocks)
+
+
+def decode_payload(buf, fmt, codec=PCM_CODEC):
+    '''DATA payload bytes to flat float32 samples, whatever the codec'''
+    if codec == LOSSLESS_CODEC:
+        bits = SAMPLE_FORMATS[fmt]['samplesize']
+        q = decode_lossless(buf).astype(np.float32).reshape(-1)
+        return q * np.float32(1.0/2**(bits-1))
+    return decode_samples(buf, fmt)
+
+
 def msgify_pkt(prevpkt, curpkt, msgtypes=('META', 'DATA'), log=logging):
     '''FIXME add msgify_pkt doc string'''
     prevpkt.extend(curpkt) # bytearray
@@ -47,6 +347,98 @@ def msgify_pkt(prevpkt, curpkt, msgtypes=('META', 'DATA'), log=logging):
 # end msgify_pkt
 
 
+# every framed message is a 4 byte msgtype, a little endian int32 length,
+# and then length bytes of payload
+MSG_PREFIX = struct.Struct('<4si')
+
+
+class MsgParserType:
+    '''
+    Incremental parser for a stream of framed META/DATA messages.
+
+    feed() returns every complete message as (msgtype, memoryview) tuples.
+    The views point in to the parser's buffer and are only valid until the
+    next call to feed(), copy them (bytes(view)) to keep them longer.
+    Consumed bytes are only compacted away when the buffer runs out of
+    room, and on corruption the parser re-syncs on the next msgtype tag
+    without rescanning bytes it has already checked.
+    '''
+    def __init__(self, msgtypes=('META', 'DATA'), maxlen=1<<24, bufsize=1<<16,
+            log=logging):
+        self.msgtypes = tuple(mt.encode() for mt in msgtypes)
+        self.maxlen   = maxlen # longer payloads are treated as corruption
+        self.log      = log
+        self.buf      = bytearray(bufsize)
+        self.view     = memoryview(self.buf)
+        self.pos      = 0 # read cursor
+        self.end      = 0 # write cursor
+        self.resyncs  = 0
+        self.skipped  = 0 # bytes thrown away while re-syncing
+
+    def _append(self, data):
+        n = len(data)
+        if self.end + n > len(self.buf):
+            # compact lazily: keep only the unread tail (at most one
+            # partial message) and grow by allocating a new buffer, never
+            # by resizing the one that may still have views exported
+            tail = self.view[self.pos:self.end]
+            size = len(self.buf)
+            while size < len(tail) + n:
+                size *= 2
+            buf = bytearray(size)
+            buf[0:len(tail)] = tail
+            self.buf, self.view = buf, memoryview(buf)
+            self.end -= self.pos
+            self.pos = 0
+        self.buf[self.end:self.end+n] = data
+        self.end += n
+
+    def _resync(self):
+        # find the earliest msgtype tag after the current (bad) position
+        self.resyncs += 1
+        start = self.pos + 1
+        found = [idx for idx in (self.buf.find(mt, start, self.end)
+            for mt in self.msgtypes) if idx >= 0]
+        if found:
+            newpos = min(found)
+        else:
+            # keep 3 bytes in case they are the start of a split tag
+            newpos = max(start, self.end - 3)
+        self.skipped += newpos - self.pos
+        self.pos = newpos
+
+    def feed(self, data):
+        if len(data):
+            self._append(data)
+
+        msgs = []
+        while self.end - self.pos >= MSG_PREFIX.size:
+            msgtype, pktlen = MSG_PREFIX.unpack_from(self.buf, self.pos)
+            if msgtype not in self.msgtypes or pktlen < 0 or pktlen > self.maxlen:
+                self.log.warning('out of sync, re-syncing')
+                self._resync()
+                continue
+
+            start = self.pos + MSG_PREFIX.size
+            if self.end - start < pktlen:
+                break # wait for more data
+
+            msgs.append((msgtype.decode(), self.view[start:start+pktlen]))
+            self.pos = start + pktlen
+
+        if self.pos == self.end:
+            self.pos = self.end = 0 # nothing pending, rewind for free
+        return msgs
+# end MsgParserType
+
+
+def pack_msg(msgtype, payload):
+    '''frame payload (bytes or a json-able object for META) as one message'''
+    if msgtype == 'META' and not isinstance(payload, (bytes, bytearray, memoryview)):
+        payload = json.dumps(payload).encode()
+    return MSG_PREFIX.pack(msgtype.encode(), len(payload)) + bytes(payload)
+
+
 import socket
 def get_ip():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -58,4 +450,223 @@ def get_ip():
         IP = '127.0.0.1'
     finally:
         s.close()
-    return IP
\ No newline at end of file
+    return IP
+
+class JitterBufferType:
+    '''
+    Preallocated float32 ring of (frames x channels) audio between the
+    network and the sound card, with a target depth that adapts to the
+    measured arrival jitter.
+
+    write() is called per received DATA message, read() by the audio
+    output. On underrun read() returns the right number of frames, padded
+    with silence, and the buffer re-fills to its target before playing
+    again. When the depth runs far past the target (e.g. after a network
+    stall) the excess is dropped with a short crossfade.
+    '''
+    def __init__(self, channels, samplerate, target_ms=60.0, min_ms=20.0,
+            max_ms=1000.0, fade=64):
+        self.channels   = channels
+        self.samplerate = samplerate
+        self.min_target = int(min_ms * samplerate / 1000.0)
+        self.max_target = int(max_ms * samplerate / 1000.0)
+        self.base_target= int(target_ms * samplerate / 1000.0)
+        self.target     = self.base_target
+        self.capacity   = 2 * self.max_target
+        self.fade       = fade
+        self.ramp       = np.linspace(0.0, 1.0, fade, dtype=np.float32)[:, None]
+
+        self.ring = np.zeros((self.capacity, channels), np.dtype('float32'))
+        self.wpos = 0 # total frames written, writer-owned
+        self.rpos = 0 # total frames read or skipped, reader-owned
+        self.buffering = True # waiting to reach self.target
+
+        # arrival jitter estimate in frames, RFC 3550 style
+        self.jitter = 0.0
+        self.last_arrival = None
+        self.last_frames = 0
+
+        # counters
+        self.underruns = 0
+        self.overruns = 0 # writes that found the ring full
+        self.dropped = 0 # frames discarded to bring the depth down
+
+    def depth(self):
+        return self.wpos - self.rpos
+
+    def _adapt(self, frames, now):
+        if self.last_arrival is not None:
+            expected = self.last_frames
+            actual = (now - self.last_arrival) * self.samplerate
+            self.jitter += (abs(actual - expected) - self.jitter) / 16.0
+        self.last_arrival = now
+        self.last_frames = frames
+        self.target = int(min(self.max_target, max(self.min_target,
+            self.base_target, 3.0 * self.jitter)))
+
+    def write(self, samples, now=None):
+        '''samples is (frames x channels) float32'''
+        frames = len(samples)
+        self._adapt(frames, time.monotonic() if now is None else now)
+        if frames > self.capacity:
+            samples, frames = samples[-self.capacity:], self.capacity
+
+        if self.depth() + frames > self.capacity:
+            # keep the newest audio, the reader skips ahead
+            self.overruns += 1
+            self.rpos = self.wpos + frames - self.capacity
+
+        start = self.wpos % self.capacity
+        n = min(frames, self.capacity - start)
+        self.ring[start:start+n] = samples[:n]
+        self.ring[:frames-n] = samples[n:]
+        self.wpos += frames
+
+    def write_silence(self, frames):
+        self.write(np.zeros((frames, self.channels), np.dtype('float32')))
+
+    def _take(self, pos, frames, out):
+        start = pos % self.capacity
+        n = min(frames, self.capacity - start)
+        out[:n] = self.ring[start:start+n]
+        out[n:frames] = self.ring[:frames-n]
+
+    def read(self, frames, out=None):
+        '''returns exactly frames x channels float32 samples'''
+        if out is None:
+            out = np.zeros((frames, self.channels), np.dtype('float32'))
+
+        depth = self.depth()
+        if self.buffering:
+            if depth < self.target:
+                out[:frames] = 0.0
+                return out[:frames]
+            self.buffering = False
+
+        if depth < frames:
+            # underrun, play what is left then silence and re-buffer
+            self.underruns += 1
+            self._take(self.rpos, depth, out)
+            out[depth:frames] = 0.0
+            self.rpos += depth
+            self.buffering = True
+            return out[:frames]
+
+        excess = depth - frames - 2 * self.target
+        if excess > self.fade:
+            # drop down to the target, crossfading old in to new
+            self._take(self.rpos, frames, out)
+            skip = depth - frames - self.target
+            self.dropped += skip
+            self.rpos += skip
+            fade = min(self.fade, frames)
+            newer = np.empty((frames, self.channels), np.dtype('float32'))
+            self._take(self.rpos, frames, newer)
+            ramp = self.ramp[:fade] if fade == self.fade else \
+                np.linspace(0.0, 1.0, fade, dtype=np.float32)[:, None]
+            out[:fade] = out[:fade] * (1.0 - ramp) + newer[:fade] * ramp
+            out[fade:frames] = newer[fade:]
+        else:
+            self._take(self.rpos, frames, out)
+        self.rpos += frames
+        return out[:frames]
+
+    def stats(self):
+        ms = 1000.0 / self.samplerate
+        return dict(depth_ms=self.depth()*ms, target_ms=self.target*ms,
+            jitter_ms=self.jitter*ms, underruns=self.underruns,
+            overruns=self.overruns, dropped_frames=self.dropped)
+# end JitterBufferType
+
+
+class FractionalResamplerType:
+    '''
+    Streaming cubic (Hermite) resampler for ratios close to 1, vectorized
+    over frames and channels. ratio is output frames per input frame and
+    may change between calls; phase and the last input frames are kept so
+    block boundaries are seamless.
+    '''
+    def __init__(self, channels):
+        self.channels = channels
+        self.hist  = np.zeros((3, channels), np.dtype('float32'))
+        self.phase = 0.0 # position of the next output frame, in input frames
+
+    def process(self, samples, ratio=1.0):
+        # x[0:3] are history, output positions are relative to x[1]
+        x = np.concatenate((self.hist, samples))
+        n = len(samples)
+        step = 1.0 / ratio
+        count = int(np.ceil((n - self.phase) / step))
+        pos = self.phase + step * np.arange(max(count, 0))
+        pos = pos[pos < n]
+
+        idx = pos.astype(np.int64)
+        t = (pos - idx).astype(np.float32)[:, None]
+        xm1, x0, x1, x2 = x[idx], x[idx+1], x[idx+2], x[idx+3]
+        c1 = 0.5 * (x1 - xm1)
+        c2 = xm1 - 2.5*x0 + 2.0*x1 - 0.5*x2
+        c3 = 0.5 * (x2 - xm1) + 1.5 * (x0 - x1)
+        out = ((c3*t + c2)*t + c1)*t + x0
+
+        self.phase = (self.phase + step * len(pos)) - n
+        self.hist[:] = x[-3:]
+        return out.astype(np.float32, copy=False)
+# end FractionalResamplerType
+
+
+class DriftCompensatorType:
+    '''
+    Estimates the sender/sound card clock ratio from the trend of the
+    jitter buffer depth (least squares slope over a sliding window, plus a
+    slow pull towards the target depth) and resamples incoming audio to
+    cancel it, so latency stays bounded over long sessions.
+    '''
+    def __init__(self, channels, samplerate, window_s=60.0, rate_hz=10.0,
+            tau_s=30.0, max_ppm=2000.0):
+        self.samplerate = samplerate
+        self.interval   = 1.0 / rate_hz
+        self.tau        = tau_s
+        self.max_dev    = max_ppm * 1e-6
+        self.resampler  = FractionalResamplerType(channels)
+
+        npoints = int(window_s * rate_hz)
+        self.times  = np.zeros(npoints)
+        self.errors = np.zeros(npoints) # depth - target, in frames
+        self.count  = 0
+        self.last   = None
+
+        self.ratio  = 1.0 # output/input frames, applied to incoming audio
+
+    def _estimate(self, now, error):
+        idx = self.count % len(self.times)
+        self.times[idx], self.errors[idx] = now, error
+        self.count += 1
+
+        n = min(self.count, len(self.times))
+        if n < 10:
+            return
+        t = self.times[:n] - now
+        e = self.errors[:n]
+        tm, em = t.mean(), e.mean()
+        var = np.dot(t - tm, t - tm)
+        slope = np.dot(t - tm, e - em) / var if var > 0 else 0.0 # frames/s
+
+        # positive slope: audio arrives faster than it is played
+        target = 1.0 - (slope + em / self.tau) / self.samplerate
+        target = min(1.0 + self.max_dev, max(1.0 - self.max_dev, target))
+        self.ratio += 0.1 * (target - self.ratio) # avoid audible wobble
+
+    def process(self, samples, jitter, now=None):
+        '''resample (frames x channels) samples before jitter.write()'''
+        now = time.monotonic() if now is None else now
+        if not jitter.buffering and (self.last is None or
+                now - self.last >= self.interval):
+            self.last = now
+            self._estimate(now, jitter.depth() - jitter.target)
+        if self.ratio == 1.0:
+            return samples
+        return self.resampler.process(samples, self.ratio)
+
+    def ppm(self):
+        return (self.ratio - 1.0) * 1e6
+# end DriftCompensatorType
@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+
+"""
+Headless jack_stream listener and load generator.
+
+Opens one or many connections to jack_stream_talk.py (websocket or the
+framed plain TCP protocol), selects channels, and writes the audio to
+WAV files, discards it, or measures throughput, sequence gaps and
+latency jitter per connection.
+"""
+
+# standard imports
+import sys
+import json
+import time
+import array
+import random
+import signal
+import asyncio
+import logging
+import argparse
+
+import numpy as np
+
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+from jack_stream_common import MsgParserType, pack_msg, parse_data, seq_delta, \
+    decode_payload, SILENCE_FORMAT_ID, CODEC_FORMAT_IDS, SAMPLE_FORMATS, CODECS, \
+    JACK_STREAM_VERSION
+from jack_stream_record import MmapWavType
+
+MODES = ('measure', 'discard', 'file')
+PERCENTILES = (50, 90, 99, 99.9)
+
+# latency samples kept per connection, a uniform sample of the whole run
+LATENCY_RESERVOIR = 4096
+
+
+class ConnStatsType:
+    '''
+    counters of one connection, latency as arrival minus frame time; the
+    latency percentiles come from a bounded reservoir sample, so memory
+    stays flat however long the run, min and max are exact
+    '''
+    def __init__(self, idx):
+        self.idx       = idx
+        self.bytes     = 0
+        self.data      = 0 # DATA messages
+        self.meta      = 0 # META messages
+        self.frames    = 0 # audio frames, silence markers included
+        self.silence   = 0 # DTX silence markers
+        self.gaps      = 0 # sequence discontinuities
+        self.lost      = 0 # DATA messages missing in those gaps
+        self.late      = 0 # late or duplicate DATA messages
+        self.errors    = 0 # undecodable DATA messages
+        self.connected = None # time of the first DATA message
+        self.latency   = array.array('d') # at most LATENCY_RESERVOIR samples
+        self.nlatency  = 0 # latencies observed
+        self.lat_min   = float('inf')
+        self.lat_max   = float('-inf')
+        self.rng       = random.Random(idx)
+
+        # frame time unwrapping, to seconds on the server's clock
+        self.last_ft   = None
+        self.clock     = 0 # unwrapped frame time
+
+    def frame_clock(self, frame_time):
+        if self.last_ft is not None:
+            self.clock += (frame_time - self.last_ft) & 0xffffffff
+        self.last_ft = frame_time
+        return self.clock
+
+    def add_latency(self, value):
+        # reservoir sampling (algorithm R): every value seen so far is in
+        # the sample with the same probability
+        self.lat_min = min(self.lat_min, value)
+        self.lat_max = max(self.lat_max, value)
+        n, self.nlatency = self.nlatency, self.nlatency + 1
+        if n < LATENCY_RESERVOIR:
+            self.latency.append(value)
+            return
+        idx = self.rng.randrange(n + 1)
+        if idx < LATENCY_RESERVOIR:
+            self.latency[idx] = value
+
+    def summary(self, elapsed, samplerate):
+        lat = np.frombuffer(self.latency, np.float64)
+        outp = dict(conn=self.idx, bytes=self.bytes, data=self.data,
+            meta=self.meta, frames=self.frames, silence=self.silence,
+            gaps=self.gaps, lost=self.lost, late=self.late, errors=self.errors,
+            mbit_per_sec=8e-6 * self.bytes / elapsed if elapsed else 0.0,
+            msgs_per_sec=self.data / elapsed if elapsed else 0.0,
+            realtime=self.frames / samplerate / elapsed if elapsed and samplerate else 0.0)
+        if len(lat):
+            # relative to the fastest message, the clocks are not shared
+            lat = (lat - self.lat_min) * 1000.0
+            outp['latency_ms'] = dict(('p{:g}'.format(p), float(v)) for p, v in
+                zip(PERCENTILES, np.percentile(lat, PERCENTILES)))
+            outp['latency_ms']['max'] = (self.lat_max - self.lat_min) * 1000.0
+        return outp
+# end ConnStatsType
+
+
+class TcpConnType:
+    '''framed META/DATA over plain TCP, as served by --tcp-port'''
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.parser = MsgParserType()
+        self.inbox  = []
+
+    async def recv(self):
+        '''returns (msgtype, payload, nbytes) with 'META' or 'DATA' msgtype'''
+        while not self.inbox:
+            data = await self.reader.read(1 << 16)
+            if not data:
+                raise ConnectionResetError('server closed the connection')
+            msgs = self.parser.feed(data)
+            # copy out, the parser reuses its buffer on the next feed()
+            self.inbox = [(mt, bytes(msg), len(msg)) for mt, msg in msgs]
+            self.inbox.reverse()
+        return self.inbox.pop()
+
+    async def send_meta(self, msg):
+        self.writer.write(pack_msg('META', msg))
+        await self.writer.drain()
+
+    async def close(self):
+        self.writer.close()
+# end TcpConnType
+
+
+class WsConnType:
+    '''websocket transport, str messages are META and bytes are DATA'''
+    def __init__(self, wsock):
+        self.wsock = wsock
+
+    async def recv(self):
+        msg = await self.wsock.recv()
+        if isinstance(msg, str):
+            return 'META', msg.encode(), len(msg)
+        return 'DATA', msg, len(msg)
+
+    async def send_meta(self, msg):
+        await self.wsock.send(json.dumps(msg))
+
+    async def close(self):
+        await self.wsock.close()
+# end WsConnType
+
+
+async def open_conn(args):
+    if args.transport == 'ws':
+        if websockets is None:
+            raise RuntimeError('the websockets package is needed for --transport ws')
+        wsock = await websockets.connect('ws://{}:{}'.format(args.host, args.port),
+            max_size=None)
+        return WsConnType(wsock)
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    return TcpConnType(reader, writer)
+
+
+def connect_msg(args):
+    # the 'connect' request, the same fields jack_stream_listen.py sends
+    msg = dict(message='connect', channel_select=args.channel_select,
+        format=args.format, codec=args.codec)
+    for name in ('rate', 'batch', 'rewind', 'preroll_ms'):
+        if getattr(args, name) is not None:
+            msg[name] = getattr(args, name)
+    return msg
+
+
+class HeadlessListenerType:
+    '''one connection: request a stream, then consume it per args.mode'''
+    def __init__(self, idx, args):
+        self.idx   = idx
+        self.args  = args
+        self.stats = ConnStatsType(idx)
+        self.fmt   = None # META format block in use
+        self.format_id = None
+        self.next_seq = None
+        self.wav   = None
+        self.files = 0
+
+    async def run(self):
+        conn = await open_conn(self.args)
+        try:
+            await conn.send_meta(connect_msg(self.args))
+            while True:
+                msgtype, msg, nbytes = await conn.recv()
+                self.stats.bytes += nbytes
+                if msgtype == 'META':
+                    self.handle_meta(msg)
+                else:
+                    self.handle_data(msg)
+        finally:
+            await conn.close()
+            self.close_file()
+
+    def handle_meta(self, msg):
+        self.stats.meta += 1
+        try:
+            meta = json.loads(msg)
+        except ValueError:
+            logging.warning('conn {}: bad META message'.format(self.idx))
+            return
+        fmt = meta.get('format') if isinstance(meta, dict) else None
+        if isinstance(fmt, dict) and fmt != self.fmt:
+            self.fmt = fmt
+            self.format_id = CODEC_FORMAT_IDS.get((fmt.get('sampleformat'),
+                fmt.get('codec', 'audio/pcm')))
+            self.close_file() # a new layout starts a new file
+
+    def handle_data(self, msg):
+        now = time.monotonic()
+        st = self.stats
+        try:
+            hdr, payload = parse_data(msg)
+        except Exception:
+            st.errors += 1
+            return
+        if self.fmt is None or hdr.format_id not in (self.format_id, SILENCE_FORMAT_ID):
+            st.errors += 1 # no META format yet, or from before a change
+            return
+
+        if st.connected is None:
+            st.connected = now
+        st.data += 1
+        st.frames += hdr.frames
+        if self.next_seq is not None and hdr.sequence != self.next_seq:
+            gap = seq_delta(hdr.sequence, self.next_seq)
+            if gap < 0x80000000:
+                st.gaps += 1
+                st.lost += gap
+            else:
+                st.late += 1
+                return
+        self.next_seq = (hdr.sequence + 1) & 0xffffffff
+
+        # arrival time minus the server's frame clock, offset is arbitrary
+        clock_rate = self.fmt.get('clock_rate', self.fmt['samplerate'])
+        st.add_latency(now - st.frame_clock(hdr.frame_time) / clock_rate)
+
+        if hdr.format_id == SILENCE_FORMAT_ID:
+            st.silence += 1
+            if self.args.mode == 'file':
+                self.write_file(np.zeros((hdr.frames, hdr.frame_channels), np.float32))
+            return
+        if self.args.mode == 'discard' or (self.args.mode == 'measure'
+                and not self.args.decode):
+            return
+        try:
+            samples = decode_payload(payload, self.fmt['sampleformat'],
+                self.fmt.get('codec', 'audio/pcm'))
+        except Exception:
+            st.errors += 1
+            return
+        if self.args.mode == 'file':
+            self.write_file(samples.reshape(-1, hdr.frame_channels))
+
+    def write_file(self, samples):
+        while len(samples):
+            if self.wav is None or self.wav.frames_left() == 0:
+                self.open_file(samples.shape[1])
+            samples = samples[self.wav.write(samples):]
+
+    def open_file(self, frame_channels):
+        self.close_file()
+        rate = self.fmt['samplerate']
+        path = '{}_{:04d}.wav'.format(self.args.output, self.files)
+        self.wav = MmapWavType(path, frame_channels, rate,
+            int(self.args.file_seconds * rate))
+        self.files += 1
+        logging.info('writing {}'.format(path))
+
+    def close_file(self):
+        if self.wav is not None:
+            self.wav.close()
+            self.wav = None
+# end HeadlessListenerType
+
+
+def aggregate(summaries, elapsed):
+    keys = ('bytes', 'data', 'meta', 'frames', 'silence', 'gaps', 'lost',
+        'late', 'errors')
+    outp = dict((key, sum(s[key] for s in summaries)) for key in keys)
+    outp['connections'] = len(summaries)
+    outp['seconds'] = elapsed
+    outp['mbit_per_sec'] = 8e-6 * outp['bytes'] / elapsed if elapsed else 0.0
+    p99 = [s['latency_ms']['p99'] for s in summaries if 'latency_ms' in s]
+    if p99:
+        outp['p99_latency_ms'] = dict(median=float(np.median(p99)),
+            worst=float(np.max(p99)))
+    return outp
+
+
+def print_report(report):
+    agg = report['total']
+    print('{} connections, {:.1f} s: {:.2f} Mbit/s, {} DATA, {} gaps '
+        '({} lost), {} late, {} errors'.format(agg['connections'],
+        agg['seconds'], agg['mbit_per_sec'], agg['data'], agg['gaps'],
+        agg['lost'], agg['late'], agg['errors']))
+    print('{:>5s} {:>9s} {:>8s} {:>6s} {:>6s} {:>8s} {:>8s} {:>8s}'.format(
+        'conn', 'Mbit/s', 'realtime', 'gaps', 'lost', 'p50 ms', 'p99 ms', 'max ms'))
+    for s in report['connections']:
+        lat = s.get('latency_ms', dict())
+        print('{:5d} {:9.3f} {:8.3f} {:6d} {:6d} {:8.2f} {:8.2f} {:8.2f}'.format(
+            s['conn'], s['mbit_per_sec'], s['realtime'], s['gaps'], s['lost'],
+            lat.get('p50', float('nan')), lat.get('p99', float('nan')),
+            lat.get('max', float('nan'))))
+
+
+async def run_coro(args):
+    listeners = [HeadlessListenerType(idx, args) for idx in range(args.connections)]
+    tasks = []
+    t0 = time.monotonic()
+    for listener in listeners:
+        tasks.append(asyncio.ensure_future(listener.run()))
+        if args.connect_rate > 0:
+            await asyncio.sleep(1.0 / args.connect_rate) # stagger the connects
+
+    stop = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    try:
+        loop.add_signal_handler(signal.SIGINT, stop.set)
+    except NotImplementedError:
+        pass
+    try:
+        await asyncio.wait_for(stop.wait(), args.duration or None)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.monotonic() - t0
+
+    for task in tasks:
+        task.cancel()
+    for listener, result in zip(listeners, await asyncio.gather(*tasks,
+            return_exceptions=True)):
+        if isinstance(result, Exception) and not isinstance(result,
+                asyncio.CancelledError):
+            logging.warning('conn {}: {}'.format(listener.idx, result))
+
+    summaries = [listener.stats.summary(elapsed, listener.fmt and
+        listener.fmt['samplerate']) for listener in listeners]
+    return dict(total=aggregate(summaries, elapsed), connections=summaries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Process args for jack_stream_headless.py')
+    parser.add_argument('--host', default='127.0.0.1', \
+        help = "jack_stream_talk.py host")
+    parser.add_argument('-p', '--port', type=int, default=4242, \
+        help = "websocket port, or the --tcp-port of the talk server")
+    parser.add_argument('--transport', default='ws', choices=('ws', 'tcp'), \
+        help = "websocket or framed plain TCP")
+    parser.add_argument('-c', '--channels', default='1', \
+        help = "',' separated 1-based channels to request")
+    parser.add_argument('--format', default='float32', choices=tuple(SAMPLE_FORMATS), \
+        help = "sample format to request")
+    parser.add_argument('--codec', default='audio/pcm', choices=CODECS, \
+        help = "codec to request")
+    parser.add_argument('--rate', type=int, default=None, \
+        help = "output sample rate to request, default is the JACK rate")
+    parser.add_argument('--batch', type=int, default=None, \
+        help = "JACK periods per DATA message to request")
+    parser.add_argument('--rewind', type=float, default=None, \
+        help = "seconds behind live to request")
+    parser.add_argument('--preroll-ms', dest='preroll_ms', type=float, default=None, \
+        help = "ms of history to request when the stream starts")
+    parser.add_argument('--mode', default='measure', choices=MODES, \
+        help = "write WAV files, discard the audio, or measure")
+    parser.add_argument('--decode', action='store_true', \
+        help = "also decode the audio in measure mode")
+    parser.add_argument('-o', '--output', default='jack_stream_headless', \
+        help = "WAV file name prefix in file mode")
+    parser.add_argument('--file-seconds', type=float, default=3600.0, \
+        help = "start a new WAV file after this many seconds")
+    parser.add_argument('-n', '--connections', type=int, default=1, \
+        help = "number of concurrent connections (load generator)")
+    parser.add_argument('--connect-rate', type=float, default=100.0, \
+        help = "connections opened per second, 0 is all at once")
+    parser.add_argument('-d', '--duration', type=float, default=0.0, \
+        help = "seconds to run, 0 is until Ctrl+C")
+    parser.add_argument('--json', action='store_true', \
+        help = "print the report as json")
+    parser.add_argument('--loglevel', default='info', \
+        choices=('debug', 'info', 'warning', 'error', 'critical'), \
+        help = "logging level")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper()))
+    args.channel_select = [int(ch) for ch in args.channels.split(',') if ch.strip()]
+    if args.mode == 'file' and args.connections != 1:
+        parser.error('file mode takes a single connection')
+
+    logging.info('jack_stream_headless v{}'.format(JACK_STREAM_VERSION))
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    report = loop.run_until_complete(run_coro(args))
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -34,7 +34,304 @@ except:
     sys.exit()
 
 
-from jack_stream_common import msgify_pkt, JACK_STREAM_VERSION
+from jack_stream_common import MsgParserType, parse_data, seq_delta, pack_msg, \
+    decode_payload, JitterBufferType, DriftCompensatorType, CODEC_FORMAT_IDS, \
+    SILENCE_FORMAT_ID, JACK_STREAM_VERSION
+
+import numpy as np
+
+# longest run of lost DATA messages that is concealed instead of skipped
+MAX_CONCEAL = 8
+
+# meter snapshots are forwarded to the GUI at most this often (seconds)
+GUI_METER_INTERVAL = 0.1
+
+class StreamWorker(QtCore.QObject):
+    '''
+    Owns the sockets, framing, decoding, jitter buffer and audio output and
+    lives in its own QThread, so GUI stalls do not stall audio. The GUI
+    drives it through queued signals and gets META messages back, with
+    meter snapshots throttled to GUI_METER_INTERVAL.
+    '''
+    metaReceived = PyQtSignal(object)
+    statusChanged = PyQtSignal(object)
+
+    def __init__(self):
+        super(StreamWorker, self).__init__()
+        self.audiolayout = () # channels the audio output is configured for
+        self.format_id = None # DATA format id the audio output expects
+        self.next_seq = None # expected DATA sequence number
+        self.lost = 0 # DATA messages missing from the sequence
+        self.dropped = 0 # DATA messages discarded, e.g. wrong format
+        self.concealed = 0 # DATA messages replaced by concealment
+        self.lastsamples = None # for repeating a single lost message
+        self.sampleformat = None # DATA sample format, decoded to float32
+        self.codec = 'audio/pcm' # DATA payload codec, from META format
+        self.frame_channels = 1
+        self.jitter = None # JitterBufferType, created by configureAudio
+        self.drift = None # DriftCompensatorType, server vs sound card clock
+        self.target_ms = '60' # initial jitter buffer target latency
+        self.udp_port = '0' # receive DATA over UDP on this port if not 0
+        self.mcast_group = '' # multicast group to join, '' for unicast
+        self.rate = '0' # server resamples to this rate if not 0
+        self.udp_mask = None # only accept datagrams from this channel mask
+        self.channel_select = []
+        self.lastmeter = 0.0 # time the last meter snapshot went to the GUI
+        self.pendingmeter = None # newest meter snapshot not yet forwarded
+
+    @PyQtSlot()
+    def start(self):
+        # Qt objects are created here so they belong to the worker thread
+        self.qsock = QtNetwork.QTcpSocket(self)
+        self.qsock.readyRead.connect(self.onReadyRead)
+        self.qsock.connected.connect(self.onConnected)
+        self.usock = None
+        self.parser = MsgParserType()
+        self.audiofmt = QAudioFormat()
+        self.audioout = QAudioOutput()
+        self.iodevice = BufferQueueIO(self)
+
+        self.meterTimer = QtCore.QTimer(self)
+        self.meterTimer.setSingleShot(True)
+        self.meterTimer.timeout.connect(self.flushMeter)
+        self.statusTimer = QtCore.QTimer(self)
+        self.statusTimer.timeout.connect(self.emitStatus)
+        self.statusTimer.start(1000)
+
+    @PyQtSlot(object)
+    def openConnection(self, params):
+        self.udp_port = params['udp_port']
+        self.mcast_group = params['mcast_group']
+        self.target_ms = params['target_ms']
+        self.rate = params['rate']
+        self.channel_select = list(params['channel_select'])
+        self.qsock.connectToHost(params['ip'], int(params['port']))
+        self.qsock.setSocketOption(QtNetwork.QAbstractSocket.LowDelayOption, 1)
+        if int(self.udp_port or 0) > 0:
+            self.udpBind()
+
+    @PyQtSlot()
+    def closeConnection(self):
+        if self.usock is not None:
+            self.usock.close()
+            self.usock = None
+        self.qsock.disconnectFromHost()
+        self.audioout.stop()
+        self.iodevice.stop()
+        self.audiolayout = ()
+        self.udp_mask = None
+        self.parser = MsgParserType()
+        self.jitter = None
+
+    @PyQtSlot(object)
+    def sendMeta(self, msg):
+        if msg.get('message') == 'channel_select':
+            self.channel_select = list(msg['channel_select'])
+        if self.qsock.state() == QtNetwork.QAbstractSocket.ConnectedState:
+            self.qsock.write(QByteArray(pack_msg('META', msg)))
+
+    @PyQtSlot()
+    def stop(self):
+        self.statusTimer.stop()
+        self.closeConnection()
+        QtCore.QThread.currentThread().quit()
+
+    def udpBind(self):
+        self.usock = QtNetwork.QUdpSocket(self)
+        self.usock.bind(QtNetwork.QHostAddress(QtNetwork.QHostAddress.AnyIPv4),
+            int(self.udp_port), QtNetwork.QUdpSocket.ShareAddress |
+            QtNetwork.QUdpSocket.ReuseAddressHint)
+        if self.mcast_group:
+            self.usock.joinMulticastGroup(QtNetwork.QHostAddress(self.mcast_group))
+        self.usock.readyRead.connect(self.onUdpReadyRead)
+
+    @PyQtSlot()
+    def onUdpReadyRead(self):
+        while self.usock.hasPendingDatagrams():
+            datagram, host, port = self.usock.readDatagram(
+                self.usock.pendingDatagramSize())
+            if self.audiolayout:
+                self.handleData(datagram)
+
+    @PyQtSlot()
+    def onConnected(self):
+        # the talk server waits for 'connect' before it sends anything
+        connect = dict(message='connect')
+        if self.channel_select:
+            connect['channel_select'] = self.channel_select
+        if int(self.rate or 0) > 0:
+            connect['rate'] = int(self.rate)
+        if self.usock is not None and self.mcast_group:
+            connect['audio'] = False # audio comes from the multicast group
+        elif self.usock is not None:
+            connect['udp_port'] = int(self.udp_port)
+        self.qsock.write(QByteArray(pack_msg('META', connect)))
+
+    @PyQtSlot()
+    def onReadyRead(self):
+        for msgtype, msg in self.parser.feed(self.qsock.readAll().data()):
+            if msgtype == 'META' and len(msg) > 0:
+                try:
+                    self.handleMeta(json.loads(msg.tobytes()))
+                except ValueError:
+                    logging.error('unable to decode json data from META msg')
+            elif msgtype == 'DATA' and self.audiolayout:
+                self.handleData(msg)
+
+    def handleMeta(self, msg):
+        # audio setup happens here, the GUI only displays META
+        if self.mcast_group and 'multicast' in msg:
+            self.selectMulticastStream(msg['multicast'])
+        elif 'format' in msg:
+            try:
+                self.configureAudio(msg['format'])
+            except Exception as e:
+                logging.warning('Unable to configure audio output: {}'.format(e))
+
+        if msg.get('message') != 'meter':
+            self.metaReceived.emit(msg)
+            return
+
+        # keep only the newest meter snapshot between GUI updates
+        self.pendingmeter = msg
+        wait = self.lastmeter + GUI_METER_INTERVAL - time.monotonic()
+        if wait <= 0:
+            self.flushMeter()
+        elif not self.meterTimer.isActive():
+            self.meterTimer.start(int(wait * 1000) + 1)
+
+    @PyQtSlot()
+    def flushMeter(self):
+        if self.pendingmeter is not None:
+            self.lastmeter = time.monotonic()
+            self.metaReceived.emit(self.pendingmeter)
+            self.pendingmeter = None
+
+    def selectMulticastStream(self, streams):
+        # prefer the advertised stream carrying exactly our channels
+        stream = streams[0]
+        for st in streams:
+            if st['format'].get('channels') == self.channel_select:
+                stream = st
+        self.udp_mask = sum(1 << (ch-1) for ch in stream['format']['channels'])
+        try:
+            self.configureAudio(stream['format'])
+        except Exception as e:
+            logging.warning('Unable to configure audio output: {}'.format(e))
+
+    def configureAudio(self, fmt):
+        # (re)start audio output when the advertised layout/format changes
+        layout = (tuple(fmt.get('channels', (1,))), str(fmt.get('mix')),
+            fmt.get('sampleformat'), fmt['samplerate'], fmt.get('codec'))
+        if layout == self.audiolayout:
+            return
+        self.audiolayout = layout
+        self.sampleformat = fmt.get('sampleformat', 'float32')
+        self.codec = fmt.get('codec', 'audio/pcm')
+        self.format_id = CODEC_FORMAT_IDS.get((self.sampleformat, self.codec))
+        self.next_seq = None
+        self.lastsamples = None
+        self.frame_channels = fmt.get('frame_channels', len(layout[0]))
+
+        self.audioout.stop()
+        self.iodevice.stop()
+
+        # a fresh jitter buffer drops audio of the previous layout
+        self.jitter = JitterBufferType(self.frame_channels, fmt['samplerate'],
+            target_ms=float(self.target_ms or 60))
+        self.drift = DriftCompensatorType(self.frame_channels, fmt['samplerate'])
+
+        # everything is decoded to float32, play that if the device can
+        self.audiofmt = QAudioFormat()
+        self.audiofmt.setSampleRate(fmt['samplerate'])
+        self.audiofmt.setChannelCount(self.frame_channels)
+        self.audiofmt.setSampleSize(32)
+        self.audiofmt.setCodec('audio/pcm')
+        self.audiofmt.setByteOrder(QAudioFormat.LittleEndian)
+        self.audiofmt.setSampleType(QAudioFormat.Float)
+        if not QAudioDeviceInfo.defaultOutputDevice().isFormatSupported(self.audiofmt):
+            self.audiofmt.setSampleSize(16)
+            self.audiofmt.setSampleType(QAudioFormat.SignedInt)
+            if not QAudioDeviceInfo.defaultOutputDevice().isFormatSupported(self.audiofmt):
+                logging.warning('audio format not supported by default output device')
+
+        self.audioout = QAudioOutput(self.audiofmt, self)
+        self.iodevice.start()
+        self.audioout.start(self.iodevice)
+
+    def handleData(self, msg):
+        try:
+            hdr, payload = parse_data(msg)
+        except Exception as e:
+            logging.warning('bad DATA message: {}'.format(e))
+            self.dropped += 1
+            return
+
+        # multicast groups carry several streams, keep only ours
+        if self.udp_mask is not None and hdr.channel_mask != self.udp_mask:
+            return
+
+        # frames still in flight from before a format or layout change,
+        # e.g. UDP DATA arriving ahead of the TCP META
+        silence = hdr.format_id == SILENCE_FORMAT_ID
+        if (self.jitter is None or hdr.frame_channels != self.frame_channels
+                or (hdr.format_id != self.format_id and not silence)):
+            self.dropped += 1
+            return
+
+        if self.next_seq is not None and hdr.sequence != self.next_seq:
+            gap = seq_delta(hdr.sequence, self.next_seq)
+            if gap < 0x80000000: # else a late/duplicate message
+                self.lost += gap
+                logging.debug('lost {} DATA messages'.format(gap))
+                self.concealGap(gap, hdr.frames)
+            else:
+                self.dropped += 1
+                return
+        self.next_seq = (hdr.sequence + 1) & 0xffffffff
+
+        if silence:
+            # the server gated a quiet stream, expand the marker locally
+            self.lastsamples = None
+            self.jitter.write_silence(int(round(hdr.frames * self.drift.ratio)))
+            return
+
+        # copy, payload may point in to the parser's buffer
+        try:
+            samples = np.array(decode_payload(payload, self.sampleformat, self.codec))
+            samples = samples.reshape(hdr.frames, self.frame_channels)
+        except Exception as e:
+            logging.warning('bad DATA payload: {}'.format(e))
+            self.dropped += 1
+            self.lastsamples = None
+            return
+        self.lastsamples = samples
+        self.writeSamples(self.lastsamples)
+
+    def writeSamples(self, samples):
+        # resample to cancel server/sound card clock drift, then buffer
+        self.jitter.write(self.drift.process(samples, self.jitter))
+
+    def concealGap(self, gap, frames):
+        # repeat a single lost message, fill longer gaps with silence, and
+        # give up (resync) on gaps too long to be worth filling
+        if gap > MAX_CONCEAL:
+            return
+        self.concealed += gap
+        if gap == 1 and self.lastsamples is not None:
+            self.writeSamples(self.lastsamples)
+        else:
+            self.jitter.write_silence(frames * gap)
+
+    @PyQtSlot()
+    def emitStatus(self):
+        if self.jitter is None:
+            return
+        st = self.jitter.stats()
+        st.update(drift_ppm=self.drift.ppm(), lost=self.lost,
+            dropped=self.dropped, concealed=self.concealed)
+        self.statusChanged.emit(st)
+# end StreamWorker
 
 class ChannelWidgetType:
     def __init__(self, button, rms, clips):
@@ -44,13 +341,22 @@ class ChannelWidgetType:
 
 class JackStreamListen(QMainWindow):
     checkInQueueSignal = PyQtSignal()
+    # queued in to the StreamWorker thread
+    openConnectionSignal = PyQtSignal(object)
+    closeConnectionSignal = PyQtSignal()
+    sendMetaSignal = PyQtSignal(object)
+    stopWorkerSignal = PyQtSignal()
     def __init__(self):
         super(JackStreamListen, self).__init__()
         self.ip = '127.0.0.1'
         self.port = '23'
         self.state = 'disconnected'
-        self.channel_select = -1
+        self.channel_select = [] # 1-based channels, interleaved in this order
         self.channel_count = -1
+        self.target_ms = '60' # initial jitter buffer target latency
+        self.udp_port = '0' # receive DATA over UDP on this port if not 0
+        self.mcast_group = '' # multicast group to join, '' for unicast
+        self.rate = '0' # output rate requested from the server, 0 is native
         # self.tsfmt = '%y%m%d-%H%M%S:'
         # self.textFgColor = 'rgb(0,0,0)'
         # self.textBgColor = 'rgb(255,255,255)'
@@ -61,17 +367,22 @@ class JackStreamListen(QMainWindow):
         # self.insFile = "";self.insDir=""
         # self.insSleepAmount = 0;
 
-        self.qsock = QtNetwork.QTcpSocket(self)
-        self.qsock.readyRead.connect(self.onReadyRead)
-        
+        # network, decoding and audio output run in their own thread
+        self.workerThread = QtCore.QThread(self)
+        self.worker = StreamWorker()
+        self.worker.moveToThread(self.workerThread)
+        self.workerThread.started.connect(self.worker.start)
+        self.openConnectionSignal.connect(self.worker.openConnection)
+        self.closeConnectionSignal.connect(self.worker.closeConnection)
+        self.sendMetaSignal.connect(self.worker.sendMeta)
+        self.stopWorkerSignal.connect(self.worker.stop)
+        self.worker.metaReceived.connect(self.updateMetadata)
+        self.worker.statusChanged.connect(self.updateStatus)
+        self.workerThread.start(QtCore.QThread.TimeCriticalPriority)
+
         # create None/empty variables to be created/updated later
-        self.prevpkt = bytearray() # note a QByteArray b/c reusing msgify_pkt
-        self.audiodata = bytearray()
         self.clips = []
         self.rms = []
-        self.audiofmt = QAudioFormat()
-        self.audioout = QAudioOutput()
-        self.iodevice = self.createIoDevice()
 
         #FIXME self.tcpSocket.error.connect(self.displayError)
 
@@ -122,9 +433,6 @@ class JackStreamListen(QMainWindow):
         self.setWindowTitle('jack_stream_listen v'+JACK_STREAM_VERSION)    
         self.show()
 
-    def createIoDevice(self):
-        pass
-
     def invokeConnectDialog(self):
         if( self.state == 'disconnected' ):
             connectDialog = ConnectDialog(self)
@@ -133,10 +441,12 @@ class JackStreamListen(QMainWindow):
     def invokeOptionsDialog(self):
         optionsDialog = OptionsDialog(self)
         optionsDialog.show()
-
-    def sockHandleConnect(self,ip,port):
+    def sockHandleConnect(self,ip,port,udp_port='0',mcast_group=''):
         self.ip=ip ; self.port=port
-        self.qsock.connectToHost(ip,int(port))
+        self.udp_port=udp_port ; self.mcast_group=mcast_group
+        self.openConnectionSignal.emit(dict(ip=ip, port=port, udp_port=udp_port,
+            mcast_group=mcast_group, target_ms=self.target_ms, rate=self.rate,
+            channel_select=list(self.channel_select)))
         self.state = 'connected'
         logging.debug('state = '+self.state+': '+self.ip+':'+self.port)
 
@@ -147,7 +457,7 @@ class JackStreamListen(QMainWindow):
 
     def disconnect(self):
         if( self.state == 'connected' ):
-            self.qsock.disconnectFromHost()
+            self.closeConnectionSignal.emit()
             self.state = 'disconnected'
             logging.debug('state = '+self.state+'\n')
 
@@ -158,19 +468,24 @@ class JackStreamListen(QMainWindow):
 
             self.channel_count = -1
             # self.channel_select = -1
-
-
     @PyQtSlot(int)
     def sendMetaToServer(self, cidx):
-        metastr = json.dumps(dict(channel_select=cidx))
+        # every checked button is part of the requested (interleaved) layout
+        self.channel_select = [idx+1 for idx,cw in enumerate(self.channelsWidgets)
+            if cw.button.isChecked()]
+        if not self.channel_select:
+            return
         if( self.state == 'connected' ):
-            print('cidx = {}'.format(cidx))
-            dbg = self.qsock.write(QByteArray(bytearray(metastr.encode())))
+            print('channel_select = {}'.format(self.channel_select))
+            self.sendMetaSignal.emit(dict(message='channel_select',
+                channel_select=self.channel_select))
 
     def exitApplication(self):
         if( self.state == 'connected' ):
-            self.qsock.disconnectFromHost()
             self.state = 'disconnected'
+        if self.workerThread.isRunning():
+            self.stopWorkerSignal.emit()
+            self.workerThread.wait(2000)
         self.saveSettings()
         self.close()
 
@@ -179,7 +494,12 @@ class JackStreamListen(QMainWindow):
         cfgParser.add_section('Generic')
         cfgParser.set('Generic', 'ip', self.ip)
         cfgParser.set('Generic', 'port', self.port)
-        cfgParser.set('Generic', 'channel_select', self.channel_select)
+        cfgParser.set('Generic', 'udp_port', self.udp_port)
+        cfgParser.set('Generic', 'mcast_group', self.mcast_group)
+        cfgParser.set('Generic', 'target_ms', self.target_ms)
+        cfgParser.set('Generic', 'rate', self.rate)
+        cfgParser.set('Generic', 'channel_select',
+            ','.join(map(str, self.channel_select)))
         
         with open(join(expanduser('~'), 'jack_stream_listen.cfg'), 'w') as cfgfile:
             cfgParser.write(cfgfile)
@@ -190,15 +510,26 @@ class JackStreamListen(QMainWindow):
         if( cfgParser.has_section('Generic') ):
             self.ip = cfgParser.get('Generic','ip')
             self.port = cfgParser.get('Generic','port')
-
-    @PyQtSlot()
-    def onReadyRead(self):
-        # tstr = time.strftime(self.tsfmt)
-        curpkt = bytearray(self.qsock.readAll())
-        msgtype, msg = msgify_pkt(self.prevpkt, curpkt)
-
-        if msgtype == 'META' and len(msg) > 0:
-            self.updateMetadata(msg)
+            if cfgParser.has_option('Generic', 'target_ms'):
+                self.target_ms = cfgParser.get('Generic', 'target_ms')
+            if cfgParser.has_option('Generic', 'rate'):
+                self.rate = cfgParser.get('Generic', 'rate')
+            if cfgParser.has_option('Generic', 'udp_port'):
+                self.udp_port = cfgParser.get('Generic', 'udp_port')
+            if cfgParser.has_option('Generic', 'mcast_group'):
+                self.mcast_group = cfgParser.get('Generic', 'mcast_group')
+            if cfgParser.has_option('Generic', 'channel_select'):
+                chsel = cfgParser.get('Generic', 'channel_select')
+                self.channel_select = [int(ch) for ch in chsel.split(',') if ch]
+
+    @PyQtSlot(object)
+    def updateStatus(self, st):
+        if self.state != 'connected':
+            return
+        self.statusLabel.setText(('STATUS: Connected | buffer {:.0f}/{:.0f} ms, '
+            'jitter {:.1f} ms, drift {:+.0f} ppm, underruns {}, lost {}').format(
+            st['depth_ms'], st['target_ms'], st['jitter_ms'], st['drift_ppm'],
+            st['underruns'], st['lost']))
 
     def createChannelsWidgets(self):
         self.channelsContainer = QWidget()
@@ -207,28 +538,33 @@ class JackStreamListen(QMainWindow):
 
         self.channelsWidgets = [
             ChannelWidgetType(
-                QPushButton(str(idx), self),
+                QPushButton(str(idx+1), self),
                 QLabel(self),
                 QLabel(self)
             )
             for idx in range(self.channel_count)
         ]
 
+        # several channels may be selected, e.g. a stereo pair
         self.channelsButtonGroup = QButtonGroup(self)
+        self.channelsButtonGroup.setExclusive(False)
         for cidx,cw in enumerate(self.channelsWidgets):
+            cw.button.setCheckable(True)
+            cw.button.setChecked(cidx+1 in self.channel_select)
             self.channelsButtonGroup.addButton(cw.button, cidx)
             self.channelsLayout.addWidget(cw.button, 0, cidx)
             self.channelsLayout.addWidget(cw.rms,    1, cidx)
             self.channelsLayout.addWidget(cw.clips,  2, cidx)
 
-            self.channelsButtonGroup.buttonClicked[int].connect(self.sendMetaToServer)
+        self.channelsButtonGroup.buttonClicked[int].connect(self.sendMetaToServer)
 
 
         self.setCentralWidget(self.channelsContainer)
     # end createChannelsWidgets
 
+    @PyQtSlot(object)
     def updateMetadata(self, msg):
-        if self.channel_count < 0:
+        if self.channel_count < 0 and 'format' in msg:
             try:
                 self.channel_count = msg['format']['channel_count']
                 self.createChannelsWidgets()
@@ -261,35 +597,39 @@ class JackStreamListen(QMainWindow):
 #END Qnet class
 
 class BufferQueueIO(QIODevice):
-    def __init__(self, bufQ, parent):
+    # pull-mode source for QAudioOutput, reads from parent.jitter; lives in
+    # the StreamWorker thread like the jitter buffer it drains
+    def __init__(self, parent):
         super(BufferQueueIO, self).__init__(parent)
-        self.buffer = QByteArray()
-        self.bufQ = bufQ
+        self.parent = parent
 
     def start(self):
         self.open(QIODevice.ReadOnly)
 
     def stop(self):
-        self.m_pos = 0
         self.close()
 
     def readData(self, maxlen):
-        if self.bufQ.qsize() >= 2:
-            self.buffer.append(self.bufQ.get())
+        jitter = self.parent.jitter
+        if jitter is None:
+            return bytes(0)
 
-        if self.buffer.length() < maxlen:
-             # FIXME, return correct length QByteArray of zeros
-            return QByteArray(bytearray((0,)*10)).data()
-        else:
-            outp = self.buffer.mid(0, maxlen).data()
-            self.buffer.remove(0, maxlen)
-            return outp
+        fmt = self.parent.audiofmt
+        bpf = fmt.channelCount() * fmt.sampleSize() // 8
+        frames = maxlen // bpf
+        samples = jitter.read(frames)
+
+        # always exactly the requested number of frames, silence on underrun
+        if fmt.sampleType() == QAudioFormat.Float:
+            return samples.astype('<f4').tobytes()
+        return (np.clip(samples, -1.0, 1.0 - 2**-15) * 2**15).astype('<i2').tobytes()
 
     def writeData(self, data):
         return 0
 
     def bytesAvailable(self):
-        return self.m_buffer.size() + super(BufferQueueIO, self).bytesAvailable()
+        # the jitter buffer always produces audio (or silence)
+        return (1 << 16) + super(BufferQueueIO, self).bytesAvailable()
 
 class ConnectDialog(QDialog):
     def __init__(self, parent):
@@ -298,12 +638,20 @@ class ConnectDialog(QDialog):
         # Create widgets
         self.ip = QLineEdit(parent.ip)
         self.port = QLineEdit(parent.port)
+        self.udp_port = QLineEdit(parent.udp_port)
+        self.mcast_group = QLineEdit(parent.mcast_group)
         self.button = QPushButton("Connect")
         self.button.clicked.connect(self.tcpConnect)
         # Create layout and add widgets
         self.layout = QFormLayout()
         self.layout.addRow("Host",self.ip)
         self.layout.addRow("Port",self.port)
+        self.layout.addRow("UDP Port (0 is off)",self.udp_port)
+        self.layout.addRow("Multicast Group",self.mcast_group)
+        self.target_ms = QLineEdit(parent.target_ms)
+        self.layout.addRow("Buffer Target (ms)",self.target_ms)
+        self.rate = QLineEdit(parent.rate)
+        self.layout.addRow("Sample Rate (0 is native)",self.rate)
         self.layout.addRow(self.button)
         # Set dialog layout
         self.setLayout(self.layout)
@@ -311,7 +659,10 @@ class ConnectDialog(QDialog):
 
     # connects socket
     def tcpConnect(self):
-        self.parent.sockHandleConnect( self.ip.text() , self.port.text() )
+        self.parent.target_ms = self.target_ms.text()
+        self.parent.rate = self.rate.text()
+        self.parent.sockHandleConnect( self.ip.text() , self.port.text(),
+            self.udp_port.text() , self.mcast_group.text() )
         self.accept()
 #END class ConnectDialog(QtGui.QDialog)
 
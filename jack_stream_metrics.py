@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+'''
+Runtime metrics for jack_stream_talk.py: counters and histograms cheap
+enough for the per-period path, exported in the Prometheus text format
+over a small HTTP endpoint on the server's event loop, and as a periodic
+structured (json) log line.
+
+Every metric has a single writer (the event loop, or one JACK thread), so
+recording is a plain integer/float update with no locks; values other code
+already counts are read by collectors only when a scrape or log line asks.
+'''
+
+# standard imports
+import json
+import math
+import bisect
+import asyncio
+import logging
+
+# seconds, from 10 us to 1 s
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3,
+    5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0)
+
+# periods waiting in a ring or queue
+DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\'
+        ).replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in sorted(labels.items())) + '}'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class CounterType:
+    '''a monotonic count, inc() from one thread only'''
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name  = name
+        self.help  = help
+        self.value = 0
+
+    def inc(self, count=1):
+        self.value += count
+
+    def samples(self):
+        yield self.name, None, self.value
+
+    def snapshot(self):
+        return self.value
+
+
+class HistogramType:
+    '''
+    Distribution of observed values over fixed buckets, observe() from one
+    thread only. Counts are kept per bucket and only made cumulative when
+    rendered.
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name    = name
+        self.help    = help
+        self.bounds  = tuple(sorted(buckets))
+        self.counts  = [0] * (len(self.bounds) + 1) # the last one is +Inf
+        self.sum     = 0.0
+        self.count   = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        '''upper bound of the bucket holding quantile q, None if empty'''
+        counts, total = list(self.counts), sum(self.counts)
+        if total == 0:
+            return None
+        rank, seen = q * total, 0
+        for bound, count in zip(self.bounds + (math.inf,), counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return math.inf
+
+    def samples(self):
+        counts, seen = list(self.counts), 0
+        for bound, count in zip(self.bounds + (math.inf,), counts):
+            seen += count
+            yield self.name + '_bucket', dict(le=format_value(bound)), seen
+        yield self.name + '_sum', None, self.sum
+        yield self.name + '_count', None, seen
+
+    def snapshot(self):
+        p50, p99 = self.quantile(0.5), self.quantile(0.99)
+        return dict(count=self.count, sum=round(self.sum, 6),
+            p50=p50 if p50 != math.inf else None,
+            p99=p99 if p99 != math.inf else None)
+# end HistogramType
+
+
+class MetricsRegistryType:
+    '''
+    The metrics of one process. Collectors are functions returning
+    (name, kind, help, [(labels, value), ...]) tuples for values that are
+    counted elsewhere; they run only at scrape / log time.
+    '''
+    def __init__(self, prefix='jack_stream_'):
+        self.prefix     = prefix
+        self.metrics    = []
+        self.collectors = []
+        self.labels     = dict() # added to every sample, e.g. the worker
+        self.fold_labels = ('client',) # summed in to one value in snapshot()
+
+    def counter(self, name, help):
+        metric = CounterType(self.prefix + name, help)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        metric = HistogramType(self.prefix + name, help, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, func):
+        self.collectors.append(func)
+
+    def remove_collector(self, func):
+        if func in self.collectors:
+            self.collectors.remove(func)
+
+    def collect(self):
+        '''(name, kind, help, [(name, labels, value), ...]) of every metric'''
+        for metric in self.metrics:
+            yield metric.name, metric.kind, metric.help, list(metric.samples())
+        for func in tuple(self.collectors):
+            for name, kind, help, samples in func():
+                yield self.prefix + name, kind, help, [(self.prefix + name,
+                    labels, value) for labels, value in samples]
+
+    def render(self):
+        '''all metrics in the Prometheus text exposition format'''
+        lines = []
+        for name, kind, help, samples in self.collect():
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for sname, labels, value in samples:
+                labels = dict(self.labels, **(labels or {}))
+                lines.append('{}{} {}'.format(sname, format_labels(labels),
+                    format_value(value)))
+        lines.append('')
+        return '\n'.join(lines)
+
+    def snapshot(self):
+        '''
+        a compact dict for the log line; samples labelled with one of
+        self.fold_labels (e.g. per client) are summed, or for gauges the
+        maximum is taken, other labelled samples are keyed by label value
+        '''
+        snap = dict(self.labels)
+        for metric in self.metrics:
+            snap[metric.name[len(self.prefix):]] = metric.snapshot()
+        for func in tuple(self.collectors):
+            for name, kind, help, samples in func():
+                if len(samples) == 1 and not samples[0][0]:
+                    snap[name] = samples[0][1]
+                elif not samples or any(label in (samples[0][0] or ())
+                        for label in self.fold_labels):
+                    values = [value for labels, value in samples]
+                    snap[name] = (max(values, default=0) if kind == 'gauge'
+                        else sum(values))
+                else:
+                    snap[name] = dict((','.join(str(value) for value in
+                        labels.values()), value) for labels, value in samples)
+        return snap
+# end MetricsRegistryType
+
+
+async def handle_metrics_http_coro(registry, reader, writer):
+    # just enough HTTP/1.x for a Prometheus scrape or curl
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5.0)
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 5.0)
+            if line in (b'\r\n', b'\n', b''):
+                break
+        parts = request.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] in ('GET', 'HEAD') and \
+                parts[1].split('?')[0] in ('/', '/metrics'):
+            status, ctype = '200 OK', PROMETHEUS_CONTENT_TYPE
+            body = registry.render().encode('utf-8')
+        else:
+            status, ctype, body = '404 Not Found', 'text/plain', b'not found\n'
+        writer.write('HTTP/1.1 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n'
+            'Connection: close\r\n\r\n'.format(status, ctype, len(body)
+            ).encode('latin-1'))
+        if parts and parts[0] != 'HEAD':
+            writer.write(body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError, UnicodeDecodeError) as e:
+        logging.debug('metrics request failed: {}'.format(e))
+    finally:
+        writer.close()
+
+
+async def serve_metrics_coro(registry, host, port):
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_metrics_http_coro(registry, reader, writer),
+        host, port)
+    logging.info('metrics on http://{}:{}/metrics'.format(host, port))
+    return server
+
+
+async def log_metrics_coro(registry, interval):
+    # one json line per interval, for log pipelines without a scraper
+    while True:
+        await asyncio.sleep(interval)
+        logging.info('metrics {}'.format(json.dumps(registry.snapshot(),
+            sort_keys=True)))
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+'''
+Recorder for jack_stream_talk.py: archives every inport to float32
+WAV/RF64 files through preallocated, memory-mapped files on a dedicated
+writer thread.
+'''
+
+# standard imports
+import os
+import mmap
+import time
+import struct
+import logging
+import threading
+
+import numpy as np
+
+# RIFF/WAVE header, a 28 byte JUNK chunk is reserved up front so it can be
+# turned in to the RF64 ds64 chunk once a file outgrows 4 GiB
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAV_RIFF = struct.Struct('<4sI4s')
+WAV_CHUNK = struct.Struct('<4sI')
+WAV_DS64 = struct.Struct('<QQQI')
+WAV_FMT = struct.Struct('<HHIIHH')
+WAV_FACT = struct.Struct('<I')
+WAV_HEADER_SIZE = (WAV_RIFF.size + WAV_CHUNK.size + WAV_DS64.size +
+    WAV_CHUNK.size + WAV_FMT.size + WAV_CHUNK.size + WAV_FACT.size +
+    WAV_CHUNK.size)
+
+
+def wav_header(channels, samplerate, frames):
+    '''header of a float32 WAV file holding frames frames, RF64 if needed'''
+    data_size = frames * channels * 4
+    riff_size = WAV_HEADER_SIZE - 8 + data_size
+    rf64 = riff_size > 0xffffffff
+    parts = [WAV_RIFF.pack(b'RF64' if rf64 else b'RIFF',
+        0xffffffff if rf64 else riff_size, b'WAVE')]
+    if rf64:
+        parts.append(WAV_CHUNK.pack(b'ds64', WAV_DS64.size))
+        parts.append(WAV_DS64.pack(riff_size, data_size, frames, 0))
+    else:
+        parts.append(WAV_CHUNK.pack(b'JUNK', WAV_DS64.size))
+        parts.append(bytes(WAV_DS64.size))
+    parts.append(WAV_CHUNK.pack(b'fmt ', WAV_FMT.size))
+    parts.append(WAV_FMT.pack(WAVE_FORMAT_IEEE_FLOAT, channels, samplerate,
+        samplerate * channels * 4, channels * 4, 32))
+    parts.append(WAV_CHUNK.pack(b'fact', WAV_FACT.size))
+    parts.append(WAV_FACT.pack(min(frames, 0xffffffff)))
+    parts.append(WAV_CHUNK.pack(b'data', 0xffffffff if rf64 else data_size))
+    return b''.join(parts)
+
+
+class MmapWavType:
+    '''
+    A float32 WAV/RF64 file of at most max_frames frames, written through
+    a memory map that grows chunk_frames at a time, so only a few seconds
+    are ever reserved ahead of the audio. The header is rewritten after
+    every write, a file left behind by a crash holds what it claims to.
+    '''
+    def __init__(self, path, channels, samplerate, max_frames, chunk_frames=None):
+        self.path       = path
+        self.channels   = channels
+        self.samplerate = samplerate
+        self.max_frames = max_frames
+        self.chunk_frames = min(max_frames, chunk_frames or 4 * samplerate)
+        self.frame_bytes = channels * 4
+        self.frames     = 0 # frames written so far
+
+        self.mm          = None
+        self.data        = None # (frames x channels) view of the mapped chunk
+        self.chunk_start = 0 # file frame of self.data[0]
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            self.write_header()
+        except Exception:
+            os.close(self.fd)
+            raise
+
+    def write_header(self):
+        os.pwrite(self.fd, wav_header(self.channels, self.samplerate,
+            self.frames), 0)
+
+    def frames_left(self):
+        return self.max_frames - self.frames
+
+    def map_chunk(self):
+        '''unmap the full chunk, reserve and map the next one'''
+        self.unmap_chunk()
+        count = min(self.chunk_frames, self.frames_left())
+        start = WAV_HEADER_SIZE + self.frames * self.frame_bytes
+        size = count * self.frame_bytes
+
+        # reserve the blocks now, a full disk later would be a SIGBUS
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(self.fd, start, size)
+        else:
+            os.ftruncate(self.fd, start + size)
+        offset = start - start % mmap.ALLOCATIONGRANULARITY
+        self.mm = mmap.mmap(self.fd, start + size - offset, offset=offset)
+        self.data = np.frombuffer(self.mm, np.dtype('<f4'),
+            count=count * self.channels, offset=start - offset
+            ).reshape(count, self.channels)
+        self.chunk_start = self.frames
+
+    def unmap_chunk(self):
+        if self.mm is not None:
+            self.data = None
+            self.mm.close()
+            self.mm = None
+
+    def write(self, samples):
+        '''copy (frames x channels) samples in, returns the frames written'''
+        count = min(len(samples), self.frames_left())
+        done = 0
+        while done < count:
+            if self.data is None or self.frames - self.chunk_start == len(self.data):
+                self.map_chunk()
+            pos = self.frames - self.chunk_start
+            n = min(count - done, len(self.data) - pos)
+            self.data[pos:pos+n] = samples[done:done+n]
+            self.frames += n
+            done += n
+        self.write_header()
+        return count
+
+    def close(self):
+        if self.fd is None:
+            return
+        try:
+            self.unmap_chunk()
+            self.write_header()
+            os.ftruncate(self.fd, WAV_HEADER_SIZE + self.frames * self.frame_bytes)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+# end MmapWavType
+
+
+class RecorderType:
+    '''
+    Archives every period handed to put() without ever blocking the caller.
+
+    put() copies the period in to a preallocated slot ring (single producer,
+    single consumer, no locks) and wakes the writer thread, which moves the
+    audio in to memory-mapped WAV files and rotates them by size and time;
+    files grow chunk_s seconds at a time. Periods that find the ring full
+    are dropped and counted. After a file error (e.g. a full disk) the
+    writer waits retry_s seconds before opening a new file, the periods
+    in between are counted as lost.
+    '''
+    def __init__(self, channels, frames, samplerate, directory,
+            rotate_bytes=2**31, rotate_s=3600.0, periods=256, prefix='jack_stream',
+            chunk_s=4.0, retry_s=5.0):
+        self.channels   = channels
+        self.frames     = frames
+        self.samplerate = samplerate
+        self.directory  = directory
+        self.prefix     = prefix
+        self.file_frames = max(frames, min(int(rotate_bytes // (channels * 4)),
+            int(rotate_s * samplerate)))
+        self.chunk_frames = max(frames, int(chunk_s * samplerate))
+        self.retry_s    = retry_s
+        self.retry_at   = None # monotonic time of the next try after an error
+        self.retry_lost = 0 # periods lost while waiting to retry
+
+        self.periods = periods
+        self.bufs    = np.zeros((periods, channels, frames), np.dtype('float32'))
+        self.windex  = 0 # total periods put, producer-owned
+        self.rindex  = 0 # total periods written, writer-owned
+        self.wake    = threading.Event()
+        self.closed  = False
+
+        # counters
+        self.dropped = 0 # periods that found the ring full, producer-owned
+        self.lost    = 0 # periods lost to write errors, writer-owned
+        self.written = 0 # periods written to files
+        self.files   = 0 # files opened
+        self.errors  = 0 # failed file opens/writes
+
+        self.wav = None
+        os.makedirs(directory, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, name='recorder')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, jackbufs):
+        '''called from the websocket loop with a (channels x frames) period'''
+        if (jackbufs.shape != self.bufs.shape[1:] or
+                self.windex - self.rindex >= self.periods):
+            self.dropped += 1
+            return False
+        self.bufs[self.windex % self.periods] = jackbufs
+        self.windex += 1
+        self.wake.set()
+        return True
+
+    def close(self):
+        '''drain what was put so far, finish the current file'''
+        self.closed = True
+        self.wake.set()
+        self.thread.join()
+
+    def run(self):
+        while True:
+            self.wake.wait(0.5)
+            self.wake.clear()
+            # re-checked after clear(), a put() in between is not lost
+            while self.rindex < self.windex:
+                self.write_period(self.bufs[self.rindex % self.periods])
+                self.rindex += 1
+            if self.closed:
+                break
+        self.close_file()
+
+    def write_period(self, jackbufs):
+        # back off after an error instead of a new file and log line per period
+        if self.retry_at is not None:
+            if time.monotonic() < self.retry_at:
+                self.lost += 1
+                self.retry_lost += 1
+                return
+            logging.warning('recorder retrying, {} periods lost meanwhile'.format(
+                self.retry_lost))
+            self.retry_at, self.retry_lost = None, 0
+
+        samples = jackbufs.T # interleaved in to the map, the one copy
+        try:
+            while len(samples):
+                if self.wav is None or self.wav.frames_left() == 0:
+                    self.open_file()
+                samples = samples[self.wav.write(samples):]
+            self.written += 1
+        except (OSError, ValueError) as e:
+            self.errors += 1
+            self.lost += 1
+            logging.error('recorder write failed, retrying in {} s: {}'.format(
+                self.retry_s, e))
+            self.close_file(remove_empty=True)
+            self.retry_at = time.monotonic() + self.retry_s
+
+    def open_file(self):
+        self.close_file()
+        name = '{}_{}_{:04d}.wav'.format(self.prefix,
+            time.strftime('%Y%m%d-%H%M%S'), self.files)
+        path = os.path.join(self.directory, name)
+        self.wav = MmapWavType(path, self.channels, self.samplerate,
+            self.file_frames, self.chunk_frames)
+        self.files += 1
+        logging.info('recording to {}'.format(path))
+
+    def close_file(self, remove_empty=False):
+        if self.wav is not None:
+            wav, self.wav = self.wav, None
+            try:
+                wav.close()
+                if remove_empty and wav.frames == 0:
+                    os.unlink(wav.path)
+            except OSError as e:
+                self.errors += 1
+                logging.error('recorder close failed: {}'.format(e))
+
+    def stats(self):
+        wav = self.wav # may be swapped by the writer thread meanwhile
+        return dict(written=self.written, dropped=self.dropped, lost=self.lost,
+            pending=self.windex - self.rindex, files=self.files,
+            errors=self.errors, file=wav.path if wav is not None else None)
+# end RecorderType
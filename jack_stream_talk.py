@@ -2,15 +2,18 @@
 
 """
 Create a JACK client that serves audio to jack_stream_listen.
+
+Importing this module has no side effects; main() parses the arguments,
+creates the audio source (JACK, or a synthetic one for tests and
+benchmarks) and runs the server.
 """
 
 # standard imports
-# import os
+import os
 import sys
 import json
 import time
 import uuid
-import janus
 import queue
 import signal
 import struct
@@ -18,16 +21,30 @@ import socket
 import asyncio
 import logging
 import argparse
+import functools
 import threading
+import concurrent.futures
 import websockets
-# import collections
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
 
 import numpy as np
 
 import queue # non-standard import???
-import jack
-
-from jack_stream_common import get_ip, JACK_STREAM_VERSION
+try:
+    import jack
+except (ImportError, OSError): # the package, or libjack itself, is missing
+    jack = None
+
+from jack_stream_common import get_ip, JACK_STREAM_VERSION, \
+    SAMPLE_FORMATS, DEFAULT_SAMPLE_FORMAT, format_dict, encode_samples, \
+    pack_data_header, pack_silence, DATA_HEADER, MsgParserType, MSG_PREFIX, \
+    PCM_CODEC, LOSSLESS_CODEC, CODECS, LOSSLESS_FORMATS, quantize_samples, \
+    encode_lossless, MASK_CHANNELS
+from jack_stream_record import RecorderType
+from jack_stream_metrics import MetricsRegistryType, DEPTH_BUCKETS, \
+    serve_metrics_coro, log_metrics_coro
 
 if sys.version_info < (3, 0):
     # In Python 2.x, event.wait() cannot be interrupted with Ctrl+C.
@@ -40,6 +57,14 @@ else:
     pass
 
 
+# what to do with a client's outbound queue when it is full
+DROP_POLICIES = ('drop_oldest', 'drop_newest', 'disconnect')
+
+# audio sources, and what the synthetic one can generate
+SOURCES = ('jack', 'synthetic')
+SIGNALS = ('tone', 'noise', 'silence')
+
+
  # create arg parser
 parser = argparse.ArgumentParser(description='Process args for jack_stream_talk.py')
 
@@ -52,35 +77,588 @@ parser.add_argument('-n', '--name', type=str, default='jack_stream_talk', \
 parser.add_argument('-p', '--port', type=int, default=4242, \
         help = "port to listen on")
 
-parser.add_argument('--loglevel', default='info', \
-        choices=['debug', 'info', 'warning', 'error'])
+parser.add_argument('--ring-periods', type=int, default=32, \
+        help = "number of JACK periods buffered between JACK and the network")
+
+parser.add_argument('--send-queue', type=int, default=64, \
+        help = "max number of outbound messages queued per client")
+
+parser.add_argument('--drop-policy', default='drop_oldest', \
+        choices=DROP_POLICIES, \
+        help = "what to do when a client's send queue is full")
+
+parser.add_argument('--batch', type=int, default=1, \
+        help = "default number of JACK periods coalesced per DATA message")
+
+parser.add_argument('--max-batch-ms', type=float, default=250.0, \
+        help = "largest batch (in ms) a client may request")
+
+parser.add_argument('--history-s', type=float, default=10.0, \
+        help = "seconds of recent audio kept for pre-roll and rewind, 0 is off")
+
+parser.add_argument('--preroll-ms', type=float, default=250.0, \
+        help = "default audio burst (ms of history) a stream starts with")
+
+parser.add_argument('--dtx-threshold', type=float, default=None, \
+        help = "send silence markers instead of periods whose inports are all "
+               "below this level (dBFS), off by default")
+
+parser.add_argument('--dtx-hangover-ms', type=float, default=300.0, \
+        help = "keep sending audio this long after a stream falls silent")
+
+parser.add_argument('--meter', action='store_true', \
+        help = "enable the metering stream (peak, true-peak, loudness, bands)")
+
+parser.add_argument('--meter-fft', type=int, default=4096, \
+        help = "FFT size in frames for meter band energies")
+
+parser.add_argument('--meter-bands', type=int, default=24, \
+        help = "number of log-spaced meter bands")
+
+parser.add_argument('--max-meter-rate', type=float, default=30.0, \
+        help = "highest meter rate (Hz) a client may request")
+
+parser.add_argument('--tcp-port', type=int, default=0, \
+        help = "also serve the framed META/DATA protocol on this plain TCP "
+            "port (0 is off)")
+
+parser.add_argument('--tcp-host', type=str, default='0.0.0.0', \
+        help = "address the plain TCP listener binds to")
+
+parser.add_argument('--tcp-sndbuf', type=int, default=0, \
+        help = "SO_SNDBUF for plain TCP clients in bytes (0 is the OS default)")
+
+parser.add_argument('--multicast', type=str, default='', \
+        help = "GROUP:PORT to send --multicast-channels to as UDP datagrams")
+
+parser.add_argument('--multicast-channels', type=str, default='1', \
+        help = "';' separated multicast streams, each a ',' separated list "
+            "of 1-based channels, e.g. '1,2;3'")
+
+parser.add_argument('--multicast-format', default=DEFAULT_SAMPLE_FORMAT, \
+        choices=sorted(SAMPLE_FORMATS), \
+        help = "sample format of the multicast streams")
+
+parser.add_argument('--multicast-ttl', type=int, default=1, \
+        help = "IP_MULTICAST_TTL of multicast datagrams")
+
+parser.add_argument('--record-dir', default=None, \
+        help = "record every inport to float32 WAV/RF64 files in this directory")
+
+parser.add_argument('--record-rotate-mb', type=float, default=2048.0, \
+        help = "start a new recording file after this many MB")
+
+parser.add_argument('--record-rotate-s', type=float, default=3600.0, \
+        help = "start a new recording file after this many seconds")
+
+parser.add_argument('--record-queue', type=int, default=256, \
+        help = "periods buffered for the recorder's writer thread")
+
+parser.add_argument('--record-retry-s', type=float, default=5.0, \
+        help = "seconds the recorder waits after a file error before retrying")
 
-# parse args
-args = parser.parse_args()
+parser.add_argument('--workers', type=int, default=0, \
+        help = "number of fan-out worker processes sharing the port (0 is "
+            "a single in-process websocket loop)")
 
-# init things and set settings according to args
-logging.root.setLevel(args.loglevel.upper())
-clientname = args.name
-servername = None
-channels = args.channels
-port = args.port
-jack_client = jack.Client(clientname, servername=servername)
+parser.add_argument('--metrics-port', type=int, default=0, \
+        help = "serve Prometheus metrics over HTTP on this port, 0 is off; "
+            "fan-out worker n serves on port + n")
 
-# check jack server status and possible jack_client renaming
-if jack_client.status.server_started:
-    logging.info('JACK server started')
-if jack_client.status.name_not_unique:
-    logging.warning('unique name {0!r} assigned'.format(jack_client.name))
+parser.add_argument('--metrics-host', type=str, default='127.0.0.1', \
+        help = "address the metrics endpoint binds to")
+
+parser.add_argument('--metrics-log-s', type=float, default=60.0, \
+        help = "seconds between structured metrics log lines, 0 is off")
+
+parser.add_argument('--source', default='jack', choices=SOURCES, \
+        help = "where the audio comes from, synthetic needs no JACK server")
+
+parser.add_argument('--signal', default='tone', choices=SIGNALS, \
+        help = "what the synthetic source generates")
+
+parser.add_argument('--synth-rate', type=int, default=48000, \
+        help = "sample rate of the synthetic source")
+
+parser.add_argument('--synth-period', type=int, default=256, \
+        help = "frames per period of the synthetic source")
+
+parser.add_argument('--tone-hz', type=float, default=440.0, \
+        help = "synthetic tone of channel 1, each further channel a semitone up")
+
+parser.add_argument('--level-db', type=float, default=-20.0, \
+        help = "synthetic tone peak / noise rms level in dBFS")
+
+parser.add_argument('--loglevel', default='info', \
+        choices=['debug', 'info', 'warning', 'error'])
+
+# set by configure() from the args and the audio source, read by
+# everything below
+args = None
+channels = None
+port = None
+samplerate = None
+blocksize = None
 
 # this is to support python2 - should we even bother?
 event = threading.Event()
 
 
-# helper functions for channel buffer stats
-def calcrms(x):
-    return np.sqrt(np.mean(x**2))
-def countclips(x):
-    return np.sum(abs(x) > 1.0)
+class JackSourceType:
+    '''
+    Audio from the inports of a JACK client; the only code that talks to
+    libjack, so the rest of the server runs on any source.
+    '''
+    def __init__(self, name, channels, servername=None):
+        if jack is None:
+            raise RuntimeError('JACK is not available, try --source synthetic')
+        self.client = jack.Client(name, servername=servername)
+
+        # check jack server status and possible jack_client renaming
+        if self.client.status.server_started:
+            logging.info('JACK server started')
+        if self.client.status.name_not_unique:
+            logging.warning('unique name {0!r} assigned'.format(self.client.name))
+
+        # cached so fan-out code (possibly in worker processes) never calls libjack
+        self.channels   = channels
+        self.samplerate = self.client.samplerate
+        self.blocksize  = self.client.blocksize
+        self.current_blocksize = self.blocksize # follows JACK buffer size changes
+
+        # create input ports
+        for chidx in range(channels):
+            self.client.inports.register('input_{:02d}'.format(chidx))
+
+    def start(self, ring, on_shutdown):
+        client = self.client
+
+        @client.set_process_callback
+        def jack_process(frames):
+            # copy channel buffers in to the next free ring slot, nothing else
+            ring.write_ports(client.inports, frames, client.last_frame_time)
+        # end jack_process
+
+        @client.set_xrun_callback
+        def jack_xrun(delay):
+            ring.xrun()
+
+        @client.set_blocksize_callback
+        def jack_blocksize(frames):
+            # the ring, stats and encoders are all sized for one period
+            # length, periods of any other length are dropped
+            if frames != ring.frames:
+                logging.error('JACK buffer size changed from {} to {} frames, '
+                    'audio is dropped until it is changed back or the server '
+                    'is restarted'.format(ring.frames, frames))
+            elif frames != self.current_blocksize:
+                logging.info('JACK buffer size is {} frames again'.format(frames))
+            self.current_blocksize = frames
+
+        @client.set_shutdown_callback
+        def jack_shutdown(status, reason):
+            print('JACK shutdown!')
+            print('    status:', status)
+            print('    reason:', reason)
+            on_shutdown()
+
+        client.activate()
+
+    def stop(self):
+        try:
+            self.client.deactivate()
+        except jack.JackError as e: # e.g. after the server shut down
+            logging.debug('JACK deactivate failed: {}'.format(e))
+        self.client.close()
+# end JackSourceType
+
+
+class SyntheticPortType:
+    '''stands in for a JACK inport, get_buffer() returns the period bytes'''
+    def __init__(self, buf):
+        self.view = memoryview(buf).cast('B')
+
+    def get_buffer(self):
+        return self.view
+
+
+class SyntheticSourceType:
+    '''
+    Test tones, noise or silence from a clock-accurate thread, so the server
+    runs (and can be benchmarked) without JACK.
+
+    Periods are due on an absolute timeline, t0 + n * period, so the rate
+    never drifts; a thread that wakes late generates the missed periods
+    back to back, and one more than a second behind starts a new timeline.
+    '''
+    def __init__(self, channels, samplerate=48000, blocksize=256,
+            signal='tone', tone_hz=440.0, level_db=-20.0, seed=None):
+        assert signal in SIGNALS
+        self.channels   = channels
+        self.samplerate = samplerate
+        self.blocksize  = blocksize
+        self.signal     = signal
+        self.level      = 10.0 ** (level_db / 20.0)
+        self.rng        = np.random.default_rng(seed)
+
+        self.bufs    = np.zeros((channels, blocksize), np.dtype('float32'))
+        self.inports = [SyntheticPortType(buf) for buf in self.bufs]
+
+        # one tone per channel, a semitone apart, phase-continuous
+        freqs = tone_hz * 2.0 ** (np.arange(channels) / 12.0)
+        self.omega = 2 * np.pi * np.minimum(freqs, 0.45 * samplerate) / samplerate
+        self.ramp  = np.arange(blocksize)
+        self.phase = np.zeros(channels)
+
+        self.frame_time = 0 # like jack_client.last_frame_time
+        self.late    = 0 # periods generated behind schedule
+        self.running = False
+        self.thread  = None
+
+    def generate(self):
+        '''fill self.bufs with the next period'''
+        if self.signal == 'tone':
+            angles = self.phase[:, None] + self.omega[:, None] * self.ramp
+            np.multiply(np.sin(angles), self.level, out=self.bufs, casting='unsafe')
+            self.phase = (self.phase + self.omega * self.blocksize) % (2 * np.pi)
+        elif self.signal == 'noise':
+            self.rng.standard_normal(self.bufs.shape, np.float32, out=self.bufs)
+            self.bufs *= self.level
+
+    def process(self, ring):
+        '''one period in to ring, what the JACK process callback does'''
+        self.generate()
+        ring.write_ports(self.inports, self.blocksize, self.frame_time)
+        self.frame_time += self.blocksize
+
+    def start(self, ring, on_shutdown=None):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, args=(ring,),
+            name='synthetic-source')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, ring):
+        period = self.blocksize / self.samplerate
+        t0 = time.monotonic()
+        count = 0
+        while self.running:
+            self.process(ring)
+            count += 1
+            delay = t0 + count * period - time.monotonic()
+            if delay > 0.0:
+                time.sleep(delay)
+            elif delay < -1.0:
+                logging.warning('synthetic source fell behind, resyncing')
+                ring.xrun()
+                t0 -= delay
+            else:
+                self.late += 1
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+# end SyntheticSourceType
+
+
+def probe_jack_format(name, servername=None):
+    '''
+    (samplerate, blocksize) of the JACK server, asked through a client that
+    is closed again, so fan-out workers can be forked before the real one
+    '''
+    if jack is None:
+        raise RuntimeError('JACK is not available, try --source synthetic')
+    client = jack.Client(name, servername=servername)
+    try:
+        return client.samplerate, client.blocksize
+    finally:
+        client.close()
+
+
+def make_source(args):
+    if args.source == 'synthetic':
+        return SyntheticSourceType(args.channels, args.synth_rate,
+            args.synth_period, signal=args.signal, tone_hz=args.tone_hz,
+            level_db=args.level_db)
+    return JackSourceType(args.name, args.channels)
+
+
+def configure(argv=None, source=None):
+    '''
+    parse argv and set the module settings everything else reads; the
+    audio format comes from source if given, else from the args or the
+    JACK server. Creates no source, see make_source().
+    '''
+    global args, channels, port, samplerate, blocksize
+    args = parser.parse_args(argv)
+
+    # init things and set settings according to args
+    logging.root.setLevel(args.loglevel.upper())
+    channels = args.channels
+    if source is not None:
+        channels = source.channels
+        samplerate, blocksize = source.samplerate, source.blocksize
+    elif args.source == 'synthetic':
+        samplerate, blocksize = args.synth_rate, args.synth_period
+    else:
+        samplerate, blocksize = probe_jack_format(args.name)
+    if channels > MASK_CHANNELS:
+        logging.warning('only channels 1..{} of {} can be streamed'.format(
+            MASK_CHANNELS, channels))
+    port = args.port
+
+
+class PeriodRingType:
+    '''
+    Single-producer/single-consumer ring of preallocated float32 periods.
+
+    The JACK process callback is the only writer of self.windex and the
+    websocket loop is the only writer of self.rindex, so no locks are needed.
+    Each slot is (channels x frames); when the ring is full the incoming
+    period is dropped and counted in self.overruns, a period of the wrong
+    size (the JACK buffer size changed) in self.mismatched.
+    '''
+    def __init__(self, channels, frames, periods=32):
+        self.channels = channels
+        self.frames   = frames
+        self.periods  = periods
+        self.bufs     = np.zeros((periods, channels, frames), np.dtype('float32'))
+        self.frame_times = np.zeros(periods, np.dtype('int64'))
+
+        # byte views of every (slot, channel) row, so the process callback
+        # only has to memcpy port buffers into place
+        self.rowviews = [[memoryview(self.bufs[sidx, chidx]).cast('B')
+            for chidx in range(channels)] for sidx in range(periods)]
+
+        self.windex    = 0 # total periods written, producer-owned
+        self.rindex    = 0 # total periods consumed, consumer-owned
+        self.overruns  = 0
+        self.xruns     = 0 # source xruns, owned by the JACK xrun callback
+        self.mismatched = 0 # periods that were not self.frames long
+        self.closed    = False
+
+        # set by the consumer before it sleeps, cleared by the producer
+        self.waiting   = False
+        self.loop      = None
+        self.wake      = None
+
+    def attach_loop(self, loop):
+        self.loop = loop
+        self.wake = asyncio.Event()
+
+    def write_ports(self, ports, frames, frame_time=0):
+        '''called from the JACK realtime thread, must not block'''
+        if frames != self.frames:
+            self.mismatched += 1
+            return False
+        if self.windex - self.rindex >= self.periods:
+            self.overruns += 1
+            return False
+
+        sidx = self.windex % self.periods
+        for dst, port in zip(self.rowviews[sidx], ports):
+            dst[:] = port.get_buffer()
+        self.frame_times[sidx] = frame_time
+        self.windex += 1
+
+        self.notify()
+        return True
+
+    def xrun(self):
+        '''called from the JACK xrun callback'''
+        self.xruns += 1
+
+    def notify(self):
+        if self.waiting and self.loop is not None:
+            self.waiting = False
+            self.loop.call_soon_threadsafe(self.wake.set)
+
+    def close(self):
+        self.closed = True
+        self.waiting = True
+        self.notify()
+
+    def pending(self):
+        return self.windex - self.rindex
+
+    async def get(self):
+        '''returns a (channels x frames) view of the oldest period, or None
+        when the ring is closed; call release() when done with the view'''
+        while self.windex == self.rindex:
+            if self.closed:
+                return None
+            self.wake.clear()
+            self.waiting = True
+            # re-check after publishing self.waiting to avoid a lost wakeup
+            if self.windex != self.rindex or self.closed:
+                self.waiting = False
+                continue
+            await self.wake.wait()
+        return self.bufs[self.rindex % self.periods]
+
+    def frame_time(self):
+        return int(self.frame_times[self.rindex % self.periods])
+
+    def release(self):
+        self.rindex += 1
+# end PeriodRingType
+
+
+class SharedPeriodRingType:
+    '''
+    Single-producer/multi-consumer period ring in shared memory, for
+    fan-out worker processes.
+
+    The producer (JACK process callback) never waits for readers: a reader
+    that falls too far behind skips ahead and counts overruns. Readers that
+    are about to sleep raise a flag in the shared header, and the producer
+    wakes them by writing a byte to their pipe.
+    '''
+    WINDEX, CLOSED, XRUNS, MISMATCHED, NHEADER = 0, 1, 2, 3, 4 # then one 'waiting' flag per reader
+
+    def __init__(self, channels, frames, periods=32, readers=1):
+        self.channels = channels
+        self.frames   = frames
+        self.periods  = periods
+        self.readers  = readers
+
+        nheader = self.NHEADER + readers
+        nbytes  = 8*nheader + 8*periods + 4*periods*channels*frames
+        self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        self.header = np.ndarray(nheader, np.dtype('int64'), self.shm.buf, 0)
+        self.frame_times = np.ndarray(periods, np.dtype('int64'), self.shm.buf,
+            8*nheader)
+        self.bufs = np.ndarray((periods, channels, frames), np.dtype('float32'),
+            self.shm.buf, 8*nheader + 8*periods)
+        self.header[:] = 0
+
+        self.rowviews = [[memoryview(self.bufs[sidx, chidx]).cast('B')
+            for chidx in range(channels)] for sidx in range(periods)]
+
+        # one non-blocking wake pipe per reader, (read fd, write fd)
+        self.pipes = []
+        for ridx in range(readers):
+            rfd, wfd = os.pipe()
+            os.set_blocking(rfd, False)
+            os.set_blocking(wfd, False)
+            self.pipes.append((rfd, wfd))
+
+        self.windex   = 0 # producer's private copy of header[WINDEX]
+
+    def write_ports(self, ports, frames, frame_time=0):
+        '''called from the JACK realtime thread, must not block'''
+        if frames != self.frames:
+            self.header[self.MISMATCHED] += 1
+            return False
+
+        sidx = self.windex % self.periods
+        for dst, port in zip(self.rowviews[sidx], ports):
+            dst[:] = port.get_buffer()
+        self.frame_times[sidx] = frame_time
+        self.windex += 1
+        self.header[self.WINDEX] = self.windex
+
+        self.notify()
+        return True
+
+    def xrun(self):
+        '''called from the JACK xrun callback, the readers see the count'''
+        self.header[self.XRUNS] += 1
+
+    def notify(self):
+        for ridx in range(self.readers):
+            if self.header[self.NHEADER + ridx]:
+                self.header[self.NHEADER + ridx] = 0
+                try:
+                    os.write(self.pipes[ridx][1], b'\0')
+                except OSError:
+                    pass # pipe full, the reader is awake anyway
+
+    def close(self):
+        self.header[self.CLOSED] = 1
+        self.header[self.NHEADER:] = 1
+        self.notify()
+
+    def reader(self, ridx):
+        return SharedRingReaderType(self, ridx)
+
+    def unlink(self):
+        self.shm.close()
+        self.shm.unlink()
+# end SharedPeriodRingType
+
+
+class SharedRingReaderType:
+    '''one worker's view of a SharedPeriodRingType, same interface as
+    PeriodRingType on the consumer side'''
+    def __init__(self, ring, ridx):
+        self.ring     = ring
+        self.ridx     = ridx
+        self.channels = ring.channels
+        self.frames   = ring.frames
+        self.periods  = ring.periods
+        self.wakefd   = ring.pipes[ridx][0]
+        self.rindex   = 0
+        self.overruns = 0
+        self.wake     = None
+
+    def attach_loop(self, loop):
+        self.wake = asyncio.Event()
+        loop.add_reader(self.wakefd, self.on_wake)
+        self.rindex = int(self.ring.header[self.ring.WINDEX]) # start at 'now'
+
+    def on_wake(self):
+        try:
+            os.read(self.wakefd, 4096)
+        except BlockingIOError:
+            pass
+        self.wake.set()
+
+    def pending(self):
+        return int(self.ring.header[self.ring.WINDEX]) - self.rindex
+
+    @property
+    def xruns(self):
+        return int(self.ring.header[self.ring.XRUNS])
+
+    @property
+    def mismatched(self):
+        return int(self.ring.header[self.ring.MISMATCHED])
+
+    async def get(self):
+        header, flag = self.ring.header, self.ring.NHEADER + self.ridx
+        while True:
+            windex = int(header[self.ring.WINDEX])
+
+            # keep a two slot margin to the producer, skip ahead if lapped
+            if windex - self.rindex > self.periods - 2:
+                self.overruns += windex - 1 - self.rindex
+                self.rindex = windex - 1
+
+            if self.rindex < windex:
+                return self.ring.bufs[self.rindex % self.periods]
+            if header[self.ring.CLOSED]:
+                return None
+
+            self.wake.clear()
+            header[flag] = 1
+            # re-check after publishing the flag to avoid a lost wakeup
+            if int(header[self.ring.WINDEX]) != windex or header[self.ring.CLOSED]:
+                header[flag] = 0
+                continue
+            await self.wake.wait()
+
+    def frame_time(self):
+        return int(self.ring.frame_times[self.rindex % self.periods])
+
+    def release(self):
+        # the producer may have reused the slot while we were reading it
+        if int(self.ring.header[self.ring.WINDEX]) - self.rindex >= self.periods:
+            self.overruns += 1
+        self.rindex += 1
+# end SharedRingReaderType
+
 
 async def ws_recv_json_dict(ws):
     jss = await ws.recv()
@@ -99,61 +677,1102 @@ async def ws_send_json_fields(ws, **kwargs):
         return True
 
 
+class TcpSockType:
+    '''
+    Wraps a plain TCP client socket in the small part of the websocket
+    interface used by handle_wsock_coro and client_sender_coro.
+
+    Outgoing str messages are framed as META and bytes as DATA, and the
+    frame prefix and the (shared) message are written with one sendmsg
+    call, so the message is never copied per client.
+    '''
+    def __init__(self, sock, loop, addr=None):
+        self.sock   = sock
+        self.loop   = loop
+        self.remote_address = addr
+        self.parser = MsgParserType(msgtypes=('META',), maxlen=1<<16)
+        self.inbox  = collections.deque() # decoded incoming META strings
+        self.closed = False
+
+    async def recv(self):
+        while not self.inbox:
+            data = await self.loop.sock_recv(self.sock, 1<<16)
+            if not data:
+                raise ConnectionResetError('tcp client closed the connection')
+            for msgtype, msg in self.parser.feed(data):
+                self.inbox.append(msg.tobytes().decode())
+        return self.inbox.popleft()
+
+    async def send(self, msg):
+        if isinstance(msg, str):
+            msgtype, msg = b'META', msg.encode()
+        else:
+            msgtype = b'DATA'
+        bufs = [MSG_PREFIX.pack(msgtype, len(msg)), memoryview(msg)]
+
+        while bufs:
+            try:
+                sent = self.sock.sendmsg(bufs)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            # drop what was written, possibly part way in to a buffer
+            while bufs and sent >= len(bufs[0]):
+                sent -= len(bufs[0])
+                bufs.pop(0)
+            if bufs:
+                bufs[0] = memoryview(bufs[0])[sent:]
+                await self.writable()
+
+    def writable(self):
+        fut = self.loop.create_future()
+        fd = self.sock.fileno()
+        def on_writable():
+            self.loop.remove_writer(fd)
+            if not fut.done():
+                fut.set_result(None)
+        self.loop.add_writer(fd, on_writable)
+        return fut
+
+    async def close(self):
+        if not self.closed:
+            self.closed = True
+            self.loop.remove_writer(self.sock.fileno())
+            self.sock.close()
+# end TcpSockType
+
+
+async def serve_tcp_coro(host, port, reuse_port=False):
+    # accept plain TCP clients and hand them to handle_wsock_coro
+    loop = asyncio.get_event_loop()
+    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    lsock.bind((host, port))
+    lsock.listen(128)
+    lsock.setblocking(False)
+    logging.info('serving plain TCP on {}:{}'.format(host, port))
+
+    while True:
+        csock, addr = await loop.sock_accept(lsock)
+        csock.setblocking(False)
+        csock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if args.tcp_sndbuf > 0:
+            csock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, args.tcp_sndbuf)
+        asyncio.ensure_future(handle_tcp_coro(TcpSockType(csock, loop, addr), addr))
+# end async def serve_tcp_coro
+
+
+async def handle_tcp_coro(tsock, addr):
+    try:
+        await handle_wsock_coro(tsock, '{}:{}'.format(*addr))
+    except ConnectionError as e:
+        logging.info('tcp client {}:{} gone: {}'.format(addr[0], addr[1], e))
+    finally:
+        await tsock.close()
+# end async def handle_tcp_coro
+
+
+class UdpSenderType:
+    '''
+    Non-blocking UDP sender for unicast subscribers and multicast groups.
+    A datagram that cannot be sent right away is dropped and counted, so
+    no receiver can ever stall the fan-out.
+    '''
+    def __init__(self, ttl=1):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        self.sent    = 0
+        self.dropped = 0
+        self.errors  = 0
+
+    def send(self, msg, addr):
+        try:
+            self.sock.sendto(msg, addr)
+            self.sent += 1
+        except (BlockingIOError, InterruptedError):
+            self.dropped += 1
+        except OSError as e:
+            # e.g. EMSGSIZE for oversized batches, or ICMP unreachable
+            if 0 == self.errors % 1000:
+                logging.warning('udp send to {} failed: {}'.format(addr, e))
+            self.errors += 1
+# end UdpSenderType
+
+
+def parse_hostport(hostport):
+    host, _, port = hostport.rpartition(':')
+    return (host, int(port))
+
+
+def multicast_stream_keys():
+    # one StreamKey per ';' separated --multicast-channels entry
+    keys = []
+    for spec in args.multicast_channels.split(';'):
+        chans = tuple(int(ch) for ch in spec.split(',') if ch.strip())
+        if chans and all(1 <= ch <= min(channels, MASK_CHANNELS) for ch in chans):
+            keys.append(StreamKey(chans, args.multicast_format, None,
+                PCM_CODEC, None, 1, 0))
+        else:
+            logging.warning('ignoring invalid multicast channels {!r}'.format(spec))
+    return keys
+
+
 class ChannelsStatsType:
-    def __init__(self, rms=None, clips=None):
-        if list != type(rms): rms=list()
-        if list != type(clips): clips=list()
+    '''
+    Running per-channel statistics over all periods since the last collect.
+
+    All accumulators and scratch arrays are preallocated, and every period
+    is reduced with a handful of 2-D NumPy calls across all channels.
+    '''
+    def __init__(self, channels, frames):
+        self.channels = channels
+        self.alloc(frames)
+        self.clear()
+
+    def alloc(self, frames):
+        self.frames = frames
+        shape = (self.channels, frames)
+        self.sqbuf    = np.zeros(shape, np.dtype('float32'))
+        self.absbuf   = np.zeros(shape, np.dtype('float32'))
+        self.clipmask = np.zeros(shape, np.dtype('bool'))
+
+        # latest period, e.g. for gating on the current energy
+        self.period_sumsq = np.zeros(self.channels, np.dtype('float64'))
+        self.period_peak  = np.zeros(self.channels, np.dtype('float32'))
+        self.period_clips = np.zeros(self.channels, np.dtype('int64'))
+
+        # accumulators, reset by clear()
+        self.sumsq = np.zeros(self.channels, np.dtype('float64'))
+        self.peak  = np.zeros(self.channels, np.dtype('float32'))
+        self.clips = np.zeros(self.channels, np.dtype('int64'))
+        self.count = 0
 
-        # shadow inputs to class variables
-        self.rms = rms
-        self.clips = clips
-    
     def clear(self):
-        self.rms, self.clips = [], []
-    
+        self.sumsq.fill(0.0)
+        self.peak.fill(0.0)
+        self.clips.fill(0)
+        self.count = 0
+
     def update_with_bufs(self, jackbufs):
-        # make numpy arrays for calculating stats
-        jackarrs = tuple(np.frombuffer(jb, np.dtype('float32')) 
-            for jb in jackbufs)
+        # jackbufs is a (channels x frames) float32 array
+        if jackbufs.shape[1] != self.frames:
+            self.alloc(jackbufs.shape[1])
 
-        self.rms.append( tuple((calcrms(ja) for ja in jackarrs)) )
-        self.clips.append( tuple((countclips(ja) for ja in jackarrs)) )
+        np.multiply(jackbufs, jackbufs, out=self.sqbuf)
+        self.sqbuf.sum(axis=1, dtype=np.float64, out=self.period_sumsq)
+        np.add(self.sumsq, self.period_sumsq, out=self.sumsq)
 
-    def collect_as_dict(self):
-        logging.debug('rms = {}'.format(self.rms))
-        logging.debug('clips = {}'.format(self.clips))
+        np.abs(jackbufs, out=self.absbuf)
+        self.absbuf.max(axis=1, out=self.period_peak)
+        np.maximum(self.peak, self.period_peak, out=self.peak)
 
-        if len(self.rms) <= 0 or len(self.clips) <= 0:
+        np.greater(self.absbuf, 1.0, out=self.clipmask)
+        self.clipmask.sum(axis=1, out=self.period_clips)
+        np.add(self.clips, self.period_clips, out=self.clips)
+
+        self.count += self.frames
+
+    def period_meansq(self):
+        return self.period_sumsq / self.frames
+
+    def collect_as_dict(self):
+        if self.count <= 0:
             outp = dict(
-                rms  =(np.nan,)*channels,
-                clips=(np,)*channels
+                rms  =[float('nan')]*self.channels,
+                peak =[float('nan')]*self.channels,
+                clips=[0]*self.channels
             )
         else:
             outp = dict(
-                rms  =np.mean(np.array(self.rms), 0).tolist(),
-                clips=np.sum(np.array(self.clips), 0).tolist()
+                rms  =np.sqrt(self.sumsq / self.count).tolist(),
+                peak =self.peak.tolist(),
+                clips=self.clips.tolist()
             )
+        logging.debug('stats = {}'.format(outp))
 
         self.clear()
         return outp
 # end ChannelsStatsType
 
 
+def biquad_response(b, a, w):
+    # |H(e^jw)|^2 of one biquad at normalized angular frequencies w
+    z = np.exp(-1j * w)
+    num = b[0] + b[1]*z + b[2]*z*z
+    den = a[0] + a[1]*z + a[2]*z*z
+    return np.abs(num / den)**2
+
+
+def kweight_response(samplerate, nfft):
+    '''power response of the BS.1770 K-weighting filter at rfft bins'''
+    w = 2*np.pi * np.fft.rfftfreq(nfft, 1.0/samplerate) / samplerate
+
+    # stage 1, high shelf (+4 dB), same constants as libebur128
+    f0, G, Q = 1681.974450955533, 3.999843853973347, 0.7071752369554196
+    K  = np.tan(np.pi * f0 / samplerate)
+    Vh = 10**(G/20.0)
+    Vb = Vh**0.4996667741545416
+    a0 = 1.0 + K/Q + K*K
+    b = ((Vh + Vb*K/Q + K*K)/a0, 2.0*(K*K - Vh)/a0, (Vh - Vb*K/Q + K*K)/a0)
+    a = (1.0, 2.0*(K*K - 1.0)/a0, (1.0 - K/Q + K*K)/a0)
+    resp = biquad_response(b, a, w)
+
+    # stage 2, RLB high pass at ~38 Hz
+    f0, Q = 38.13547087602444, 0.5003270373238773
+    K  = np.tan(np.pi * f0 / samplerate)
+    a0 = 1.0 + K/Q + K*K
+    b = (1.0, -2.0, 1.0)
+    a = (1.0, 2.0*(K*K - 1.0)/a0, (1.0 - K/Q + K*K)/a0)
+    return resp * biquad_response(b, a, w)
+
+
+def truepeak_phases(oversample=4, taps=12):
+    # windowed-sinc interpolator split in to (oversample x taps) phases
+    n = np.arange(oversample*taps) - (oversample*taps - 1) / 2.0
+    h = np.sinc(n / oversample) * np.hanning(oversample*taps)
+    h = h.reshape(taps, oversample).T
+    return (h / h.sum(axis=1, keepdims=True)).astype(np.float32)
+
+
+def todb(x, floor=-150.0):
+    return np.maximum(10*np.log10(np.maximum(x, 1e-30)), floor)
+
+
+class MeterType:
+    '''
+    Batched metering over all channels, computed once per interval no
+    matter how many clients subscribe: sample peak, 4x oversampled
+    true-peak, short-term (3 s) K-weighted loudness and log-spaced FFT
+    band energies of the latest nfft frames. Loudness is per channel and
+    built from the K-weighted energy of each interval's FFT window.
+    '''
+    def __init__(self, channels, samplerate, nfft=4096, bands=24,
+            max_rate=30.0, short_term=3.0):
+        self.channels   = channels
+        self.samplerate = samplerate
+        self.nfft       = nfft
+        self.short_term = short_term
+
+        # rolling window of the latest nfft frames, written circularly
+        self.hist  = np.zeros((channels, nfft), np.dtype('float32'))
+        self.hpos  = 0
+        self.fresh = 0 # frames written since the last compute
+        self.peak  = np.zeros(channels, np.dtype('float32'))
+
+        self.window = np.hanning(nfft).astype(np.float32)
+        self.wnorm  = 2.0 / (nfft * np.sum(self.window**2)) # one-sided
+        self.kresp  = kweight_response(samplerate, nfft)
+        self.phases = truepeak_phases()
+
+        # log-spaced band edges from 20 Hz to nyquist, as a (bins x bands)
+        # 0/1 matrix so all band energies are one matmul
+        freqs = np.fft.rfftfreq(nfft, 1.0/samplerate)
+        self.band_edges = np.geomspace(20.0, samplerate/2.0, bands+1)
+        bandidx = np.searchsorted(self.band_edges, freqs, side='right') - 1
+        bandidx[freqs >= samplerate/2.0] = bands - 1
+        self.bandmat = np.zeros((len(freqs), bands), np.dtype('float32'))
+        valid = bandidx >= 0
+        self.bandmat[np.flatnonzero(valid), bandidx[valid]] = 1.0
+
+        # per compute K-weighted mean squares, for short-term loudness
+        depth = int(np.ceil(short_term * max_rate)) + 1
+        self.kms   = np.zeros((depth, channels), np.dtype('float64'))
+        self.ktime = np.full(depth, -np.inf)
+        self.kpos  = 0
+
+        self.last_compute = 0.0
+
+    def update(self, jackbufs, period_peak):
+        frames = jackbufs.shape[1]
+        if frames >= self.nfft:
+            self.hist[:] = jackbufs[:, -self.nfft:]
+            self.hpos = 0
+        else:
+            n = min(frames, self.nfft - self.hpos)
+            self.hist[:, self.hpos:self.hpos+n] = jackbufs[:, :n]
+            self.hist[:, :frames-n] = jackbufs[:, n:]
+            self.hpos = (self.hpos + frames) % self.nfft
+        self.fresh += frames
+        np.maximum(self.peak, period_peak, out=self.peak)
+
+    def compute(self, now):
+        x = np.concatenate((self.hist[:, self.hpos:], self.hist[:, :self.hpos]), axis=1)
+
+        # true-peak over the frames that are new since the last compute
+        taps = self.phases.shape[1]
+        m = min(self.fresh, self.nfft - taps + 1)
+        if m > 0:
+            frames = np.lib.stride_tricks.sliding_window_view(
+                x[:, self.nfft-m-taps+1:], taps, axis=1)
+            truepeak = np.abs(frames @ self.phases.T).max(axis=(1, 2))
+            truepeak = np.maximum(truepeak, self.peak)
+        else:
+            truepeak = self.peak.copy()
+
+        # one FFT of all channels for bands and loudness
+        power = np.abs(np.fft.rfft(x * self.window, axis=1))**2 * self.wnorm
+        bands = power @ self.bandmat
+        self.kms[self.kpos] = power @ self.kresp
+        self.ktime[self.kpos] = now
+        self.kpos = (self.kpos + 1) % len(self.ktime)
+        recent = self.ktime > now - self.short_term
+        loudness = -0.691 + todb(self.kms[recent].mean(axis=0))
+
+        outp = dict(
+            message   = 'meter',
+            peak      = np.round(20*np.log10(np.maximum(self.peak, 1e-9)), 1).tolist(),
+            true_peak = np.round(20*np.log10(np.maximum(truepeak, 1e-9)), 1).tolist(),
+            loudness  = np.round(loudness, 1).tolist(),
+            bands     = np.round(todb(bands), 1).tolist(),
+            band_edges= np.round(self.band_edges, 1).tolist())
+
+        self.peak.fill(0.0)
+        self.fresh = 0
+        self.last_compute = now
+        return outp
+# end MeterType
+
+
+# identifies one distinct outbound stream, clients with equal keys are
+# served the very same payload object; delay is in periods behind live
+StreamKey = collections.namedtuple('StreamKey', 'channels fmt rate codec mix batch delay')
+
+
+class MixerType:
+    '''
+    Computes all distinct client mixes with one matrix multiply per period.
+
+    A mix signature is a tuple of output rows (mono or stereo), each row a
+    tuple of per-inport gains. Clients with equal signatures share rows.
+    '''
+    def __init__(self, channels):
+        self.channels = channels
+        self.sigs     = frozenset()
+        self.rows     = dict() # signature -> slice of self.gains/self.out rows
+        self.gains    = np.zeros((0, channels), np.dtype('float32'))
+        self.out      = None
+        self.jackbufs = None
+        self.mixed    = False
+
+    def set_mixes(self, sigs):
+        sigs = frozenset(sigs)
+        if sigs == self.sigs:
+            return
+        self.sigs = sigs
+
+        # stack every distinct mix in to one (mixes x channels) gain matrix
+        rowlist = []
+        self.rows = dict()
+        for sig in sorted(sigs):
+            self.rows[sig] = slice(len(rowlist), len(rowlist)+len(sig))
+            rowlist.extend(sig)
+        self.gains = np.array(rowlist, np.dtype('float32')).reshape(-1, self.channels)
+        self.out = None
+        logging.debug('mixer rebuilt with {} mixes'.format(len(sigs)))
+
+    def new_period(self, jackbufs):
+        self.jackbufs = jackbufs
+        self.mixed = False
+
+    def get(self, sig):
+        '''returns the (len(sig) x frames) rows of mix sig for this period'''
+        if not self.mixed:
+            shape = (self.gains.shape[0], self.jackbufs.shape[1])
+            if self.out is None or self.out.shape != shape:
+                self.out = np.zeros(shape, np.dtype('float32'))
+            np.matmul(self.gains, self.jackbufs, out=self.out)
+            self.mixed = True
+        return self.out[self.rows[sig]]
+# end MixerType
+
+
+# lowest output rate and largest interpolation factor a client may request
+MIN_OUTPUT_RATE = 8000
+MAX_RESAMPLE_PHASES = 512
+
+
+@functools.lru_cache(maxsize=None)
+def polyphase_bank(in_rate, out_rate, zeros=16, beta=8.6):
+    '''
+    Kaiser windowed sinc lowpass for in_rate -> out_rate, split in to its
+    up phases; returns (up, down, bank) with bank shaped (up x taps).
+    '''
+    g = np.gcd(in_rate, out_rate)
+    up, down = out_rate // g, in_rate // g
+    taps = 2 * zeros * int(np.ceil(max(up, down) / up))
+    n = np.arange(taps * up) - (taps * up - 1) / 2.0
+    fc = 0.5 * 0.92 / max(up, down) # of the upsampled rate, below nyquist
+    h = 2*fc * np.sinc(2*fc * n) * np.kaiser(taps * up, beta) * up
+    bank = np.ascontiguousarray(h.reshape(taps, up).T, np.dtype('float32'))
+    return up, down, bank
+
+
+class ResamplerType:
+    '''
+    Streaming polyphase resampler; keeps the filter history and output
+    phase between periods so period boundaries are seamless.
+    '''
+    def __init__(self, in_rate, out_rate, frame_channels):
+        self.up, self.down, self.bank = polyphase_bank(in_rate, out_rate)
+        taps = self.bank.shape[1]
+        self.hist = np.zeros((taps-1, frame_channels), np.dtype('float32'))
+        self.pos  = 0 # next output, in upsampled units from the period start
+        self.tapidx = np.arange(taps-1, -1, -1)
+
+    def skip(self, frames):
+        '''advance over frames of silence, returns the output frame count'''
+        count = max(0, -(-(frames * self.up - self.pos) // self.down))
+        self.pos += self.down * count - frames * self.up
+        self.hist.fill(0.0)
+        return count
+
+    def process(self, samples):
+        '''resample (frames x channels) samples, returns (frames\' x channels)'''
+        frames = len(samples)
+        x = np.concatenate((self.hist, samples))
+        count = max(0, -(-(frames * self.up - self.pos) // self.down))
+        t = self.pos + self.down * np.arange(count)
+        base, phase = np.divmod(t, self.up)
+        # (count x taps) input frames, newest first, per output frame
+        window = x[base[:, None] + self.tapidx]
+        out = np.einsum('nk,nkc->nc', self.bank[phase], window)
+
+        self.pos += self.down * count - frames * self.up
+        self.hist[:] = x[frames:]
+        return out
+# end ResamplerType
+
+
+class StreamStateType:
+    '''state that one distinct stream keeps across periods'''
+    def __init__(self, key):
+        self.key      = key
+        self.sequence = 0    # DATA messages emitted so far
+        self.periods  = []   # encoded periods of the current batch
+        self.frame_time = 0  # JACK frame time of the first period in batch
+        self.frame_channels = len(key.mix or key.channels)
+        self.frame_bytes = self.frame_channels * SAMPLE_FORMATS[key.fmt]['samplesize'] // 8
+        self.quiet    = 0    # consecutive periods below the dtx threshold
+
+        # inports that feed this stream, bit 0 is channel 1
+        if key.mix is not None:
+            gains = np.array(key.mix)
+            chidxs = np.flatnonzero(np.any(gains != 0.0, axis=0))
+        else:
+            chidxs = np.array(key.channels) - 1
+        self.channel_mask = sum(1 << int(chidx) for chidx in chidxs)
+        self.chidxs = chidxs
+
+        # filter state for streams at a client requested rate
+        self.resampler = None
+        if key.rate is not None:
+            self.resampler = ResamplerType(samplerate, key.rate,
+                self.frame_channels)
+
+    def silent_payload(self, frames):
+        # an encoded period of digital silence
+        if self.key.codec == LOSSLESS_CODEC:
+            return encode_lossless(np.zeros((frames, self.frame_channels), np.int32))
+        return bytes(frames * self.frame_bytes)
+
+    def gate(self, meansq, threshold, hangover):
+        '''True when this period may be sent as silence'''
+        if len(self.chidxs) and meansq[self.chidxs].max() >= threshold:
+            self.quiet = 0
+            return False
+        self.quiet += 1
+        return self.quiet > hangover
+
+    def add_period(self, payload, frames, frame_time):
+        '''
+        returns the header + payload DATA message when the batch is full;
+        payload None is a silent period, a batch of only silent periods
+        becomes a silence marker
+        '''
+        if not self.periods:
+            self.frame_time = frame_time
+            self.frames = 0
+        self.periods.append((payload, frames))
+        self.frames += frames
+        if len(self.periods) < self.key.batch:
+            return None
+
+        if all(payload is None for payload, frames in self.periods):
+            msg = pack_silence(self.frame_channels, self.sequence,
+                self.frame_time, self.channel_mask, self.frames)
+        else:
+            header = pack_data_header(self.key.fmt, self.frame_channels,
+                self.sequence, self.frame_time, self.channel_mask, self.frames,
+                self.key.codec)
+            msg = header + b''.join(self.silent_payload(frames)
+                if payload is None else payload for payload, frames in self.periods)
+        self.periods.clear()
+        self.sequence += 1
+        return msg
+# end StreamStateType
+
+
+class HistoryRingType:
+    '''
+    Fixed size ring of the most recent periods of every inport, with their
+    frame times and energies. One ring serves every client, for pre-roll
+    bursts and for rewound (delayed) streams.
+    '''
+    def __init__(self, channels, frames, periods):
+        self.channels = channels
+        self.periods  = max(1, periods)
+        self.alloc(frames)
+
+    def alloc(self, frames):
+        self.frames = frames
+        self.bufs = np.zeros((self.periods, self.channels, frames), np.dtype('float32'))
+        self.frame_times = np.zeros(self.periods, np.dtype('int64'))
+        self.meansq = np.zeros((self.periods, self.channels), np.dtype('float64'))
+        self.count = 0 # periods pushed so far
+
+    def push(self, jackbufs, frame_time, meansq=None):
+        if jackbufs.shape[1] != self.frames:
+            self.alloc(jackbufs.shape[1]) # older periods no longer fit
+        idx = self.count % self.periods
+        self.bufs[idx] = jackbufs
+        self.frame_times[idx] = frame_time
+        if meansq is not None:
+            self.meansq[idx] = meansq
+        self.count += 1
+
+    def available(self):
+        return min(self.count, self.periods)
+
+    def get(self, back):
+        '''(jackbufs, frame_time, meansq) of the period back periods before
+        the newest one, back 0 is the newest'''
+        idx = (self.count - 1 - back) % self.periods
+        return self.bufs[idx], int(self.frame_times[idx]), self.meansq[idx]
+# end HistoryRingType
+
+
+class EncodeCacheType:
+    '''
+    Per-period cache of encoded payloads keyed by StreamKey.
+
+    Call new_period() once per JACK period, then get(key) for every client;
+    each distinct key is encoded exactly once per period. Keys with
+    batch > 1 accumulate periods and only return a DATA message (else None)
+    once key.batch periods have been collected. Keys with a delay are
+    encoded from the history ring.
+    '''
+    def __init__(self, mixer, rng=None, dtx_threshold=None, dtx_hangover=0,
+            history=None):
+        if rng == None: rng = np.random.default_rng()
+        self.mixer    = mixer
+        self.rng      = rng # dither source for the integer formats
+        self.history  = history # HistoryRingType, for delays and pre-roll
+        self.jackbufs = None
+        self.frame_time = 0
+        self.meansq   = None # per-inport energy of this period, for dtx
+
+        # mean square below which a stream is silent, None disables dtx
+        self.dtx_threshold = dtx_threshold
+        self.dtx_hangover  = dtx_hangover # in periods
+        self.payloads = dict()
+        self.streams  = dict() # key -> StreamStateType
+
+        # counters, encodes vs. cache hits
+        self.misses = 0
+        self.hits   = 0
+        self.silent = 0
+
+    def new_period(self, jackbufs, frame_time=0, meansq=None):
+        # forget state of streams nobody asked for last period
+        for key in tuple(self.streams):
+            if key not in self.payloads:
+                del self.streams[key]
+
+        self.jackbufs = jackbufs
+        self.frame_time = frame_time
+        self.meansq = meansq
+        self.payloads.clear()
+        self.mixer.new_period(jackbufs)
+        if self.history is not None:
+            self.history.push(jackbufs, frame_time, meansq)
+
+    def source(self, key, back=0):
+        # (jackbufs, frame_time, meansq) key encodes, None if not available
+        back += key.delay
+        if back == 0:
+            return self.jackbufs, self.frame_time, self.meansq
+        if self.history is None or back >= self.history.available():
+            return None
+        return self.history.get(back)
+
+    def get(self, key):
+        if key in self.payloads:
+            self.hits += 1
+            return self.payloads[key]
+
+        stream = self.streams.get(key)
+        if stream is None:
+            stream = self.streams[key] = StreamStateType(key)
+
+        source = self.source(key)
+        payload = None
+        if source is not None: # else not enough history for the delay yet
+            payload = self.add_period(stream, *source)
+        self.misses += 1
+        self.payloads[key] = payload
+        return payload
+
+    def preroll(self, key, periods):
+        '''
+        DATA messages of up to periods history periods right before the
+        next live message of key, numbered to run in to the live stream
+        '''
+        # skip the periods the client's first live message will carry
+        live = self.streams.get(key)
+        if live is None:
+            sequence, newest = 0, 1
+        elif key not in self.payloads:
+            sequence, newest = live.sequence, len(live.periods) + 1
+        elif self.payloads[key] is None:
+            sequence, newest = live.sequence, len(live.periods)
+        else: # this period's message is out already, the client gets it too
+            sequence, newest = live.sequence - 1, key.batch
+        avail = 0
+        if self.history is not None:
+            avail = self.history.available() - newest - key.delay
+        count = max(0, min(periods, avail)) // key.batch
+
+        stream = StreamStateType(key)
+        stream.sequence = (sequence - count) & 0xffffffff
+        msgs = []
+        for back in range(newest + count * key.batch - 1, newest - 1, -1):
+            payload = self.add_period(stream, *self.source(key, back))
+            if payload is not None:
+                msgs.append(payload)
+        return msgs
+
+    def add_period(self, stream, jackbufs, frame_time, meansq):
+        key = stream.key
+        frames = jackbufs.shape[1]
+        if (self.dtx_threshold is not None and meansq is not None and
+                stream.gate(meansq, self.dtx_threshold, self.dtx_hangover)):
+            # nothing to encode, the resampler only advances its phase
+            if stream.resampler is not None:
+                frames = stream.resampler.skip(frames)
+            self.silent += 1
+            return stream.add_period(None, frames, frame_time)
+        return stream.add_period(*self.encode(key, jackbufs, stream.resampler),
+            frame_time)
+
+    def encode(self, key, jackbufs, resampler=None):
+        '''returns the encoded payload of key for jackbufs and its frames'''
+        if key.mix is not None:
+            if jackbufs is self.jackbufs:
+                samples = self.mixer.get(key.mix)
+            else: # a delayed period, the mixer only holds the live one
+                samples = np.matmul(np.array(key.mix, np.dtype('float32')), jackbufs)
+            samples = samples[0] if len(samples) == 1 else np.ascontiguousarray(samples.T)
+        elif len(key.channels) == 1:
+            # channel-1 --> convert 1-based TO 0-based
+            samples = jackbufs[key.channels[0]-1]
+        else:
+            # gather + transpose gives one (frames x channels) interleaved copy
+            chidxs = np.array(key.channels) - 1
+            samples = np.ascontiguousarray(jackbufs[chidxs].T)
+        if resampler is not None:
+            shape = samples.shape
+            samples = resampler.process(samples.reshape(shape[0], -1))
+            samples = samples.reshape((len(samples),) + shape[1:])
+        if key.codec == LOSSLESS_CODEC:
+            q = quantize_samples(samples, key.fmt, self.rng)
+            return encode_lossless(q.reshape(len(q), -1)), len(samples)
+        return encode_samples(samples, key.fmt, self.rng).tobytes(), len(samples)
+# end EncodeCacheType
+
+
 class ClientType:
-    def __init__(self, wsock, wsaddr, id=None, channel=None, connected=None):
-        if id        == None: id = str(uuid.uuid1())
-        if channel   == None: channel = 1
-        if connected == None: connected = False
-        
+    def __init__(self, wsock, wsaddr, id=None, channels=None, connected=None,
+            maxqueue=None, drop_policy=None, fmt=None):
+        if id          == None: id = str(uuid.uuid1())
+        if channels    == None: channels = (1,)
+        if fmt         == None: fmt = DEFAULT_SAMPLE_FORMAT
+        if connected   == None: connected = False
+        if maxqueue    == None: maxqueue = 64
+        if drop_policy == None: drop_policy = 'drop_oldest'
+        assert drop_policy in DROP_POLICIES
+
         # shadow inputs to class variables
-        self.wsock     = wsock
-        self.wsaddr    = wsaddr
-        self.id        = id
-        self.channel   = channel
-        self.connected = connected
+        self.wsock       = wsock
+        self.wsaddr      = wsaddr
+        self.id          = id
+        self.channels    = tuple(channels) # 1-based, interleaved in order
+        self.connected   = connected
+        self.drop_policy = drop_policy
+        self.fmt         = fmt # negotiated sample format for DATA frames
+        self.mix         = None # mix signature, replaces self.channels if set
+        self.batch       = 1 # JACK periods per DATA message
+        self.audio       = True # False for meter-only clients
+        self.meter_rate  = 0.0 # meter messages per second, 0 is off
+        self.last_meter  = 0.0
+        self.udp_port    = 0 # send DATA as UDP datagrams to this port if set
+        self.delay       = 0 # periods behind live, from a 'rewind' request
+        self.preroll     = 0 # periods of history a new stream starts with
+        self.preroll_pending = True # send the burst with the next period
+
+        # peer address, for UDP unicast
+        try:
+            self.peer_ip = wsock.remote_address[0]
+        except (AttributeError, TypeError, IndexError):
+            self.peer_ip = None
+        self.rate        = None # None is the JACK samplerate
+        self.codec       = PCM_CODEC
+
+        # bounded outbound queue, drained by self.sender_task
+        self.sendq       = asyncio.Queue(maxsize=maxqueue)
+        self.sender_task = None
+
+        # lag counters
+        self.sent    = 0 # messages handed to the socket
+        self.dropped = 0 # messages dropped because the queue was full
+        self.maxlag  = 0 # deepest the queue has been since the last META
+
+    def enqueue(self, msg):
+        '''queue msg without ever blocking, returns False if the client
+        should be disconnected according to self.drop_policy'''
+        if self.sendq.full():
+            self.dropped += 1
+            if self.drop_policy == 'disconnect':
+                return False
+            elif self.drop_policy == 'drop_newest':
+                return True
+            elif not self.drop_oldest_data(): # drop_oldest
+                if not isinstance(msg, str):
+                    return True # nothing but META queued, drop msg instead
+                self.sendq.get_nowait()
+        self.sendq.put_nowait(msg)
+        self.maxlag = max(self.maxlag, self.sendq.qsize())
+        return True
+
+    def drop_oldest_data(self):
+        '''evict the oldest DATA (bytes) message, META and control messages
+        (str) keep their place; returns False if no DATA was queued'''
+        msgs = [self.sendq.get_nowait() for idx in range(self.sendq.qsize())]
+        found = False
+        for idx, msg in enumerate(msgs):
+            if not isinstance(msg, str):
+                del msgs[idx]
+                found = True
+                break
+        for msg in msgs:
+            self.sendq.put_nowait(msg)
+        return found
+
+    def stream_key(self):
+        if self.mix is not None:
+            return StreamKey((), self.fmt, self.rate, self.codec, self.mix,
+                self.batch, self.delay)
+        return StreamKey(self.channels, self.fmt, self.rate, self.codec, None,
+            self.batch, self.delay)
+
+    def lag(self):
+        return self.sendq.qsize()
+
+    def lag_dict(self, reset=True):
+        outp = dict(lag=self.lag(), maxlag=self.maxlag,
+            sent=self.sent, dropped=self.dropped)
+        if reset:
+            self.maxlag = self.lag()
+        return outp
+
+    def start(self):
+        self.sender_task = asyncio.ensure_future(client_sender_coro(self))
+
+    def stop(self):
+        self.connected = False
+        if self.sender_task is not None:
+            self.sender_task.cancel()
+            self.sender_task = None
 # end ClientsType
 
 
+def requested_channels(msg, default):
+    # 'channel_select' may be a single 1-based channel or a list of them
+    chsel = msg.get('channel_select', default)
+    if isinstance(chsel, (int, str)):
+        chsel = (chsel,)
+    try:
+        chsel = tuple(int(ch) for ch in chsel)
+    except (TypeError, ValueError, OverflowError):
+        logging.warning('invalid channel_select {!r}'.format(chsel))
+        return default
+    if len(chsel) < 1 or not all(1 <= ch <= channels for ch in chsel):
+        logging.warning('invalid channel_select {!r}'.format(chsel))
+        return default
+    if max(chsel) > MASK_CHANNELS:
+        logging.warning('channel_select {!r}: only channels 1..{} can be '
+            'streamed'.format(chsel, MASK_CHANNELS))
+        return default
+    return chsel
+
+
+def requested_mix(msg, default):
+    '''
+    'mix' is a list of one (mono) or two (stereo) gain rows, each row either
+    a list with one gain per inport or a dict of {1-based channel: gain};
+    a flat list of gains is a mono mix, null removes the mix
+    '''
+    if 'mix' not in msg:
+        return default
+    mix = msg['mix']
+    if mix is None:
+        return None
+    try:
+        if isinstance(mix, dict) or not isinstance(mix[0], (list, dict)):
+            mix = [mix]
+        sig = []
+        for row in mix:
+            gains = np.zeros(channels, np.dtype('float32'))
+            if isinstance(row, dict):
+                for ch, g in row.items():
+                    # no negative indexing in to the last inports
+                    if not 1 <= int(ch) <= channels:
+                        raise ValueError('channel {} not in 1..{}'.format(ch, channels))
+                    gains[int(ch)-1] = g
+            else:
+                gains[:] = row
+            if np.any(gains[MASK_CHANNELS:] != 0.0):
+                raise ValueError('only channels 1..{} can be mixed'.format(MASK_CHANNELS))
+            # float32 values so near-identical requests share a signature
+            sig.append(tuple(gains.tolist()))
+        assert len(sig) in (1, 2)
+        return tuple(sig)
+    except Exception as e:
+        logging.warning('invalid mix {!r}: {}'.format(mix, e))
+        return default
+
+
+def requested_batch(msg, default):
+    # 'batch' in JACK periods, or 'batch_ms' rounded to whole periods
+    try:
+        if 'batch' in msg:
+            batch = int(msg['batch'])
+        elif 'batch_ms' in msg:
+            periods = float(msg['batch_ms']) * samplerate / 1000.0
+            batch = int(round(periods / blocksize))
+        else:
+            return default
+    except (TypeError, ValueError, OverflowError):
+        logging.warning('invalid batch request {!r}'.format(msg))
+        return default
+
+    max_batch = args.max_batch_ms * samplerate / 1000.0
+    max_batch = max(1, int(max_batch / blocksize))
+    return min(max(1, batch), max_batch)
+
+
+def requested_meter_rate(msg, default):
+    if 'meter_rate' not in msg:
+        return default
+    try:
+        rate = float(msg['meter_rate'] or 0.0)
+    except (TypeError, ValueError):
+        logging.warning('invalid meter_rate {!r}'.format(msg['meter_rate']))
+        return default
+    if rate > 0.0 and not args.meter:
+        logging.warning('meter_rate requested but metering is disabled')
+        return 0.0
+    return min(max(0.0, rate), args.max_meter_rate)
+
+
+def requested_rate(msg, default):
+    # 'rate' in Hz, resampled on the server; None (or the JACK rate) is native
+    if 'rate' not in msg:
+        return default
+    try:
+        rate = int(msg['rate'] or samplerate)
+    except (TypeError, ValueError, OverflowError):
+        logging.warning('invalid rate {!r}'.format(msg['rate']))
+        return default
+    if rate == samplerate:
+        return None
+    up = rate // np.gcd(rate, samplerate)
+    if not MIN_OUTPUT_RATE <= rate < samplerate or up > MAX_RESAMPLE_PHASES:
+        logging.warning('unsupported rate {} requested'.format(rate))
+        return default
+    return rate
+
+
+def history_periods():
+    return int(args.history_s * samplerate / blocksize)
+
+
+def requested_preroll(msg, default):
+    # 'preroll_ms' of history sent when the stream (re)starts, 0 is none
+    if 'preroll_ms' not in msg:
+        return default
+    try:
+        periods = float(msg['preroll_ms'] or 0.0) * samplerate / 1000.0 / blocksize
+        periods = int(np.ceil(periods))
+    except (TypeError, ValueError, OverflowError):
+        logging.warning('invalid preroll_ms {!r}'.format(msg['preroll_ms']))
+        return default
+    return min(max(0, periods), history_periods())
+
+
+def requested_delay(msg, default):
+    # 'rewind' seconds behind live, limited by the history ring
+    if 'rewind' not in msg:
+        return default
+    try:
+        periods = int(round(float(msg['rewind'] or 0.0) * samplerate / blocksize))
+    except (TypeError, ValueError, OverflowError):
+        logging.warning('invalid rewind {!r}'.format(msg['rewind']))
+        return default
+    if periods > history_periods() - 1:
+        logging.warning('rewind {} is beyond the {} s history'.format(
+            msg['rewind'], args.history_s))
+    return min(max(0, periods), max(0, history_periods() - 1))
+
+
+def requested_udp_port(msg, default):
+    try:
+        port = int(msg.get('udp_port', default) or 0)
+    except (TypeError, ValueError, OverflowError):
+        logging.warning('invalid udp_port {!r}'.format(msg.get('udp_port')))
+        return default
+    return port if 0 < port < 65536 else 0
+
+
+def requested_format(msg, default):
+    # 'format' in a connect or channel_select message, if it is one we know
+    fmt = msg.get('format', default)
+    if not isinstance(fmt, str) or fmt not in SAMPLE_FORMATS:
+        logging.warning('unknown sample format {!r} requested'.format(fmt))
+        return default
+    return fmt
+
+
+def requested_codec(msg, fmt, default):
+    # 'codec', the lossless codec only codes the integer formats
+    codec = msg.get('codec', default)
+    if not isinstance(codec, str) or codec not in CODECS:
+        logging.warning('unknown codec {!r} requested'.format(codec))
+        return default
+    if codec == LOSSLESS_CODEC and fmt not in LOSSLESS_FORMATS:
+        logging.warning('codec {} needs one of {}, not {}'.format(codec,
+            LOSSLESS_FORMATS, fmt))
+        return PCM_CODEC
+    return codec
+
+
+def apply_client_request(client, msg):
+    # settings a client may send in 'connect' and 'channel_select' messages
+    key = client.stream_key()
+    client.channels   = requested_channels(msg, client.channels)
+    client.mix        = requested_mix(msg, client.mix)
+    client.batch      = requested_batch(msg, client.batch)
+    client.fmt        = requested_format(msg, client.fmt)
+    client.codec      = requested_codec(msg, client.fmt, client.codec)
+    client.rate       = requested_rate(msg, client.rate)
+    client.meter_rate = requested_meter_rate(msg, client.meter_rate)
+    client.audio      = bool(msg.get('audio', client.audio))
+    client.udp_port   = requested_udp_port(msg, client.udp_port)
+    client.delay      = requested_delay(msg, client.delay)
+    client.preroll    = requested_preroll(msg, client.preroll)
+    if client.udp_port and client.peer_ip is None:
+        logging.warning('client {} has no peer address for udp'.format(client.id))
+        client.udp_port = 0
+
+    # a different stream starts over, with a burst of history
+    if client.stream_key() != key:
+        client.preroll_pending = True
+
+
+# hot path metrics of this process, the rest is collected at scrape time
+g_metrics = MetricsRegistryType()
+g_fanout_seconds = g_metrics.histogram('fanout_seconds',
+    'time to encode and queue one period for every client')
+g_send_seconds = g_metrics.histogram('send_seconds',
+    'time a client socket takes to accept one message')
+g_ring_depth = g_metrics.histogram('ring_depth',
+    'periods waiting in the period ring when one is fetched', DEPTH_BUCKETS)
+
+
+def server_collector(bufRing, clientD, encode_cache, udp_sender, recorder):
+    # counters kept elsewhere, read only when metrics are scraped or logged
+    def collect():
+        clients = tuple(clientD.values())
+        yield ('periods_total', 'counter', 'periods taken from the period ring',
+            [(None, bufRing.rindex)])
+        yield ('ring_pending', 'gauge', 'periods waiting in the period ring',
+            [(None, bufRing.pending())])
+        yield ('ring_overruns_total', 'counter', 'periods lost to a full period ring',
+            [(None, bufRing.overruns)])
+        yield ('xruns_total', 'counter', 'xruns reported by the audio source',
+            [(None, bufRing.xruns)])
+        yield ('ring_mismatched_total', 'counter',
+            'periods dropped for not being the configured period length',
+            [(None, bufRing.mismatched)])
+        yield ('dtx_silent_periods_total', 'counter',
+            'stream periods sent as silence markers', [(None, encode_cache.silent)])
+        yield ('udp_datagrams_total', 'counter', 'udp datagrams by outcome',
+            [(dict(result='sent'), udp_sender.sent),
+            (dict(result='dropped'), udp_sender.dropped),
+            (dict(result='error'), udp_sender.errors)])
+        yield ('clients', 'gauge', 'connected clients', [(None, len(clients))])
+        yield ('client_queue_depth', 'gauge', 'messages queued per client',
+            [(dict(client=client.id), client.lag()) for client in clients])
+        yield ('client_queue_max_depth', 'gauge',
+            'deepest a client queue has been since the last META',
+            [(dict(client=client.id), client.maxlag) for client in clients])
+        yield ('client_sent_total', 'counter', 'messages sent per client',
+            [(dict(client=client.id), client.sent) for client in clients])
+        yield ('client_dropped_total', 'counter',
+            'messages dropped from full client queues',
+            [(dict(client=client.id), client.dropped) for client in clients])
+        if recorder is not None:
+            stats = recorder.stats()
+            yield ('recorder_periods_total', 'counter', 'recorder periods by outcome',
+                [(dict(result=result), stats[result])
+                for result in ('written', 'dropped', 'lost')])
+            yield ('recorder_pending', 'gauge', 'periods waiting for the recorder',
+                [(None, stats['pending'])])
+            yield ('recorder_files_total', 'counter', 'recording files opened',
+                [(None, stats['files'])])
+            yield ('recorder_errors_total', 'counter', 'recorder file errors',
+                [(None, stats['errors'])])
+    return collect
+# end def server_collector
+
+
+async def client_sender_coro(client):
+    # drain one client's queue, a slow socket only ever stalls this task
+    try:
+        while True:
+            msg = await client.sendq.get()
+            t0 = time.perf_counter()
+            await client.wsock.send(msg)
+            g_send_seconds.observe(time.perf_counter() - t0)
+            client.sent += 1
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logging.info('client {} send failed: {}'.format(client.id, e))
+        drop_client(client)
+# end async def client_sender_coro
+
+
+def drop_client(client, close=False):
+    g_client_d.pop(client.id, None)
+    client.stop()
+    if close:
+        asyncio.ensure_future(client.wsock.close())
+# end def drop_client
+
+
 # list of clients to be appended by handle_incoming_threads
 # this list will be looped over/serviced by handle_buffers_and_clients
 
@@ -174,121 +1793,375 @@ async def handle_wsock_coro(wsock, wsuri):
     # wait for 'connect' message
     while True:
         connect = await ws_recv_json_dict(wsock)
-        if 'message' in connect and 'connect' == connect['message']:
-            client = ClientType(wsock, wsuri, connected=True)
-            g_client_d[client.id] = client
-            await ws_send_json_fields(client.wsock, 
-                    message        = 'connected', 
+        if isinstance(connect, dict) and connect.get('message') == 'connect':
+            drop_policy = connect.get('drop_policy', args.drop_policy)
+            if drop_policy not in DROP_POLICIES:
+                drop_policy = args.drop_policy
+            client = ClientType(wsock, wsuri, connected=True,
+                maxqueue=args.send_queue, drop_policy=drop_policy)
+            client.batch = max(1, args.batch)
+            client.preroll = requested_preroll(dict(preroll_ms=args.preroll_ms), 0)
+            apply_client_request(client, connect)
+            await ws_send_json_fields(client.wsock,
+                    message        = 'connected',
                     id             = client.id,
-                    channel_select = client.channel)
+                    channel_select = client.channels,
+                    drop_policy    = client.drop_policy,
+                    sampleformat   = client.fmt,
+                    mix            = client.mix,
+                    batch          = client.batch,
+                    audio          = client.audio,
+                    meter_rate     = client.meter_rate,
+                    udp_port       = client.udp_port,
+                    rewind         = client.delay * blocksize / samplerate)
+            g_client_d[client.id] = client
+            client.start()
             break
 
     # after 'connect', wait for messages of the types...
     # ('channel_select', )
-    while True:
-        msg = await ws_recv_json_dict(wsock)
-        assert 'message' in msg
-        if msg['message'] in ('channel_select',):
-            try:
-                g_client_d[client.id].channel = int(msg['channel_select'])
-            except Exception as e:
-                print(str(e))
+    try:
+        while client.connected:
+            msg = await ws_recv_json_dict(wsock)
+            assert 'message' in msg
+            if msg['message'] in ('channel_select',):
+                try:
+                    apply_client_request(client, msg)
+                except Exception as e:
+                    print(str(e))
+    except (websockets.ConnectionClosed, ConnectionError):
+        logging.info('client {} disconnected'.format(client.id))
+    finally:
+        drop_client(client)
 # end async def handle_incoming
 
 
-async def sendbufs_wsock_coro(bufQ, clientD):
-    channel_stats = ChannelsStatsType()
+def stream_format_dict(key):
+    # META 'format' block describing the DATA messages of stream key; with
+    # a resampled rate the frames per period vary, the header has the count
+    rate = key.rate or samplerate
+    period_frames = blocksize * rate // samplerate
+    return format_dict(key.fmt,
+        channel_count = channels,
+        channels      = list(key.channels),
+        mix           = key.mix,
+        frame_channels= len(key.mix or key.channels),
+        period_frames = period_frames,
+        batch         = key.batch,
+        message_frames= key.batch * period_frames,
+        header_size   = DATA_HEADER.size,
+        samplerate    = rate,
+        clock_rate    = samplerate, # of the DATA header frame_time
+        dtx           = args.dtx_threshold is not None,
+        rewind        = key.delay * blocksize / samplerate,
+        codec         = key.codec)
+
+
+def send_preroll(client, encode_cache, udp_sender):
+    # a new stream always starts with its META format so the listener can
+    # set up audio, then a burst of history fills the listener's buffer at
+    # once; the burst takes at most half the queue, live periods need the
+    # rest. Returns False if the client should be disconnected
+    key = client.stream_key()
+    if not client.enqueue(json.dumps(dict(format=stream_format_dict(key)))):
+        return False
+    maxmsgs = min(client.sendq.maxsize // 2,
+        client.sendq.maxsize - client.sendq.qsize())
+    msgs = encode_cache.preroll(key, min(client.preroll, maxmsgs * key.batch))
+    for msg in msgs:
+        if client.udp_port:
+            udp_sender.send(msg, (client.peer_ip, client.udp_port))
+        elif not client.enqueue(msg):
+            return False
+    if msgs:
+        logging.debug('client {} pre-roll of {} messages'.format(client.id, len(msgs)))
+    return True
+
+
+async def sendbufs_wsock_coro(bufRing, clientD):
+    channel_stats = ChannelsStatsType(bufRing.channels, bufRing.frames)
     last_meta_send_time = time.time()
+    last_overruns = 0
+    last_xruns = 0
+    mixer = MixerType(bufRing.channels)
+    dtx_threshold = None
+    if args.dtx_threshold is not None:
+        dtx_threshold = 10.0 ** (args.dtx_threshold / 10.0)
+    dtx_hangover = int(np.ceil(args.dtx_hangover_ms * samplerate / 1000.0 / blocksize))
+    history = None
+    if history_periods() > 0:
+        history = HistoryRingType(bufRing.channels, bufRing.frames, history_periods())
+    encode_cache = EncodeCacheType(mixer, dtx_threshold=dtx_threshold,
+        dtx_hangover=dtx_hangover, history=history)
+
+    udp_sender = UdpSenderType(ttl=args.multicast_ttl)
+    mcast_keys, mcast_addr, mcast_meta = [], None, []
+    if args.multicast:
+        mcast_addr = parse_hostport(args.multicast)
+        mcast_keys = multicast_stream_keys()
+        mcast_meta = [dict(group=mcast_addr[0], port=mcast_addr[1],
+            format=stream_format_dict(key)) for key in mcast_keys]
+
+    # in fan-out mode the first worker records, the others only stream
+    recorder = None
+    if args.record_dir and getattr(bufRing, 'ridx', 0) == 0:
+        recorder = RecorderType(bufRing.channels, bufRing.frames, samplerate,
+            args.record_dir, rotate_bytes=args.record_rotate_mb * 2**20,
+            rotate_s=args.record_rotate_s, periods=args.record_queue,
+            retry_s=args.record_retry_s)
+    last_record_dropped = 0
+
+    meter = None
+    if args.meter:
+        meter = MeterType(bufRing.channels, samplerate,
+            nfft=args.meter_fft, bands=args.meter_bands,
+            max_rate=args.max_meter_rate)
+
+    # metrics endpoint and log line, per fan-out worker
+    collector = server_collector(bufRing, clientD, encode_cache, udp_sender,
+        recorder)
+    g_metrics.add_collector(collector)
+    ridx = getattr(bufRing, 'ridx', None)
+    if ridx is not None:
+        g_metrics.labels['worker'] = ridx
+    metrics_server, metrics_log = None, None
+    if args.metrics_port > 0:
+        try:
+            metrics_server = await serve_metrics_coro(g_metrics,
+                args.metrics_host, args.metrics_port + (ridx or 0))
+        except OSError as e:
+            logging.error('metrics endpoint failed: {}'.format(e))
+    if args.metrics_log_s > 0:
+        metrics_log = asyncio.ensure_future(log_metrics_coro(g_metrics,
+            args.metrics_log_s))
 
     while True:
-        jackbufs = await bufQ.get()
+        g_ring_depth.observe(bufRing.pending())
+        jackbufs = await bufRing.get()
 
         if jackbufs is None:
             break # end the thread
+        t0 = time.perf_counter()
 
-        # send buffers ASAP
-        for client in clientD.values():
-            if 1 <= client.channel and client.channel <= len(jackbufs):
-                # channel-1 --> convert 1-based TO 0-based
-                await client.wsock.send(jackbufs[client.channel-1])
-                # FIXME, add exceptions to this in try/except ?
-
-        # update channel statistics with 'rms' and 'clips'
+        # update channel statistics with 'rms' and 'clips', the period
+        # energy also drives the dtx gate
         channel_stats.update_with_bufs(jackbufs)
 
+        # every distinct stream is encoded once, on first request
+        mixer.set_mixes(client.mix for client in clientD.values()
+            if client.mix is not None)
+        encode_cache.new_period(jackbufs, bufRing.frame_time(),
+            channel_stats.period_meansq())
+
+        # queue buffers ASAP, per-client sender tasks do the actual sends
+        for client in tuple(clientD.values()):
+            if not client.audio:
+                continue
+            # a stream that fails to encode costs its client, not the fan-out
+            try:
+                if client.preroll_pending:
+                    client.preroll_pending = False
+                    if not send_preroll(client, encode_cache, udp_sender):
+                        drop_client(client, close=True)
+                        continue
+                payload = encode_cache.get(client.stream_key())
+            except Exception as e:
+                logging.error('client {} stream failed, disconnecting: {!r}'.format(
+                    client.id, e))
+                drop_client(client, close=True)
+                continue
+            if payload is None:
+                continue # batch not complete yet
+            if client.udp_port:
+                udp_sender.send(payload, (client.peer_ip, client.udp_port))
+                continue
+            if not client.enqueue(payload):
+                logging.warning('client {} fell behind, disconnecting'.format(client.id))
+                drop_client(client, close=True)
+
+        # one datagram per multicast stream, whatever the listener count
+        for key in mcast_keys:
+            payload = encode_cache.get(key)
+            if payload is not None:
+                udp_sender.send(payload, mcast_addr)
+
+        meter_clients = meter and tuple(client for client in clientD.values()
+            if client.meter_rate > 0.0)
+        if meter_clients:
+            meter.update(jackbufs, channel_stats.period_peak)
+
+        # one copy in to the recorder's own ring, the writer thread does the rest
+        if recorder is not None:
+            recorder.put(jackbufs)
+
+        # the slot may be overwritten by jack_process from here on
+        bufRing.release()
+        g_fanout_seconds.observe(time.perf_counter() - t0)
+
+        # get() does not yield while periods are waiting, let the sender
+        # tasks drain the queues between periods of a backlog
+        if bufRing.pending():
+            await asyncio.sleep(0)
+
+        if meter_clients:
+            # compute at the fastest requested rate, at most once per period
+            now = time.time()
+            interval = 1.0 / max(client.meter_rate for client in meter_clients)
+            if now - meter.last_compute >= interval:
+                meter_str = json.dumps(meter.compute(now))
+                for client in meter_clients:
+                    if now - client.last_meter >= 1.0/client.meter_rate - interval/2:
+                        client.last_meter = now
+                        if not client.enqueue(meter_str):
+                            drop_client(client, close=True)
+
         if time.time() - last_meta_send_time > 1.0:
             last_meta_send_time = time.time()
 
+            if bufRing.overruns != last_overruns:
+                logging.warning('buffer ring overruns = {}'.format(bufRing.overruns))
+                last_overruns = bufRing.overruns
+            if bufRing.xruns != last_xruns:
+                logging.warning('source xruns = {}'.format(bufRing.xruns))
+                last_xruns = bufRing.xruns
+
             meta_dict = channel_stats.collect_as_dict()
-            meta_dict['format'] = dict(
-                channel_count = len(jack_client.inports),
-                samplerate    = jack_client.samplerate,
-                samplesize    = 32,
-                sampletype    = "float",
-                byteorder     = "little",
-                codec         = "audio/pcm")
-
-            for client in clientD.values():
-                await ws_send_json_fields(client.wsock, **meta_dict)
-                # FIXME with multiple exception types!
+            if recorder is not None:
+                meta_dict['recorder'] = recorder.stats()
+                if recorder.dropped != last_record_dropped:
+                    logging.warning('recorder dropped periods = {}'.format(
+                        recorder.dropped))
+                    last_record_dropped = recorder.dropped
+            if mcast_meta:
+                meta_dict['multicast'] = mcast_meta
+            if udp_sender.dropped or udp_sender.errors:
+                logging.debug('udp sent = {} dropped = {} errors = {}'.format(
+                    udp_sender.sent, udp_sender.dropped, udp_sender.errors))
+
+            # the advertised format is what each client actually receives,
+            # followed by the client's own lag counters
+            meta_strs = dict()
+            for client in tuple(clientD.values()):
+                key = client.stream_key()
+                if key not in meta_strs:
+                    meta_dict['format'] = stream_format_dict(key)
+                    meta_strs[key] = json.dumps(meta_dict)[:-1]
+
+                lag = client.lag_dict()
+                if lag['dropped']:
+                    logging.debug('client {} lag = {}'.format(client.id, lag))
+                meta_str = '{}, "lag": {}}}'.format(meta_strs[key], json.dumps(lag))
+                if not client.enqueue(meta_str):
+                    drop_client(client, close=True)
         # end stats / meta check
     # end while True
 
     # close all the netclient sockets before ending thread
-    for client in clientD.values():
-        client.wsock.close()
+    for client in tuple(clientD.values()):
+        drop_client(client, close=True)
+
+    if recorder is not None:
+        recorder.close()
+        logging.info('recorder stats = {}'.format(recorder.stats()))
+
+    if metrics_log is not None:
+        metrics_log.cancel()
+    if metrics_server is not None:
+        metrics_server.close()
+    g_metrics.remove_collector(collector)
 # end async def sendbufs
 
 
 g_wsock_loop = None
-def wsock_thread_func(asyncBufQ, clientD):
-    global g_wsock_loop
+g_sendbufs_task = None
+def wsock_thread_func(bufRing, clientD):
+    global g_wsock_loop, g_sendbufs_task
+    # create websocket event loop, this is not the main thread
+    g_wsock_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(g_wsock_loop)
+    bufRing.attach_loop(g_wsock_loop)
+
     # create coroutine OBJECT for incoming connections and sending data
     ws_handle_incoming = websockets.serve(handle_wsock_coro, 'localhost', port=args.port)
 
-    # create websocket event loop
-    g_wsock_loop = asyncio.get_event_loop()
-
     # 'put' ws_handle_incoming AND sendbufs_coro() on g_wsock_loop
     asyncio.ensure_future(ws_handle_incoming, loop=g_wsock_loop)
-    asyncio.ensure_future(sendbufs_wsock_coro(asyncBufQ, clientD), loop=g_wsock_loop)
+    if args.tcp_port > 0:
+        asyncio.ensure_future(serve_tcp_coro(args.tcp_host, args.tcp_port),
+            loop=g_wsock_loop)
+    g_sendbufs_task = asyncio.ensure_future(sendbufs_wsock_coro(bufRing, clientD),
+        loop=g_wsock_loop)
 
     # go!
-    g_wsock_loop.run_()
+    g_wsock_loop.run_forever()
 # end def wsock_thread_func
 
-# create global buffer queue, spin up 
-g_buf_q = janus.Queue() # mixed mode queue, async AND sync methods
-g_wsock_thread = threading.Thread( 
-    target=wsock_thread_func, args=(g_buf_q.async_q, g_client_d))
-g_wsock_thread.start()
 
-@jack_client.set_process_callback
-def jack_process(frames):
-    # put tuple of channel buffers in to queue
-    g_buf_q.sync_q.put( (inport.get_buffer() for inport in jack_client.inports) )
-# end jack_process
+def fanout_worker_func(bufReader):
+    global g_wsock_loop
+    # runs in a forked worker process, the parent handles Ctrl+C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    g_wsock_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(g_wsock_loop)
+    bufReader.attach_loop(g_wsock_loop)
+
+    # every worker listens on the same port, the kernel spreads clients
+    ws_handle_incoming = websockets.serve(handle_wsock_coro, 'localhost',
+        port=args.port, reuse_port=True)
+    asyncio.ensure_future(ws_handle_incoming, loop=g_wsock_loop)
+    if args.tcp_port > 0:
+        asyncio.ensure_future(serve_tcp_coro(args.tcp_host, args.tcp_port,
+            reuse_port=True), loop=g_wsock_loop)
 
+    # sendbufs_wsock_coro returns once the shared ring is closed
+    g_wsock_loop.run_until_complete(sendbufs_wsock_coro(bufReader, g_client_d))
+    logging.info('fan-out worker {} exiting'.format(bufReader.ridx))
+# end def fanout_worker_func
 
-@jack_client.set_shutdown_callback
-def jack_shutdown(status, reason):
-    print('JACK shutdown!')
-    print('    status:', status)
-    print('    reason:', reason)
-    clean_up_threads_etc()
-    event.set()
+# created by main()
+g_buf_ring = None
+g_wsock_thread = None
+g_workers = []
 
 
-# create input ports
-for chidx in range(channels):
-    jack_client.inports.register('input_{:02d}'.format(chidx))
+def source_shutdown():
+    # the source is gone (e.g. the JACK server stopped), shut down too
+    clean_up_threads_etc()
+    event.set()
 
 
 def clean_up_threads_etc():
     # global g_wsock_loop
     # global g_wsock_thread
 
+    # wake sendbufs_wsock_coro so it can close the client sockets, then
     # I think this is enough to stop g_wsock_loop and g_wsock_thread...
+    g_buf_ring.close()
+
+    if args.workers > 0:
+        if g_workers: # clean_up_threads_etc may be called twice
+            logging.debug('waiting for fan-out workers to exit')
+            for worker in g_workers:
+                worker.join(timeout=5.0)
+                if worker.is_alive():
+                    worker.terminate()
+            del g_workers[:]
+            g_buf_ring.unlink()
+            logging.info('fan-out workers have exited')
+        return
+
+    if g_wsock_thread is None or not g_wsock_thread.is_alive():
+        return # clean_up_threads_etc may be called twice
+
+    # let sendbufs_wsock_coro close the clients and the recorder before
+    # the loop stops under it
+    if g_sendbufs_task is not None:
+        done = asyncio.run_coroutine_threadsafe(asyncio.wait([g_sendbufs_task]),
+            g_wsock_loop)
+        try:
+            done.result(timeout=30.0)
+        except concurrent.futures.TimeoutError:
+            logging.warning('sendbufs_wsock_coro did not finish, stopping anyway')
     g_wsock_loop.call_soon_threadsafe( g_wsock_loop.stop )
 
     # wait for those threads to finish
@@ -301,16 +2174,49 @@ def clean_up_threads_etc():
 # end def clean_up_threads_etc()
 
 
-with jack_client:
+def main(argv=None):
+    global g_buf_ring, g_wsock_thread
+    configure(argv)
+
+    # create global buffer ring, spin up
+    if args.workers > 0:
+        # fork before the source is created, workers never touch libjack
+        g_buf_ring = SharedPeriodRingType(channels, blocksize,
+            periods=args.ring_periods, readers=args.workers)
+        mpctx = multiprocessing.get_context('fork')
+        for ridx in range(args.workers):
+            worker = mpctx.Process(target=fanout_worker_func,
+                args=(g_buf_ring.reader(ridx),), daemon=True)
+            worker.start()
+            g_workers.append(worker)
+    else:
+        g_buf_ring = PeriodRingType(channels, blocksize, periods=args.ring_periods)
+        g_wsock_thread = threading.Thread(
+            target=wsock_thread_func, args=(g_buf_ring, g_client_d))
+        g_wsock_thread.start()
+
+    # in the parent only, after the fork
+    try:
+        source = make_source(args)
+    except Exception:
+        clean_up_threads_etc()
+        raise
+    if (source.samplerate, source.blocksize) != (samplerate, blocksize):
+        logging.error('JACK changed to {} Hz / {} frames since it was probed at '
+            '{} Hz / {} frames'.format(source.samplerate, source.blocksize,
+            samplerate, blocksize))
+    source.start(g_buf_ring, source_shutdown)
     print('\nPress Ctrl+C to stop\n')
     try:
         event.wait()
     except KeyboardInterrupt:
         logging.warning('Interrupted by user')
 
+    # no more writes in to the ring before it is closed and unmapped
+    source.stop()
     clean_up_threads_etc()
+# end def main
 
 
-# When the above with-statement is left (either because the end of the# signal buf handler thread to end
-# code block is reached, or because an exception was raised inside),
-# jack_client.deactivate() and jack_client.close() are called automatically.
+if __name__ == '__main__':
+    main()
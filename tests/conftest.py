@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+# the jack_stream_* modules live flat in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='module')
+def talk():
+    '''jack_stream_talk configured for a 4 channel, 48 kHz synthetic source'''
+    import jack_stream_talk
+    jack_stream_talk.configure(['--source', 'synthetic', '-c', '4',
+        '--synth-rate', '48000', '--synth-period', '256', '--loglevel', 'warning'])
+    return jack_stream_talk
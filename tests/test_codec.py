@@ -0,0 +1,130 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from jack_stream_common import encode_samples, decode_samples, quantize_samples, \
+    encode_lossless, decode_lossless, decode_payload, LOSSLESS_CODEC, \
+    SAMPLE_FORMATS
+
+
+def signals(frames=512, channels=2):
+    rng = np.random.default_rng(7)
+    t = np.arange(frames)[:, None]
+    yield 'tone', (0.5 * np.sin(t / 9.0 + np.arange(channels))).astype(np.float32)
+    yield 'noise', rng.uniform(-1.0, 1.0, (frames, channels)).astype(np.float32)
+    yield 'silence', np.zeros((frames, channels), np.float32)
+    yield 'full scale', np.tile(np.float32([1.0, -1.0]), (frames, channels // 2))
+
+
+@pytest.mark.parametrize('fmt', ['float32', 'int16', 'int24'])
+def test_pcm_roundtrip(fmt):
+    bits = SAMPLE_FORMATS[fmt]['samplesize']
+    for name, x in signals():
+        buf = encode_samples(x, fmt).tobytes()
+        assert len(buf) == x.size * bits // 8, name
+        y = decode_samples(buf, fmt).reshape(x.shape)
+        if fmt == 'float32':
+            assert np.array_equal(x, y), name
+        else:
+            # rounding, and +1.0 clips to the largest code
+            assert np.abs(x - y).max() <= 2.0 ** (1 - bits), name
+
+
+def test_int24_negative_sign_extension():
+    x = np.float32([-1.0, -2.0**-23, 0.0, 2.0**-23, 1.0 - 2.0**-23])
+    y = decode_samples(encode_samples(x, 'int24').tobytes(), 'int24')
+    assert np.array_equal(x, y)
+
+
+def test_int24_keeps_row_slicing():
+    x = np.zeros((3, 8), np.float32)
+    assert encode_samples(x, 'int24')[1].shape == (8, 3)
+
+
+def test_dither_stays_within_one_lsb():
+    rng = np.random.default_rng(1)
+    x = np.full(10000, 0.25, np.float32)
+    q = quantize_samples(x, 'int16', rng)
+    assert abs(q.astype(np.int64) - 8192).max() <= 1
+    assert len(np.unique(q)) > 1
+
+
+@pytest.mark.parametrize('fmt', ['int16', 'int24'])
+def test_dither_error_near_full_scale(fmt):
+    # TPDF dither makes the total error variance 1/4 LSB**2 whatever the
+    # signal, if the dither survives to the rounding
+    rng = np.random.default_rng(2)
+    scale = 2.0 ** (SAMPLE_FORMATS[fmt]['samplesize'] - 1)
+    for level in (0.6, 0.9, 0.99):
+        x = np.full(100000, level, np.float32)
+        err = quantize_samples(x, fmt, rng) - np.float64(x[0]) * scale
+        assert abs(err.mean()) < 0.02
+        assert abs(err.std() - 0.5) < 0.02
+
+
+@pytest.mark.parametrize('fmt', ['int16', 'int24'])
+def test_lossless_roundtrip(fmt):
+    for name, x in signals():
+        q = quantize_samples(x, fmt)
+        buf = encode_lossless(q)
+        assert np.array_equal(decode_lossless(buf), q), name
+        y = decode_payload(buf, fmt, LOSSLESS_CODEC).reshape(x.shape)
+        assert np.array_equal(y, decode_samples(encode_samples(x, fmt).tobytes(),
+            fmt).reshape(x.shape)), name
+
+
+@pytest.mark.parametrize('fmt', ['int16', 'int24'])
+def test_lossless_size(fmt):
+    raw = 512 * 2 * SAMPLE_FORMATS[fmt]['samplesize'] // 8
+    sizes = {name: len(encode_lossless(quantize_samples(x, fmt)))
+        for name, x in signals()}
+    assert sizes['tone'] < 0.75 * raw
+    assert sizes['silence'] < 0.1 * raw
+    # incompressible channels are stored verbatim, plus headers
+    assert sizes['noise'] <= raw + 32
+
+
+def test_lossless_short_and_empty_blocks():
+    rng = np.random.default_rng(3)
+    for frames in range(6):
+        q = rng.integers(-2**23, 2**23, (frames, 3))
+        assert np.array_equal(decode_lossless(encode_lossless(q)), q)
+
+
+def test_lossless_concatenated_blocks():
+    a = np.arange(100).reshape(50, 2)
+    b = -np.arange(60).reshape(30, 2)
+    got = decode_lossless(encode_lossless(a) + encode_lossless(b))
+    assert np.array_equal(got, np.concatenate((a, b)))
+
+
+def test_lossless_extreme_values():
+    q = np.array([-2**31, 2**31 - 1, 0, 5, -7, 2**31 - 1])
+    assert np.array_equal(decode_lossless(encode_lossless(q))[:, 0], q)
+
+
+def test_lossless_rejects_bad_length():
+    buf = bytearray(encode_lossless(np.arange(64).reshape(32, 2)))
+    buf[0] += 1
+    with pytest.raises(Exception):
+        decode_lossless(bytes(buf) + b'\0')
+
+
+def test_lossless_rejects_foreign_payloads():
+    # PCM or garbage must fail on the block header, not after allocating
+    # what the header claims
+    rng = np.random.default_rng(5)
+    pcm = encode_samples(rng.uniform(-1.0, 1.0, (512, 2)).astype(np.float32),
+        'int16').tobytes()
+    good = encode_lossless(quantize_samples(np.zeros((256, 2), np.float32), 'int16'))
+    bufs = [pcm, good[:-1], good[:10], good + b'\0' * 3]
+    bufs += [rng.integers(0, 256, 1024, np.uint8).tobytes() for idx in range(50)]
+    tracemalloc.start()
+    try:
+        for buf in bufs:
+            with pytest.raises(ValueError):
+                decode_lossless(buf)
+        assert tracemalloc.get_traced_memory()[1] < 2**20
+    finally:
+        tracemalloc.stop()
@@ -0,0 +1,25 @@
+import pytest
+
+from jack_stream_headless import ConnStatsType, LATENCY_RESERVOIR
+
+
+def test_latency_sample_is_bounded():
+    st = ConnStatsType(0)
+    # 0 .. 9.99 ms on top of an arbitrary clock offset, evenly spread
+    for idx in range(100000):
+        st.add_latency(1234.5 + (idx * 7919 % 1000) * 1e-5)
+    assert len(st.latency) == LATENCY_RESERVOIR
+    lat = st.summary(1.0, 48000)['latency_ms']
+    assert lat['max'] == pytest.approx(9.99, abs=1e-6)
+    assert abs(lat['p50'] - 5.0) < 0.5
+    assert abs(lat['p90'] - 9.0) < 0.5
+    assert lat['p99.9'] <= lat['max']
+
+
+def test_latency_summary_of_short_runs_is_exact():
+    st = ConnStatsType(1)
+    for value in (2.0, 2.001, 2.003):
+        st.add_latency(value)
+    lat = st.summary(1.0, 48000)['latency_ms']
+    assert lat['p50'] == pytest.approx(1.0)
+    assert lat['max'] == pytest.approx(3.0)
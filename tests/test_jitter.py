@@ -0,0 +1,106 @@
+import numpy as np
+
+from jack_stream_common import JitterBufferType, DriftCompensatorType, \
+    FractionalResamplerType
+
+RATE = 48000
+
+
+def ramp(start, frames, channels=2):
+    # distinct, increasing samples so order and gaps are visible
+    x = np.arange(start, start + frames, dtype=np.float32)[:, None]
+    return np.repeat(x, channels, axis=1)
+
+
+def test_buffers_to_target_then_plays_in_order():
+    jb = JitterBufferType(2, RATE, target_ms=10.0, min_ms=10.0)
+    jb.write(ramp(0, 256), now=0.0)
+    assert not jb.read(128).any() # still buffering, target is 480
+    jb.write(ramp(256, 256), now=0.0)
+    out = np.concatenate([jb.read(128) for idx in range(4)])
+    assert np.array_equal(out, ramp(0, 512))
+    assert jb.underruns == 0
+
+
+def test_underrun_pads_and_rebuffers():
+    jb = JitterBufferType(2, RATE, target_ms=2.0, min_ms=2.0)
+    jb.write(ramp(1, 100), now=0.0)
+    out = jb.read(160)
+    assert len(out) == 160
+    assert np.array_equal(out[:100], ramp(1, 100))
+    assert not out[100:].any()
+    assert jb.underruns == 1 and jb.buffering
+
+
+def test_excess_depth_is_dropped_to_target():
+    jb = JitterBufferType(1, RATE, target_ms=2.0, min_ms=2.0, fade=16)
+    jb.write(np.zeros((5000, 1), np.float32), now=0.0)
+    jb.read(96)
+    assert jb.dropped > 0
+    assert jb.depth() <= jb.target
+
+
+def test_overrun_keeps_newest_audio():
+    jb = JitterBufferType(1, RATE, target_ms=1.0, min_ms=1.0, max_ms=1.0)
+    for start in range(0, 300, 50):
+        jb.write(ramp(start, 50, 1), now=0.0)
+    assert jb.overruns > 0
+    assert jb.depth() == jb.capacity
+    assert np.array_equal(jb.read(jb.capacity), ramp(300 - jb.capacity, jb.capacity, 1))
+
+
+def test_target_follows_jitter():
+    jb = JitterBufferType(1, RATE, target_ms=20.0, min_ms=20.0)
+    rng = np.random.default_rng(0)
+    now = 0.0
+    for idx in range(500):
+        now += 0.01 + rng.uniform(0.0, 0.04) # 10 ms messages, up to 40 ms late
+        jb.write(np.zeros((480, 1), np.float32), now=now)
+    assert jb.target > int(0.02 * RATE)
+    assert jb.target <= jb.max_target
+
+
+def test_fractional_resampler_unity_is_a_delay():
+    rs = FractionalResamplerType(2)
+    x = ramp(1, 100)
+    out = rs.process(x, 1.0)
+    # two frames of the zeroed history come out first
+    assert np.allclose(out[2:], x[:-2])
+    assert not out[:2].any()
+
+
+def test_fractional_resampler_block_continuity():
+    x = np.sin(np.arange(4000) / 17.0)[:, None].astype(np.float32)
+    whole = FractionalResamplerType(1).process(x, 0.9993)
+    rs = FractionalResamplerType(1)
+    sizes = [1, 7, 256, 3, 1000]
+    parts, pos = [], 0
+    for size in sizes * 4:
+        parts.append(rs.process(x[pos:pos+size], 0.9993))
+        pos += size
+    parts.append(rs.process(x[pos:], 0.9993))
+    assert np.allclose(np.concatenate(parts), whole, atol=1e-5)
+    assert abs(len(whole) - 0.9993 * len(x)) <= 1
+
+
+def test_drift_compensator_tracks_fast_sender():
+    # the sender clock runs 300 ppm fast: 480 frames every 10 ms / 1.0003,
+    # the sound card plays 480 frames every 10 ms
+    jb = JitterBufferType(1, RATE, target_ms=40.0, min_ms=40.0)
+    drift = DriftCompensatorType(1, RATE)
+    block = np.zeros((480, 1), np.float32)
+    played = 0
+    ppms, depths = [], []
+    for idx in range(1, 30000):
+        now = idx * 0.01 / 1.0003
+        jb.write(drift.process(block, jb, now=now), now=now)
+        while played + 480 <= now * RATE:
+            jb.read(480)
+            played += 480
+        if idx > 20000:
+            ppms.append(drift.ppm())
+            depths.append(jb.depth() - jb.target)
+    # settled: the ratio cancels the drift, the depth no longer walks away
+    assert abs(np.mean(ppms) + 300.0) < 60.0
+    assert jb.underruns == 0 and jb.dropped == 0
+    assert np.abs(depths).max() < 0.02 * RATE
@@ -0,0 +1,104 @@
+import json
+
+from jack_stream_common import MsgParserType, pack_msg, msgify_pkt, \
+    pack_data_header, pack_silence, parse_data, seq_delta, SILENCE_FORMAT_ID, \
+    FORMAT_IDS, DATA_HEADER, FORMAT_CODECS, PCM_CODEC, LOSSLESS_CODEC
+
+
+class QuietLog:
+    def warning(self, *args): pass
+    def error(self, *args): pass
+
+
+def parse_all(parser, chunks):
+    # copy the views, they are only valid until the next feed()
+    return [(msgtype, bytes(view)) for chunk in chunks
+        for msgtype, view in parser.feed(chunk)]
+
+
+def make_stream():
+    msgs = [('META', json.dumps(dict(rms=[0.5])).encode())]
+    msgs += [('DATA', bytes([idx]) * (100 + idx)) for idx in range(20)]
+    return msgs, b''.join(pack_msg(msgtype, payload) for msgtype, payload in msgs)
+
+
+def test_parser_any_split():
+    msgs, stream = make_stream()
+    for chunk in (1, 3, 7, 64, 1448, len(stream)):
+        parser = MsgParserType(log=QuietLog())
+        chunks = [stream[idx:idx+chunk] for idx in range(0, len(stream), chunk)]
+        assert parse_all(parser, chunks) == msgs
+
+
+def test_parser_small_buffer_grows():
+    msgs, stream = make_stream()
+    parser = MsgParserType(bufsize=16, log=QuietLog())
+    assert parse_all(parser, [stream[:500], stream[500:]]) == msgs
+
+
+def test_parser_garbage_resync():
+    msgs, stream = make_stream()
+    parser = MsgParserType(log=QuietLog())
+    got = parse_all(parser, [b'xxDAT', b'Agarbage' + stream])
+    assert got == msgs
+    assert parser.resyncs > 0 and parser.skipped > 0
+
+
+def test_parser_garbage_between_messages():
+    first, second = pack_msg('DATA', b'abc'), pack_msg('DATA', b'defg')
+    parser = MsgParserType(log=QuietLog())
+    got = parse_all(parser, [first + b'\x00junk\xff' + second])
+    assert got == [('DATA', b'abc'), ('DATA', b'defg')]
+
+
+def test_parser_rejects_oversized_length():
+    bad = b'DATA' + (1 << 30).to_bytes(4, 'little')
+    parser = MsgParserType(maxlen=1 << 20, log=QuietLog())
+    assert parse_all(parser, [bad + pack_msg('DATA', b'ok')]) == [('DATA', b'ok')]
+
+
+def test_msgify_pkt_matches_parser():
+    # msgify_pkt takes the last listed msgtype it finds, so DATA only
+    payloads = [bytes([idx]) * (10 + idx) for idx in range(10)]
+    stream = b''.join(pack_msg('DATA', payload) for payload in payloads)
+    prevpkt = bytearray()
+    got = []
+    msgtype, msg = msgify_pkt(prevpkt, stream, log=QuietLog())
+    while msgtype == 'DATA':
+        got.append(bytes(msg))
+        msgtype, msg = msgify_pkt(prevpkt, b'', log=QuietLog())
+    assert got == payloads
+    assert parse_all(MsgParserType(log=QuietLog()), [stream]) == \
+        [('DATA', payload) for payload in payloads]
+
+
+def test_data_header_roundtrip():
+    msg = pack_data_header('int24', 2, 2**32 + 5, 2**33 + 7, 0b101, 256) + b'\x01' * 6
+    hdr, payload = parse_data(msg)
+    assert len(msg) - len(payload) == DATA_HEADER.size
+    assert hdr.format_id == FORMAT_IDS['int24']
+    assert (hdr.frame_channels, hdr.sequence, hdr.frame_time) == (2, 5, 7)
+    assert (hdr.channel_mask, hdr.frames) == (0b101, 256)
+    assert bytes(payload) == b'\x01' * 6
+
+
+def test_data_header_names_the_codec():
+    pcm, _ = parse_data(pack_data_header('int16', 1, 0, 0, 1, 64))
+    lpc, _ = parse_data(pack_data_header('int16', 1, 0, 0, 1, 64, LOSSLESS_CODEC))
+    assert pcm.format_id == FORMAT_IDS['int16']
+    assert FORMAT_CODECS[pcm.format_id] == ('int16', PCM_CODEC)
+    assert FORMAT_CODECS[lpc.format_id] == ('int16', LOSSLESS_CODEC)
+    assert len(set(FORMAT_CODECS)) == len(FORMAT_CODECS)
+
+
+def test_silence_marker_has_no_payload():
+    hdr, payload = parse_data(pack_silence(2, 9, 100, 0b11, 512))
+    assert hdr.format_id == SILENCE_FORMAT_ID
+    assert (hdr.sequence, hdr.frames) == (9, 512)
+    assert len(payload) == 0
+
+
+def test_seq_delta_wraps():
+    assert seq_delta(5, 5) == 0
+    assert seq_delta(7, 5) == 2
+    assert seq_delta(1, 0xffffffff) == 2
@@ -0,0 +1,100 @@
+import errno
+import glob
+import os
+import struct
+import time
+
+import numpy as np
+
+from jack_stream_record import RecorderType, MmapWavType, WAV_HEADER_SIZE
+
+
+def data_frames(path, channels):
+    # frames the data chunk header claims
+    with open(path, 'rb') as f:
+        head = f.read(WAV_HEADER_SIZE)
+    assert head[:4] == b'RIFF' and head[-8:-4] == b'data'
+    return struct.unpack('<I', head[-4:])[0] // (4 * channels)
+
+
+def test_wav_grows_in_chunks_and_header_follows(tmp_path):
+    path = str(tmp_path / 'a.wav')
+    wav = MmapWavType(path, 2, 1000, max_frames=10000, chunk_frames=300)
+    assert os.path.getsize(path) == WAV_HEADER_SIZE
+    x = np.arange(2 * 700, dtype=np.float32).reshape(700, 2)
+    assert wav.write(x) == 700
+    assert data_frames(path, 2) == 700
+    assert os.path.getsize(path) == WAV_HEADER_SIZE + 900 * 8 # three chunks
+    wav.close()
+    assert os.path.getsize(path) == WAV_HEADER_SIZE + 700 * 8
+    with open(path, 'rb') as f:
+        f.seek(WAV_HEADER_SIZE)
+        assert np.array_equal(np.frombuffer(f.read(), '<f4').reshape(-1, 2), x)
+
+
+def test_wav_stops_at_max_frames(tmp_path):
+    wav = MmapWavType(str(tmp_path / 'b.wav'), 1, 1000, max_frames=100,
+        chunk_frames=64)
+    assert wav.write(np.ones((150, 1), np.float32)) == 100
+    assert wav.frames_left() == 0
+    wav.close()
+
+
+def test_recorder_rotates_without_losing_frames(tmp_path):
+    rec = RecorderType(3, 256, 1000, str(tmp_path), rotate_s=10.0, chunk_s=0.7)
+    rng = np.random.default_rng(0)
+    periods = [rng.standard_normal((3, 256)).astype(np.float32) for idx in range(100)]
+    for bufs in periods:
+        while not rec.put(bufs):
+            time.sleep(0.001)
+    rec.close()
+    stats = rec.stats()
+    assert (stats['written'], stats['dropped'], stats['errors']) == (100, 0, 0)
+
+    files = sorted(glob.glob(str(tmp_path / '*.wav')))
+    assert len(files) == stats['files'] == 3
+    got = []
+    for path in files:
+        frames = data_frames(path, 3)
+        assert os.path.getsize(path) == WAV_HEADER_SIZE + frames * 12
+        with open(path, 'rb') as f:
+            f.seek(WAV_HEADER_SIZE)
+            got.append(np.frombuffer(f.read(), '<f4').reshape(-1, 3))
+    assert np.array_equal(np.concatenate(got), np.concatenate(periods, axis=1).T)
+
+
+def put_all(rec, periods):
+    for bufs in periods:
+        while not rec.put(bufs):
+            time.sleep(0.001)
+    rec.close()
+
+
+def test_recorder_backs_off_after_errors(tmp_path, monkeypatch):
+    fallocate = os.posix_fallocate
+    failures = [1]
+    def disk_full(fd, offset, size):
+        if failures[0]:
+            failures[0] -= 1
+            raise OSError(errno.ENOSPC, 'No space left on device')
+        fallocate(fd, offset, size)
+    monkeypatch.setattr(os, 'posix_fallocate', disk_full)
+    periods = [np.ones((2, 64), np.float32)] * 50
+
+    # no file per period while backing off, and no empty files left
+    rec = RecorderType(2, 64, 1000, str(tmp_path / 'a'), retry_s=60.0)
+    put_all(rec, periods)
+    stats = rec.stats()
+    assert (stats['errors'], stats['lost'], stats['written'], stats['files']) == \
+        (1, 50, 0, 1)
+    assert glob.glob(str(tmp_path / 'a' / '*.wav')) == []
+
+    # once the retry is due, recording resumes in a new file
+    failures[0] = 1
+    rec = RecorderType(2, 64, 1000, str(tmp_path / 'b'), retry_s=0.0)
+    put_all(rec, periods)
+    stats = rec.stats()
+    assert (stats['errors'], stats['lost'], stats['written'], stats['files']) == \
+        (1, 1, 49, 2)
+    files = glob.glob(str(tmp_path / 'b' / '*.wav'))
+    assert len(files) == 1 and data_frames(files[0], 2) == 49 * 64
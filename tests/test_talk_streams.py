@@ -0,0 +1,207 @@
+import json
+
+import numpy as np
+
+from jack_stream_common import parse_data, decode_samples, SILENCE_FORMAT_ID, \
+    PCM_CODEC, MASK_CHANNELS
+
+FRAMES = 256
+
+
+def key(talk, channels=(1, 2), fmt='float32', rate=None, mix=None, batch=1,
+        delay=0, codec=PCM_CODEC):
+    return talk.StreamKey(channels, fmt, rate, codec, mix, batch, delay)
+
+
+def period(idx, channels=4):
+    # every sample tells its period, channel and frame
+    frames = np.arange(FRAMES, dtype=np.float32) / 1e4
+    return (idx + np.arange(channels, dtype=np.float32)[:, None] / 10.0
+        + frames).astype(np.float32) / 100.0
+
+
+def test_resampler_block_continuity(talk):
+    x = np.sin(2 * np.pi * 1000.0 * np.arange(4800) / 48000.0)[:, None]
+    x = x.astype(np.float32)
+    whole = talk.ResamplerType(48000, 44100, 1).process(x)
+    rs = talk.ResamplerType(48000, 44100, 1)
+    parts = [rs.process(x[pos:pos+FRAMES]) for pos in range(0, len(x), FRAMES)]
+    assert np.allclose(np.concatenate(parts), whole, atol=1e-5)
+    assert len(whole) == 4410
+
+
+def test_resampler_keeps_passband_level(talk):
+    x = np.sin(2 * np.pi * 1000.0 * np.arange(9600) / 48000.0)[:, None]
+    out = talk.ResamplerType(48000, 16000, 1).process(x.astype(np.float32))
+    assert len(out) == 3200
+    steady = out[200:-200, 0]
+    assert abs(np.sqrt(2 * np.mean(steady ** 2)) - 1.0) < 0.01
+
+
+def test_resampler_skip_matches_process(talk):
+    a = talk.ResamplerType(48000, 44100, 2)
+    b = talk.ResamplerType(48000, 44100, 2)
+    silence = np.zeros((FRAMES, 2), np.float32)
+    counts = [len(a.process(silence)) for idx in range(20)]
+    assert [b.skip(FRAMES) for idx in range(20)] == counts
+    assert a.pos == b.pos
+
+
+def test_mixer_gains(talk):
+    mixer = talk.MixerType(4)
+    mono = ((1.0, 0.0, 0.5, 0.0),)
+    stereo = ((1.0, 0.0, 0.0, 0.0), (0.0, 0.25, 0.0, 2.0))
+    mixer.set_mixes([mono, stereo, mono])
+    bufs = period(3)
+    mixer.new_period(bufs)
+    assert np.allclose(mixer.get(mono), np.array(mono, np.float32) @ bufs)
+    assert np.allclose(mixer.get(stereo), np.array(stereo, np.float32) @ bufs)
+    assert mixer.gains.shape == (3, 4) # equal signatures share rows
+
+
+def test_encode_cache_shares_one_encode(talk):
+    cache = talk.EncodeCacheType(talk.MixerType(4))
+    cache.new_period(period(0))
+    k = key(talk)
+    assert cache.get(k) is cache.get(k)
+    assert (cache.misses, cache.hits) == (1, 1)
+
+
+def test_encode_cache_batches_periods(talk):
+    cache = talk.EncodeCacheType(talk.MixerType(4))
+    k = key(talk, channels=(2, 4), batch=3)
+    msgs = []
+    for idx in range(6):
+        cache.new_period(period(idx), frame_time=idx * FRAMES)
+        msgs.append(cache.get(k))
+    assert [msg is None for msg in msgs] == [True, True, False] * 2
+    for seq, msg in enumerate((msgs[2], msgs[5])):
+        hdr, payload = parse_data(msg)
+        assert (hdr.sequence, hdr.frames) == (seq, 3 * FRAMES)
+        assert hdr.frame_time == seq * 3 * FRAMES
+        assert hdr.channel_mask == 0b1010
+        expect = np.concatenate([period(idx)[[1, 3]].T
+            for idx in range(3 * seq, 3 * seq + 3)])
+        assert np.array_equal(decode_samples(payload, 'float32'), expect.reshape(-1))
+
+
+def test_preroll_runs_in_to_the_live_stream(talk):
+    cache = talk.EncodeCacheType(talk.MixerType(4),
+        history=talk.HistoryRingType(4, FRAMES, 16))
+    k = key(talk, channels=(1,))
+    for idx in range(10):
+        cache.new_period(period(idx), frame_time=idx * FRAMES)
+        cache.get(k)
+
+    # a client joins before this period is encoded
+    cache.new_period(period(10), frame_time=10 * FRAMES)
+    burst = [parse_data(msg)[0] for msg in cache.preroll(k, 4)]
+    live = parse_data(cache.get(k))[0]
+    assert [hdr.sequence for hdr in burst] == [6, 7, 8, 9]
+    assert [hdr.frame_time // FRAMES for hdr in burst] == [6, 7, 8, 9]
+    assert (live.sequence, live.frame_time // FRAMES) == (10, 10)
+
+    # and after it was encoded, the burst ends right before it
+    cache.new_period(period(11), frame_time=11 * FRAMES)
+    live = parse_data(cache.get(k))[0]
+    burst = [parse_data(msg)[0] for msg in cache.preroll(k, 3)]
+    assert [hdr.sequence for hdr in burst] == [8, 9, 10]
+    assert live.sequence == 11
+
+
+def test_preroll_format_first_and_capped(talk):
+    cache = talk.EncodeCacheType(talk.MixerType(4),
+        history=talk.HistoryRingType(4, FRAMES, 16))
+    for idx in range(12):
+        cache.new_period(period(idx), frame_time=idx * FRAMES)
+    for preroll, expect in ((0, 0), (3, 3), (10, 4)):
+        client = talk.ClientType(None, None, maxqueue=8)
+        client.preroll = preroll
+        assert talk.send_preroll(client, cache, None)
+        msgs = queued(client)
+        assert json.loads(msgs[0])['format']['frame_channels'] == 1
+        assert len(msgs) == 1 + expect
+        assert all(isinstance(msg, bytes) for msg in msgs[1:])
+
+
+def test_dtx_sends_silence_markers_after_hangover(talk):
+    cache = talk.EncodeCacheType(talk.MixerType(4), dtx_threshold=1e-6,
+        dtx_hangover=2)
+    k = key(talk)
+    quiet, loud = np.zeros(4), np.ones(4)
+    ids = []
+    for meansq in (loud, quiet, quiet, quiet, quiet, loud):
+        cache.new_period(period(0), meansq=meansq)
+        hdr, payload = parse_data(cache.get(k))
+        ids.append(hdr.format_id)
+        assert hdr.frames == FRAMES
+        assert len(payload) == (0 if hdr.format_id == SILENCE_FORMAT_ID
+            else 2 * 4 * FRAMES)
+    assert [fid == SILENCE_FORMAT_ID for fid in ids] == \
+        [False, False, False, True, True, False]
+    assert cache.silent == 2
+
+
+def test_requested_channels_validation(talk, monkeypatch):
+    assert talk.requested_channels(dict(channel_select=[2, 4]), (1,)) == (2, 4)
+    assert talk.requested_channels(dict(channel_select=3), (1,)) == (3,)
+    for bad in ([0], [5], [], [-1]):
+        assert talk.requested_channels(dict(channel_select=bad), (1,)) == (1,)
+    monkeypatch.setattr(talk, 'channels', MASK_CHANNELS + 6)
+    assert talk.requested_channels(dict(channel_select=[MASK_CHANNELS]), (1,)) == \
+        (MASK_CHANNELS,)
+    assert talk.requested_channels(dict(channel_select=[MASK_CHANNELS + 2]),
+        (1,)) == (1,)
+
+
+def test_requested_mix_validation(talk, monkeypatch):
+    assert talk.requested_mix(dict(mix={'1': 1.0, '4': 0.5}), None) == \
+        ((1.0, 0.0, 0.0, 0.5),)
+    assert talk.requested_mix(dict(mix=[[1, 0, 0, 0], [0, 1, 0, 0]]), None) == \
+        ((1.0, 0.0, 0.0, 0.0), (0.0, 1.0, 0.0, 0.0))
+    assert talk.requested_mix(dict(mix=None), 'old') is None
+    for bad in ({'0': 1.0}, {'-1': 1.0}, {'5': 1.0}, [1.0, 2.0], [[1, 0, 0, 0]] * 3):
+        assert talk.requested_mix(dict(mix=bad), 'old') == 'old'
+    monkeypatch.setattr(talk, 'channels', MASK_CHANNELS + 6)
+    assert talk.requested_mix(dict(mix={str(MASK_CHANNELS + 1): 1.0}), 'old') == 'old'
+
+
+def queued(client):
+    return list(client.sendq._queue)
+
+
+def test_drop_oldest_keeps_meta(talk):
+    client = talk.ClientType(None, None, maxqueue=4)
+    for msg in ('meta', b'a', b'b', 'meter', b'c', 'meta2'):
+        assert client.enqueue(msg)
+    assert queued(client) == ['meta', 'meter', b'c', 'meta2']
+    assert client.dropped == 2
+
+    # nothing but META queued: DATA gives way, a new META replaces the oldest
+    client = talk.ClientType(None, None, maxqueue=2)
+    for msg in ('m1', 'm2', b'a', 'm3'):
+        assert client.enqueue(msg)
+    assert queued(client) == ['m2', 'm3']
+
+
+def test_lag_counters_reset_per_meta(talk):
+    client = talk.ClientType(None, None, maxqueue=8)
+    for idx in range(5):
+        client.enqueue(b'x')
+    for idx in range(3):
+        client.sendq.get_nowait()
+    assert client.lag_dict() == dict(lag=2, maxlag=5, sent=0, dropped=0)
+    assert client.lag_dict()['maxlag'] == 2
+
+
+def test_malformed_requests_fall_back(talk):
+    for bad in (dict(channel_select='abc'), dict(channel_select=[None]),
+            dict(channel_select=float('inf')), dict(format=['int16']),
+            dict(format={'int16': 1}), dict(codec=['audio/pcm']),
+            dict(batch_ms=float('inf')), dict(rate=float('inf')),
+            dict(preroll_ms=float('nan')), dict(rewind=float('inf')),
+            dict(udp_port=[1]), dict(meter_rate='x'), dict(mix='abc')):
+        client = talk.ClientType(None, None)
+        key = client.stream_key()
+        talk.apply_client_request(client, bad)
+        assert client.stream_key() == key, bad